@@ -0,0 +1,277 @@
+from external_libraries import *
+import data_const as const
+from instrumentation import stage
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import struct
+import threading
+
+class AudioDecoder(ABC):
+    @abstractmethod
+    def load(self, path, sr=22050, mono=True) -> Tuple[np.ndarray, int]:
+        pass
+
+
+class LibrosaDecoder(AudioDecoder):
+    def __init__(self, res_type="soxr_hq"):
+        self.res_type = res_type
+
+    def load(self, path, sr=22050, mono=True):
+        return librosa.load(path, sr=sr, mono=mono, res_type=self.res_type)
+
+
+# ffmpegにf32leのPCMを直接出力させ，事前確保したバッファをnp.frombufferでコピーせずに包む
+class FFmpegDecoder(AudioDecoder):
+    def __init__(self, ffmpeg="ffmpeg", ffprobe="ffprobe", resampler=None):
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.resampler = resampler
+
+    def load(self, path, sr=22050, mono=True):
+        info = self.probe(path)
+        sr = sr or info['sr']
+        channels = 1 if mono else info['channels']
+
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin", "-i", str(path), "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+               "-ac", str(channels), "-ar", str(sr)]
+        if self.resampler is not None:
+            cmd += ["-af", f"aresample=resampler={self.resampler}"]
+        cmd += ["pipe:1"]
+
+        # 余裕を持たせて確保し，足りない時だけ拡張する
+        expected = int(np.ceil(info['duration'] * sr * channels * 4 * 1.01)) + 4 * 4096
+        buffer = bytearray(expected)
+        size = 0
+
+        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=0)
+        view = memoryview(buffer)
+        while True:
+            if size == len(buffer):
+                view.release()
+                buffer.extend(bytearray(len(buffer) // 2 + 4096))
+                view = memoryview(buffer)
+            n = p.stdout.readinto(view[size:])
+            if not n:
+                break
+            size += n
+        view.release()
+        stderr = p.stderr.read()
+        p.wait()
+        if p.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed on {path}: {stderr.decode(errors='replace').strip()}")
+
+        size -= size % (4 * channels)
+        y = np.frombuffer(buffer, dtype="<f4", count=size // 4)
+        if channels > 1:
+            y = y.reshape(-1, channels).T
+        return y, sr
+
+    def probe(self, path):
+        try:
+            return probe_audio(path)
+        except (ValueError, struct.error):
+            return self._ffprobe(path)
+
+    def _ffprobe(self, path):
+        cmd = [self.ffprobe, "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=sample_rate,channels:format=duration",
+               "-of", "json", str(path)]
+        out = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, check=True).stdout
+        data = json.loads(out)
+        stream = data['streams'][0]
+        return {'sr': int(stream['sample_rate']), 'channels': int(stream['channels']), 'duration': float(data['format']['duration'])}
+
+
+DECODERS = {
+        'librosa': LibrosaDecoder,
+        'ffmpeg': FFmpegDecoder,
+        }
+
+def get_decoder(backend='librosa', **kwargs):
+    return DECODERS[backend](**kwargs)
+
+def load_audio(path, sr=22050, mono=True, backend='librosa'):
+    with stage('decode:load_audio', path=str(path), backend=backend):
+        return get_decoder(backend).load(path, sr=sr, mono=mono)
+
+
+# 解析用のレートにリサンプルしたモノラルPCMを.npyで持ち，2回目以降はmemmapで読む
+# キーはパス・サイズ・更新時刻・レートなので，元ファイルが変われば作り直される
+class ResampleCache:
+    def __init__(self, directory, enabled=True, backend='librosa'):
+        self.directory = directory
+        self.enabled = enabled
+        self.backend = backend
+
+    def path(self, path, sr):
+        stat = os.stat(path)
+        key = f"{os.path.realpath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{self.backend}"
+        return os.path.join(self.directory, f"sr{sr}", hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '.npy')
+
+    def load(self, path, sr):
+        if not self.enabled:
+            return load_audio(path, sr=sr, mono=True, backend=self.backend)
+
+        cache_path = self.path(path, sr)
+        if os.path.exists(cache_path):
+            with stage('decode:resample_cache', path=str(path), sr=sr):
+                return np.load(cache_path, mmap_mode='r'), sr
+
+        y, sr = load_audio(path, sr=sr, mono=True, backend=self.backend)
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.save(file, y)
+        os.replace(tmp_path, cache_path)
+        return y, sr
+
+
+# 環境変数 RESAMPLE_CACHE=0 でキャッシュせずに毎回デコードする
+RESAMPLE_CACHE = ResampleCache(os.path.join(const.PROD_CACHE_DIRECTORY, 'resampled'),
+                               enabled=os.environ.get('RESAMPLE_CACHE', '1') not in ('', '0'))
+
+def load_analysis_audio(path, sr=const.ANALYSIS_SR):
+    # 解析は const.ANALYSIS_SR / const.SPECTRAL_SR のどちらかに揃え，リサンプルは1ファイル1レートにつき1回だけ行う
+    return RESAMPLE_CACHE.load(path, sr)
+
+
+MP3_BITRATES = {
+        (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+        (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        }
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+# デコードせずにMP3のフレームヘッダ/Xingタグ，WAVのヘッダから長さ・サンプルレート等を読む
+def probe_audio(path):
+    with open(path, 'rb') as file:
+        head = file.read(12)
+        file.seek(0)
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _probe_wav(file)
+        return _probe_mp3(file, os.path.getsize(path))
+
+def probe_corpus(paths, max_workers=16):
+    def probe(path):
+        try:
+            return probe_audio(path)
+        except (ValueError, OSError, struct.error):
+            return None
+
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(probe, paths)))
+
+def _probe_wav(file):
+    file.seek(12)
+    fmt = None
+    while True:
+        chunk = file.read(8)
+        if len(chunk) < 8:
+            raise ValueError("WAV file has no data chunk")
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', file.read(16))
+            file.seek(chunk_size - 16 + chunk_size % 2, 1)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("WAV data chunk before fmt chunk")
+            _, channels, sr, byte_rate, block_align, _ = fmt
+            frames = chunk_size // block_align
+            return {'format': 'wav', 'sr': sr, 'channels': channels, 'duration': frames / sr, 'bitrate': byte_rate * 8}
+        else:
+            file.seek(chunk_size + chunk_size % 2, 1)
+
+def _probe_mp3(file, file_size):
+    audio_start = 0
+    header = file.read(10)
+    while header[:3] == b'ID3':
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        audio_start += 10 + size + (10 if header[5] & 0x10 else 0)
+        file.seek(audio_start)
+        header = file.read(10)
+
+    file.seek(audio_start)
+    data = file.read(64 * 1024)
+    audio_end = file_size
+    file.seek(max(file_size - 128, 0))
+    if file.read(3) == b'TAG':
+        audio_end -= 128
+
+    offset = 0
+    while True:
+        offset = data.find(b'\xff', offset)
+        if offset < 0 or offset + 4 > len(data):
+            raise ValueError("no MPEG audio frame found")
+        frame = _parse_mp3_header(data[offset:offset + 4])
+        if frame is not None:
+            break
+        offset += 1
+
+    version, layer, bitrate, sr, channels, samples_per_frame = frame
+    duration = None
+    vbr_bytes = None
+
+    # Xing/Info タグ(VBR/CBRのフレーム数)
+    if version == 1:
+        side_info = 32 if channels == 2 else 17
+    else:
+        side_info = 17 if channels == 2 else 9
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        position = xing + 8
+        frames = None
+        if flags & 0x1:
+            frames = struct.unpack('>I', data[position:position + 4])[0]
+            position += 4
+        if flags & 0x2:
+            vbr_bytes = struct.unpack('>I', data[position:position + 4])[0]
+            position += 4
+        if frames is not None:
+            samples = frames * samples_per_frame
+            lame = xing + 120
+            if data[lame:lame + 4] == b'LAME' or data[lame:lame + 4] == b'Lavc':
+                delay_padding = data[lame + 21:lame + 24]
+                if len(delay_padding) == 3:
+                    delay = (delay_padding[0] << 4) | (delay_padding[1] >> 4)
+                    padding = ((delay_padding[1] & 0x0f) << 8) | delay_padding[2]
+                    samples = max(samples - delay - padding, 0)
+            duration = samples / sr
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        vbri = offset + 36
+        vbr_bytes, frames = struct.unpack('>II', data[vbri + 10:vbri + 18])
+        duration = frames * samples_per_frame / sr
+
+    if duration is None:
+        duration = (audio_end - audio_start - offset) * 8 / (bitrate * 1000)
+    if vbr_bytes and duration:
+        bitrate = vbr_bytes * 8 / duration / 1000
+
+    return {'format': 'mp3', 'sr': sr, 'channels': channels, 'duration': duration, 'bitrate': int(round(bitrate * 1000))}
+
+def _parse_mp3_header(header):
+    b1, b2, b3 = header[1], header[2], header[3]
+    if (b1 & 0xe0) != 0xe0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((b1 >> 3) & 0x03)
+    layer = {1: 3, 2: 2, 3: 1}.get((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sr_index = (b2 >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sr_index == 3:
+        return None
+
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index]
+    sr = MP3_SAMPLE_RATES[version][sr_index]
+    channels = 1 if (b3 >> 6) == 3 else 2
+    if layer == 1:
+        samples_per_frame = 384
+    elif layer == 2 or version == 1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+    return version, layer, bitrate, sr, channels, samples_per_frame
@@ -0,0 +1,331 @@
+from external_libraries import *
+from modules import *
+import data_const as const
+from audio_io import get_decoder
+from manifest import CorpusManifest
+from drum_store import EVENT_DTYPE, DrumEventStore
+from matching import match_corpus
+from stats import run_tests
+from synthetic import generate_corpus, feature_curve, make_song, song_index
+from experiment1 import calculate_section_averages
+from experiment4 import process_midi_file_combined
+from experiment5 import collect_change_points
+from precision import PRECISION_POLICY, SECTION_LABELS, SectionAccumulator, section_means, set_storage_dtype, to_storage
+import contextlib
+import tracemalloc
+import re
+import time
+
+# 読み込み時間の上限(numpyの読み込み時間の何倍か)．numpyはexternal_librariesが必ず読み込み，それだけで
+# 固定の400msの半分以上を使い負荷で大きく揺れるので，直前に測ったnumpyと比べる
+IMPORT_TIME_BUDGET_RATIO = 3.0
+IMPORT_TIME_MODULES = ['format_allin1', 'modules', 'drum_store', 'novelty', 'section_classifier', 'streaming', 'figure_queue', 'stats', 'resampling', 'results_db', 'pipeline', 'instrumentation', 'result_log', 'synthetic', 'precision', 'packed_audio', 'sample_rate', 'subset', 'experiment1', 'experiment1ex', 'experiment2', 'experiment2ex', 'experiment2ex2',
+                       'experiment3', 'experiment4', 'experiment4ex', 'experiment4ex2', 'experiment5']
+# 起動時に読み込まれてはいけない重いライブラリ
+HEAVY_LIBRARIES = ['librosa', 'matplotlib', 'pandas', 'scipy', 'IPython', 'pydub', 'mido', 'scikit_posthocs', 'vistats']
+
+def time_call(fn, *args, repeat=3, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def find_stem_files(demucs_directory, components, max_songs):
+    stem_files = []
+    for song_name in sorted(os.listdir(demucs_directory))[:max_songs]:
+        for component in components:
+            file_path = os.path.join(demucs_directory, song_name, f"{component}.mp3")
+            if os.path.exists(file_path):
+                stem_files.append(file_path)
+    return stem_files
+
+def benchmark_decode(demucs_directory, components, sr=22050, max_songs=5, repeat=3):
+    decoders = {'librosa': get_decoder('librosa'), 'ffmpeg': get_decoder('ffmpeg')}
+    results = {name: [] for name in decoders}
+
+    for file_path in tqdm(find_stem_files(demucs_directory, components, max_songs), desc="Decoding"):
+        reference = None
+        for name, decoder in decoders.items():
+            elapsed, (y, _) = time_call(decoder.load, file_path, sr=sr, repeat=repeat)
+            if reference is None:
+                reference = y
+            n = min(len(reference), len(y))
+            max_diff = float(np.max(np.abs(reference[:n] - y[:n]))) if n else 0.0
+            results[name].append({'time': elapsed, 'seconds': len(y) / sr, 'max_diff': max_diff})
+
+    for name, rows in results.items():
+        if not rows:
+            continue
+        total_time = sum(row['time'] for row in rows)
+        total_audio = sum(row['seconds'] for row in rows)
+        print(f"{colored(name, 'blue')}: {len(rows)} files, {total_time:.2f} s, "
+              f"{total_audio / total_time:.1f}x realtime, max diff vs librosa {max(row['max_diff'] for row in rows):.2e}")
+    return results
+
+def parse_importtime(stderr):
+    cumulative = {}
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)", line)
+        if match and match.group(4) not in cumulative:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative
+
+def measure_import_time(module, repeat=3):
+    best, imported = None, set()
+    for _ in range(repeat):
+        result = sp.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                        stdout=sp.DEVNULL, stderr=sp.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+        cumulative = parse_importtime(result.stderr)
+        imported = {name.split('.')[0] for name in cumulative}
+        elapsed = cumulative[module] / 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, imported
+
+def benchmark_import_time(modules=IMPORT_TIME_MODULES, budget_ratio=IMPORT_TIME_BUDGET_RATIO):
+    failures = []
+    for module in modules:
+        baseline, _ = measure_import_time('numpy')
+        elapsed, imported = measure_import_time(module)
+        eager = sorted(imported & set(HEAVY_LIBRARIES))
+        ok = elapsed <= budget_ratio * baseline and not eager
+        status = colored('ok', 'green') if ok else colored('REGRESSED', 'red')
+        print(f"{module:>16}: {elapsed:8.1f} ms ({elapsed / baseline:.2f}x numpy) {status}" + (f" (eager: {', '.join(eager)})" if eager else ""))
+        if not ok:
+            failures.append(module)
+
+    if failures:
+        raise SystemExit(f"Import time regressed (budget {budget_ratio:.1f}x numpy): {', '.join(failures)}")
+
+SYNTHETIC_SIZES = (10, 100, 1000)
+# 前回より遅くなったとみなす比率
+REGRESSION_RATIO = 1.2
+
+def benchmark_synthetic(root, sizes=SYNTHETIC_SIZES, seed=0, repeat=3, results_path=None):
+    # 合成コーパスは曲番号ごとに決まるので，最大サイズを1度作れば小さいサイズはその先頭を使える
+    _, directories = generate_corpus(root, max(sizes), seed=seed, audio=False)
+    manifest = CorpusManifest.load_or_build(**directories)
+    corpus = Corpus(manifest)
+    all_songs = list(corpus.songs(require=('midi',)))
+
+    results = []
+    for n_songs in sizes:
+        songs = all_songs[:n_songs]
+        segments = {song.name: song.segments for song in songs}
+        features = [feature_curve(make_song(song_index(song.name), seed)) for song in songs]
+        for song in songs:
+            song.drum_events
+
+        def section_averages():
+            return [calculate_section_averages(song.segments, values, 22050, times) for song, (values, times) in zip(songs, features)]
+
+        def drum_store_build():
+            return DrumEventStore.build({song.name: song.entry['midi'] for song in songs})
+
+        store = drum_store_build()
+
+        def drum_section_counts():
+            return store.section_counts(segments)
+
+        def matching():
+            return match_corpus([collect_change_points(song) for song in songs], tolerances=[0.5, 1, 2])
+
+        averages = section_averages()
+        studies = {f"study{i}": {label: [values[label] * (1 + 0.1 * i) for values in averages if label in values]
+                                 for label in ('intro', 'drop', 'break', 'outro')} for i in range(4)}
+
+        def stats():
+            with contextlib.redirect_stdout(io.StringIO()):
+                return run_tests(studies)
+
+        # scipyの読み込みを計測に含めない
+        stats()
+
+        for name, fn in [('section_averages', section_averages), ('drum_store_build', drum_store_build),
+                         ('drum_section_counts', drum_section_counts), ('matching', matching), ('stats', stats)]:
+            elapsed, _ = time_call(fn, repeat=repeat)
+            results.append({'benchmark': name, 'songs': n_songs, 'time': elapsed, 'songs_per_second': n_songs / elapsed})
+
+    previous = {}
+    if results_path is not None and os.path.exists(results_path):
+        with open(results_path, 'r') as file:
+            previous = {(row['benchmark'], row['songs']): row for row in json.load(file)}
+
+    print(f"{'benchmark':>20} {'songs':>6} {'time s':>9} {'songs/s':>10} {'vs last':>8}")
+    for row in results:
+        last = previous.get((row['benchmark'], row['songs']))
+        ratio = row['time'] / last['time'] if last else None
+        flag = colored(' slower', 'red') if ratio is not None and ratio > REGRESSION_RATIO else ''
+        print(f"{row['benchmark']:>20} {row['songs']:6d} {row['time']:9.4f} {row['songs_per_second']:10.1f} "
+              f"{f'{ratio:.2f}x' if ratio is not None else '-':>8}{flag}")
+
+    if results_path is not None:
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        with open(results_path, 'w') as file:
+            json.dump(results, file, indent=4)
+    return results
+
+def _legacy_section_counts(times_by_drum, segments):
+    # experiment4.process_midi_file_combinedの内側のループと同じ数え方
+    counts = {label: {} for label in SECTION_LABELS}
+    for drum_name, times in times_by_drum.items():
+        for time in times:
+            for section in segments:
+                if section['start'] <= time < section['end']:
+                    counts[section['label']][drum_name] = counts[section['label']].get(drum_name, 0) + 1
+                    break
+    return counts
+
+def _nonempty(section_counts):
+    return {label: counts for label, counts in section_counts.items() if counts}
+
+def check_section_counts(root, n_songs=40, seed=0):
+    # DrumEventStore.section_countsが曲ごとのループと1打も違わないことを確かめる
+    _, directories = generate_corpus(root, n_songs, seed=seed, audio=False)
+    songs = list(Corpus(CorpusManifest.load_or_build(**directories)).songs(require=('midi',)))
+    store = DrumEventStore.build({song.name: song.entry['midi'] for song in songs})
+    legacy, existing = {}, set()
+    for song in songs:
+        process_midi_file_combined(song.entry['midi'], song.section_data, store.drum_mapping, legacy, existing)
+    counts, _ = store.section_count_dicts({song.name: song.segments for song in songs})
+    failures = [] if _nonempty(counts) == _nonempty(legacy) else ['synthetic corpus']
+
+    # 境界のすぐ手前(1e-9秒前と1ulp前)の打点．曲IDが大きいほどずらした時間軸では丸めで境界を越えやすい
+    boundary = 31.3
+    onsets = np.array([boundary - 1e-9, np.nextafter(boundary, 0), boundary, boundary + 1e-9])
+    segments = [{'label': 'intro', 'start': 0.0, 'end': boundary}, {'label': 'drop', 'start': boundary, 'end': 2 * boundary}]
+    song_names = [f"song{i:03d}" for i in range(n_songs)]
+    events = np.zeros(len(onsets), dtype=EVENT_DTYPE)
+    events['song_id'], events['note'], events['onset'] = n_songs - 1, 36, onsets
+    notes = np.array(sorted(Drum().drum_mapping), dtype=np.uint8)
+    song_offsets = np.r_[np.zeros(n_songs, dtype=np.int64), len(onsets)]
+    instrument_offsets = np.zeros((n_songs, len(notes) + 1), dtype=np.int64)
+    instrument_offsets[-1, np.searchsorted(notes, 36) + 1:] = len(onsets)
+    boundary_store = DrumEventStore(song_names, events, song_offsets, instrument_offsets, notes)
+    expected = _legacy_section_counts({boundary_store.drum_mapping[36]: onsets}, segments)
+    counts, _ = boundary_store.section_count_dicts({song_names[-1]: segments})
+    if _nonempty(counts) != _nonempty(expected):
+        failures.append('onsets next to a section boundary')
+
+    print(f"{colored('Section counts', 'blue')}: {'matches the per-song loop' if not failures else colored('differs: ' + ', '.join(failures), 'red')}")
+    return not failures
+
+def _legacy_matching_rates(pattern_changes, section_changes, song_duration, tolerance):
+    # 以前のexperiment5の入れ子のany()そのまま(セクション基準, ドラム基準)
+    section_matched = [section_change / song_duration * 100 for section_change in section_changes
+                       if any(section_change - tolerance <= pattern_change <= section_change + tolerance for pattern_change in pattern_changes)]
+    pattern_matched = [pattern_change / song_duration * 100 for pattern_change in pattern_changes
+                       if any(pattern_change - tolerance <= section_change <= pattern_change + tolerance for section_change in section_changes)]
+    section_rate = len(section_matched) / len(section_changes) * 100 if section_changes else 0
+    return (section_rate, section_matched), (len(pattern_matched) / len(pattern_changes) * 100, pattern_matched)
+
+def check_matching(n_songs=200, tolerances=(0.1, 0.5, 1, 2), seed=0):
+    # match_corpusが以前のループと同じ判定をするか，許容誤差の端(±1ulp)に置いた浮動小数の時刻で確かめる
+    rng = np.random.default_rng(seed)
+    songs = []
+    for _ in range(n_songs):
+        duration = float(rng.uniform(60, 400))
+        sections = sorted(rng.uniform(0, duration, rng.integers(1, 12)).tolist())
+        edges = [section + sign * tolerance for section in sections for tolerance in tolerances for sign in (-1, 1)]
+        patterns = [float(np.nextafter(edge, edge + direction)) for edge in rng.choice(edges, rng.integers(1, 20)) for direction in (-1, 0, 1)]
+        songs.append((patterns + rng.uniform(0, duration, 5).tolist(), sections, duration))
+
+    result = match_corpus(songs, tolerances)
+    mismatches = 0
+    for i, (patterns, sections, duration) in enumerate(songs):
+        for j, tolerance in enumerate(tolerances):
+            (section_rate, section_matched), (drum_rate, drum_matched) = _legacy_matching_rates(patterns, sections, duration, tolerance)
+            if (section_rate != result['section_based_rate'][i, j] or drum_rate != result['drum_based_rate'][i, j]
+                    or section_matched != result['section_matched_percent'][i][j].tolist()
+                    or drum_matched != result['drum_matched_percent'][i][j].tolist()):
+                mismatches += 1
+    print(f"{colored('Matching', 'blue')}: {'matches the nested loops' if not mismatches else colored(f'{mismatches} song/tolerance pairs differ', 'red')}")
+    return not mismatches
+
+def _hold_features(curves, n_songs, components, compact):
+    # 曲×ステムのフレーム特徴量と，セクション平均の集計をメモリに持つ
+    features = {}
+    averages = {component: SectionAccumulator() if compact else {label: [] for label in SECTION_LABELS} for component in components}
+    for i in range(n_songs):
+        values, times, sections = curves[i % len(curves)]
+        for j, component in enumerate(components):
+            stem_values = values * (1 + 0.1 * j)
+            if compact:
+                features[(i, component)] = to_storage(stem_values)
+            else:
+                # これまでの持ち方: float64の値とフレームごとの時刻配列
+                features[(i, component)] = (stem_values.astype(np.float64), times.astype(np.float64))
+            for label, value in section_means(sections, stem_values, times).items():
+                if compact:
+                    averages[component][label].append(value)
+                else:
+                    averages[component][label].append(np.float64(value))
+    return features, averages
+
+def _traced(fn, *args):
+    tracemalloc.start()
+    result = fn(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+def benchmark_memory(n_songs=1000, components=('bass', 'drums', 'other', 'vocals'), n_curves=20, seed=0):
+    # 合成曲の特徴量曲線を使い回し，曲数×ステム数だけ保持したときのメモリを比べる
+    curves = []
+    for index in range(n_curves):
+        song = make_song(index, seed)
+        values, times = feature_curve(song)
+        curves.append((values.reshape(-1), times, [{'label': s['label'], 'start': s['start'], 'end': s['end']} for s in song['sections']]))
+
+    storage = PRECISION_POLICY['storage']
+    rows = {}
+    try:
+        rows['float64 + times (legacy)'] = _traced(_hold_features, curves, n_songs, components, False)
+        for dtype in (np.float32, np.float16):
+            set_storage_dtype(dtype)
+            rows[f"{np.dtype(dtype).name} (compact)"] = _traced(_hold_features, curves, n_songs, components, True)
+    finally:
+        set_storage_dtype(storage)
+
+    # 小さい型で保存したときのセクション平均の誤差
+    errors = {}
+    for dtype in (np.float32, np.float16):
+        worst = 0.0
+        for values, times, sections in curves:
+            reference = section_means(sections, values.astype(np.float64), times)
+            compact = section_means(sections, values.astype(dtype), times)
+            worst = max([worst] + [abs(compact[label] - reference[label]) / abs(reference[label]) for label in reference])
+        errors[f"{np.dtype(dtype).name} (compact)"] = worst
+
+    legacy = rows['float64 + times (legacy)'][0]
+    print(f"{colored('Memory', 'blue')}: {n_songs} songs x {len(components)} stems")
+    print(f"{'storage':>26} {'held MB':>9} {'peak MB':>9} {'vs legacy':>10} {'max rel err':>12}")
+    for name, (current, peak) in rows.items():
+        error = errors.get(name)
+        print(f"{name:>26} {current / 2**20:9.1f} {peak / 2**20:9.1f} {current / legacy:9.2f}x {f'{error:.2e}' if error is not None else '-':>12}")
+    return rows, errors
+
+def main(process_mode):
+    demucs_directory = const.PROD_DEMUCS_DIRECTORY
+    components = ['bass', 'drums', 'other', 'vocals']
+
+    if process_mode == 'decode':
+        benchmark_decode(demucs_directory, components)
+    elif process_mode == 'import_time':
+        benchmark_import_time()
+    elif process_mode == 'synthetic':
+        benchmark_synthetic(os.path.join(const.DEMO_CACHE_DIRECTORY, 'synthetic'),
+                            results_path=os.path.join(const.DEMO_CACHE_DIRECTORY, 'benchmarks', 'synthetic.json'))
+    elif process_mode == 'memory':
+        benchmark_memory()
+    elif process_mode == 'check':
+        check_section_counts(os.path.join(const.DEMO_CACHE_DIRECTORY, 'synthetic'))
+        check_matching()
+
+if __name__ == "__main__":
+    process_mode = 'decode'  # 'decode' | 'import_time' | 'synthetic' | 'memory' | 'check'
+    main(process_mode)
@@ -7,3 +7,12 @@ DEMO_JSON_DIRECTORY = "../data/demo/allin1_demo"
 PROD_MIDI_DIRECTORY = "../data/prod/midi"
 DEMO_MIDI_DIRECTORY = "../data/demo/midi_demo"
 PROD_JSON_DIRECTORY_TEMPO = "../data/prod/allin1_tempo"
+PROD_CACHE_DIRECTORY = "../data/prod/cache"
+DEMO_CACHE_DIRECTORY = "../data/demo/cache"
+PROD_FIGURE_DIRECTORY = "../data/prod/figures"
+DEMO_FIGURE_DIRECTORY = "../data/demo/figures"
+PROD_WAV_DIRECTORY = "../data/prod/songs/wav"
+PROD_ALLIN1_DIRECTORY = "../data/prod/allin1"
+# 解析用のサンプルレート(包絡・RMSなどはモノラル22050Hz，スペクトル系は44100Hz)
+ANALYSIS_SR = 22050
+SPECTRAL_SR = 44100
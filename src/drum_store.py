@@ -0,0 +1,146 @@
+from external_libraries import *
+from modules import Drum
+from concurrent.futures import ProcessPoolExecutor
+
+EVENT_DTYPE = np.dtype([('song_id', '<i4'), ('note', 'u1'), ('onset', '<f8'), ('velocity', 'u1')])
+SECTION_LABELS = ['intro', 'drop', 'break', 'outro']
+
+def store_directory(cache_directory, manifest):
+    # 目録(JSONディレクトリ)ごとに別の場所に置き，違う目録の実験を交互に走らせても作り直さない
+    return os.path.join(cache_directory, 'drum_events', os.path.basename(os.path.normpath(manifest.json_directory)))
+
+# コーパス全体のドラムイベントを1つの構造化配列に入れ，曲・楽器ごとのCSRオフセットで引く
+class DrumEventStore:
+    def __init__(self, song_names, events, song_offsets, instrument_offsets, notes, signatures=None):
+        self.song_names = list(song_names)
+        self.song_ids = {song_name: i for i, song_name in enumerate(self.song_names)}
+        self.events = events
+        self.song_offsets = song_offsets
+        self.instrument_offsets = instrument_offsets
+        self.notes = notes
+        self.signatures = signatures or {}
+        self.note_index = np.full(256, -1, dtype=np.int64)
+        self.note_index[notes] = np.arange(len(notes))
+        self.drum_mapping = Drum().drum_mapping
+
+    @classmethod
+    def build(cls, midi_paths, signatures=None, max_workers=None):
+        song_names = sorted(midi_paths)
+        notes = np.array(sorted(Drum().drum_mapping), dtype=np.uint8)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parsed = list(tqdm(executor.map(_read_midi_events, [midi_paths[name] for name in song_names], chunksize=8),
+                               total=len(song_names), desc="Reading MIDI"))
+
+        counts = [len(song_notes) for song_notes, _, _ in parsed]
+        events = np.zeros(sum(counts), dtype=EVENT_DTYPE)
+        if events.size:
+            events['song_id'] = np.repeat(np.arange(len(song_names), dtype=np.int32), counts)
+            events['note'] = np.concatenate([song_notes for song_notes, _, _ in parsed])
+            events['onset'] = np.concatenate([onsets for _, onsets, _ in parsed])
+            events['velocity'] = np.concatenate([velocities for _, _, velocities in parsed])
+        events = events[np.lexsort((events['onset'], events['note'], events['song_id']))]
+
+        song_offsets = np.searchsorted(events['song_id'], np.arange(len(song_names) + 1)).astype(np.int64)
+        # 曲×楽器の開始位置(絶対インデックス)
+        note_index = np.full(256, -1, dtype=np.int64)
+        note_index[notes] = np.arange(len(notes))
+        keys = events['song_id'].astype(np.int64) * (len(notes) + 1) + note_index[events['note']]
+        grid = np.arange(len(song_names))[:, None] * (len(notes) + 1) + np.arange(len(notes) + 1)[None, :]
+        instrument_offsets = np.searchsorted(keys, grid).astype(np.int64)
+
+        return cls(song_names, events, song_offsets, instrument_offsets, notes, signatures)
+
+    @classmethod
+    def from_manifest(cls, manifest, directory, max_workers=None):
+        entries = {entry['song_name']: entry for entry in manifest.songs(require=('midi',))}
+        # MIDIのパスと更新時刻だけを見る(JSONやミックスが変わっても作り直さない)
+        signatures = {song_name: [entry['midi'], entry['signature'][2]] for song_name, entry in entries.items()}
+        if os.path.exists(os.path.join(directory, 'songs.json')):
+            store = cls.load(directory)
+            if store.signatures == signatures:
+                return store
+
+        store = cls.build({song_name: entry['midi'] for song_name, entry in entries.items()}, signatures, max_workers)
+        store.save(directory)
+        return cls.load(directory)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'events.npy'), self.events)
+        np.save(os.path.join(directory, 'song_offsets.npy'), self.song_offsets)
+        np.save(os.path.join(directory, 'instrument_offsets.npy'), self.instrument_offsets)
+        np.save(os.path.join(directory, 'notes.npy'), self.notes)
+        with open(os.path.join(directory, 'songs.json'), 'w') as file:
+            json.dump({'song_names': self.song_names, 'signatures': self.signatures}, file, indent=4, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'songs.json'), 'r') as file:
+            songs = json.load(file)
+        arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ['events', 'song_offsets', 'instrument_offsets', 'notes']]
+        return cls(songs['song_names'], *arrays, signatures=songs.get('signatures'))
+
+    def __len__(self):
+        return len(self.song_names)
+
+    def song_events(self, song_name, note=None):
+        song_id = self.song_ids[song_name]
+        if note is None:
+            return self.events[self.song_offsets[song_id]:self.song_offsets[song_id + 1]]
+        i = self.note_index[note]
+        return self.events[self.instrument_offsets[song_id, i]:self.instrument_offsets[song_id, i + 1]]
+
+    def instrument_counts(self):
+        return np.diff(self.instrument_offsets, axis=1)
+
+    def section_counts(self, segments_by_song, labels=SECTION_LABELS):
+        label_index = {label: i for i, label in enumerate(labels)}
+        counts = np.zeros((len(self.song_names), len(labels), len(self.notes)), dtype=np.int64)
+        if not len(self.events):
+            return counts
+
+        onsets = np.asarray(self.events['onset'])
+        instruments = self.note_index[np.asarray(self.events['note'])]
+        for song_name, segments in segments_by_song.items():
+            if song_name not in self.song_ids:
+                continue
+            song_id = self.song_ids[song_name]
+            begin, end = self.song_offsets[song_id], self.song_offsets[song_id + 1]
+            rows = sorted((segment['start'], segment['end'], label_index[segment['label']]) for segment in segments if segment['label'] in label_index)
+            if begin == end or not rows:
+                continue
+            starts, ends, label_ids = (np.array(column) for column in zip(*rows))
+
+            # 曲ごとに元の時刻のまま二分探索する(曲IDでずらした1本の時間軸にすると，足し算の丸めで境界の直前の打点が次のセクションに入る)
+            song_onsets = onsets[begin:end]
+            segment = np.searchsorted(starts, song_onsets, side='right') - 1
+            valid = segment >= 0
+            segment = np.clip(segment, 0, None)
+            valid &= song_onsets < ends[segment]
+
+            flat = label_ids[segment[valid]] * len(self.notes) + instruments[begin:end][valid]
+            counts[song_id] += np.bincount(flat, minlength=len(labels) * len(self.notes)).reshape(len(labels), len(self.notes))
+        return counts
+
+    def section_count_dicts(self, segments_by_song, labels=SECTION_LABELS):
+        totals = self.section_counts(segments_by_song, labels).sum(axis=0)
+        present = self.instrument_counts()[[self.song_ids[name] for name in segments_by_song if name in self.song_ids]].sum(axis=0) > 0
+        all_section_counts = {label: {self.drum_mapping[int(note)]: int(totals[i, j])
+                                      for j, note in enumerate(self.notes) if totals[i, j] > 0}
+                              for i, label in enumerate(labels)}
+        all_existing_drums = {self.drum_mapping[int(note)] for note in self.notes[present]}
+        return all_section_counts, all_existing_drums
+
+    def bar_counts(self, song_name, note, bar_length):
+        onsets = self.song_events(song_name, note)['onset']
+        if len(onsets) == 0:
+            return {}
+        counts = np.bincount((onsets // bar_length).astype(np.int64))
+        bars = np.flatnonzero(counts)
+        return dict(zip(bars.tolist(), counts[bars].tolist()))
+
+
+def _read_midi_events(midi_path):
+    return Drum().get_drum_event_array(midi_path)
@@ -1,29 +1,23 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
+from audio_io import load_analysis_audio
+from instrumentation import profile, song_context
+from precision import SectionAccumulator, section_means
+from stats import run_tests
+from resampling import perform_resampling_tests
+from result_log import record_test
 
 def perform_dunn_test(all_section_averages):
-    data = []
-    groups = []
-    for section, values in all_section_averages.items():
-        for value in values:
-            data.append(value)
-            groups.append(section)
-    df = pd.DataFrame({'Value': data, 'Group': groups})
-
-    stat, p = kruskal(*all_section_averages.values())
-    print(f"Kruskal-Wallis test: Statistics = {stat}, p-value = {p}")
-
-    if p < 0.05:
-        dunn_p_values = scikit_posthocs.posthoc_dunn(df, val_col='Value', group_col='Group', p_adjust='bonferroni')
-        print("Dunn's test results (p-values):")
-        print(dunn_p_values)
+    return run_tests({'sections': all_section_averages}, p_adjust='bonferroni')
 
 def perform_kruskal_wallis_test(all_section_averages):
     data = [values for values in all_section_averages.values() if values]
 
     stat, p = kruskal(*data)
     print(f"Kruskal-Wallis test: Statistics = {stat}, p-value = {p}")
+    record_test("Kruskal-Wallis test", stat, p)
 
 def apply_log_transformation(data):
     if np.any(data <= 0):
@@ -37,40 +31,27 @@ def reevaluate_normality(all_section_averages):
 
         stat, p = normaltest(transformed_data[section])
         print(f"Reevaluated normality test for {section}: Statistics = {stat}, p-value = {p}")
+        record_test(f"Reevaluated normality test for {section}", stat, p)
     return transformed_data
 
 def check_homoscedasticity(all_section_averages):
     data = [values for values in all_section_averages.values() if values]
     stat, p = levene(*data)
     print(f"Levene's test for homoscedasticity: Statistics = {stat}, p-value = {p}")
+    record_test("Levene's test for homoscedasticity", stat, p)
 
+@profile('feature')
 def get_spectral_centroid(audio_file: str, n_fft=2048*2) -> Tuple[np.ndarray, float, np.ndarray]:
-    y, sr = librosa.load(audio_file, sr=None)
+    y, sr = load_analysis_audio(audio_file, sr=const.SPECTRAL_SR)
     spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr, n_fft=n_fft)
     times = librosa.times_like(spectral_centroid, sr=sr)
     return spectral_centroid, sr, times
 
 def calculate_section_averages(sections, feature_values, sr, times):
-    section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
-    feature_values = feature_values.flatten()
-
-    for section in sections:
-        label = section['label']
-        start_index = np.argmax(times >= section['start'])
-        end_index = np.argmax(times >= section['end'])
-        if end_index == 0:
-            end_index = len(feature_values)
-        section_feature = feature_values[start_index:end_index]
-        if len(section_feature) > 0:
-            section_averages[label].append(section_feature.mean())
-
-    section_averages_mean = {}
-    for label, values in section_averages.items():
-        if values:
-            section_averages_mean[label] = np.mean(values)
-
-    return section_averages_mean
+    # セクション平均はリストに溜めずに累積和からまとめて求める
+    return section_means(sections, feature_values, times)
 
+@profile('plot')
 def plot_bar_graph(section_averages):
     total_averages = {}
     for section, avgs in section_averages.items():
@@ -89,6 +70,7 @@ def plot_bar_graph(section_averages):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_box_plot(section_averages):
     plt.boxplot(section_averages.values(), labels=section_averages.keys(), showmeans=True)
     plt.xlabel('Section')
@@ -102,6 +84,7 @@ def plot_box_plot(section_averages):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_violin_plot(section_averages):
     data_to_plot = [avgs for avgs in section_averages.values() if avgs]
     plt.violinplot(data_to_plot)
@@ -112,31 +95,27 @@ def plot_violin_plot(section_averages):
     plt.tight_layout()
     plt.show()
 
-def process_file(json_path, song_directory, all_section_averages, allin1):
-    section_data = allin1.load_section_data(json_path)
+def process_file(entry, all_section_averages, allin1):
+    section_data = allin1.load_section_data(entry['json'])
 
-    filename = os.path.splitext(os.path.basename(json_path))[0] + '.mp3'
-    file_path = os.path.join(song_directory, filename)
-    spectral_centroid, sr, times = get_spectral_centroid(file_path)
+    spectral_centroid, sr, times = get_spectral_centroid(entry['mix'])
     section_averages = calculate_section_averages(section_data['segments'], spectral_centroid, sr, times)
 
-    for section, average in section_averages.items():
-        all_section_averages[section].append(average)
+    all_section_averages.add(section_averages)
 
-def process_files(json_directory, song_directory, allin1, all_section_averages):
-    for root, dirs, files in tqdm(os.walk(json_directory), desc="Processing files"):
-        for file in tqdm(files, desc="Overall Progress", leave=False):
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, song_directory, all_section_averages, allin1)
+def process_files(manifest, allin1, all_section_averages):
+    for entry in tqdm(manifest.songs(require=('mix',)), total=len(manifest), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            process_file(entry, all_section_averages, allin1)
 
 def main(process_mode):
     song_directory = const.PROD_SONG_DIRECTORY
     json_directory = const.PROD_JSON_DIRECTORY
     allin1 = Allin1()
-    all_section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
+    all_section_averages = SectionAccumulator()
 
-    process_files(json_directory, song_directory, allin1, all_section_averages)
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, song_directory=song_directory)
+    process_files(manifest, allin1, all_section_averages)
 
     # 対数変換をした上でダゴスティーノのK^2検定(正規性の検討)
     transformed_data = reevaluate_normality(all_section_averages)
@@ -151,7 +130,10 @@ def main(process_mode):
         plot_box_plot(all_section_averages)
     elif process_mode == 'violin':
         plot_violin_plot(all_section_averages)
+    elif process_mode == 'resampling':
+        # 並べ替え検定と区間推定(ブートストラップ)で各セクション対の差を調べる
+        perform_resampling_tests(all_section_averages, n_resamples=10000)
 
 if __name__ == "__main__":
-    process_mode = 'box'  # 'bar' | 'box' | 'violin'
+    process_mode = 'box'  # 'bar' | 'box' | 'violin' | 'resampling'
     main(process_mode)
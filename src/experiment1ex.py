@@ -2,7 +2,11 @@ from experiment1 import *
 from external_libraries import *
 from modules import *
 import data_const as const
+from audio_io import load_analysis_audio
+from instrumentation import profile, song_context
+from precision import SectionAccumulator
 
+@profile('plot')
 def plot_bar_graph(section_averages):
     total_averages = {}
     for section, avgs in section_averages.items():
@@ -21,6 +25,7 @@ def plot_bar_graph(section_averages):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_box_plot(section_averages):
     plt.boxplot(section_averages.values(), labels=section_averages.keys(), showmeans=True)
     plt.xlabel('Section')
@@ -34,6 +39,7 @@ def plot_box_plot(section_averages):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_violin_plot(section_averages):
     data_to_plot = [avgs for avgs in section_averages.values() if avgs]
     plt.violinplot(data_to_plot)
@@ -45,37 +51,34 @@ def plot_violin_plot(section_averages):
     plt.show()
 
 
+@profile('feature')
 def get_rms(file_path):
-    y, sr = librosa.load(file_path)
+    y, sr = load_analysis_audio(file_path)
     rms = librosa.feature.rms(y=y)
-    times = librosa.times_like(rms)
+    times = librosa.times_like(rms, sr=sr)
     return rms, sr, times
 
-def process_file(json_path, song_directory, all_section_averages, allin1):
-    section_data = allin1.load_section_data(json_path)
+def process_file(entry, all_section_averages, allin1):
+    section_data = allin1.load_section_data(entry['json'])
 
-    filename = os.path.splitext(os.path.basename(json_path))[0] + '.mp3'
-    file_path = os.path.join(song_directory, filename)
-    rms_values, sr, times = get_rms(file_path)
+    rms_values, sr, times = get_rms(entry['mix'])
     section_averages = calculate_section_averages(section_data['segments'], rms_values, sr, times)
 
-    for section, average in section_averages.items():
-        all_section_averages[section].append(average)
+    all_section_averages.add(section_averages)
 
-def process_files(json_directory, song_directory, allin1, all_section_averages):
-    for root, dirs, files in tqdm(os.walk(json_directory), desc="Processing files"):
-        for file in tqdm(files, desc="Overall Progress", leave=False):
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, song_directory, all_section_averages, allin1)
+def process_files(manifest, allin1, all_section_averages):
+    for entry in tqdm(manifest.songs(require=('mix',)), total=len(manifest), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            process_file(entry, all_section_averages, allin1)
 
 def main(process_mode):
     song_directory = const.PROD_SONG_DIRECTORY
     json_directory = const.PROD_JSON_DIRECTORY
     allin1 = Allin1()
-    all_section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
+    all_section_averages = SectionAccumulator()
 
-    process_files(json_directory, song_directory, allin1, all_section_averages)
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, song_directory=song_directory)
+    process_files(manifest, allin1, all_section_averages)
 
     # 対数変換をした上でダゴスティーノのK^2検定(正規性の検討)
     transformed_data = reevaluate_normality(all_section_averages)
@@ -90,7 +93,10 @@ def main(process_mode):
         plot_box_plot(all_section_averages)
     elif process_mode == 'violin':
         plot_violin_plot(all_section_averages)
+    elif process_mode == 'resampling':
+        # 並べ替え検定と区間推定(ブートストラップ)で各セクション対の差を調べる
+        perform_resampling_tests(all_section_averages, n_resamples=10000)
 
 if __name__ == "__main__":
-    process_mode = 'box'  # 'bar' | 'box' | 'violin'
+    process_mode = 'box'  # 'bar' | 'box' | 'violin' | 'resampling'
     main(process_mode)
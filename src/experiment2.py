@@ -1,42 +1,27 @@
 from external_libraries import *
 from modules import *
 import data_const as const
-
-def perform_kruskal_wallis_test_by_component(component_averages, component):
-    data = [component_averages[component][section] for section in component_averages[component] if component_averages[component][section]]
-    if len(data) > 1:
-        stat, p = kruskal(*data)
-        print(f"Kruskal-Wallis test for {component}: Statistics = {stat}, p-value = {p}")
-        return p < 0.05
-    return False
-
-def perform_dunn_test_by_component(component_averages, component):
-    data = []
-    groups = []
-    for section in component_averages[component]:
-        for value in component_averages[component][section]:
-            if value is not None:
-                data.append(value)
-                groups.append(section)
-    if data and groups:
-        df = pd.DataFrame({'Value': data, 'Group': groups})
-        dunn_p_values = scikit_posthocs.posthoc_dunn(df, val_col='Value', group_col='Group', p_adjust='bonferroni')
-        print(f"Dunn's test results for {component} (p-values):")
-        print(dunn_p_values)
+from manifest import CorpusManifest
+from audio_io import load_analysis_audio
+from instrumentation import profile, song_context
+from precision import SectionAccumulator
+from figure_queue import FigureQueue
+from stats import run_tests
 
 def perform_anova_on_components(component_averages):
-    for component in component_averages:
-        if perform_kruskal_wallis_test_by_component(component_averages, component):
-            perform_dunn_test_by_component(component_averages, component)
+    # 全コンポーネントを一度に順位付けし，Kruskal-WallisとDunnをまとめて計算する
+    return run_tests(component_averages, p_adjust='bonferroni')
 
+@profile('feature')
 def get_spectral_centroid(audio_file: str) -> Tuple[np.ndarray, float, np.ndarray]:
-    y, sr = librosa.load(audio_file, sr=None)
+    y, sr = load_analysis_audio(audio_file, sr=const.SPECTRAL_SR)
     spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
     times = librosa.times_like(spectral_centroid, sr=sr)
     return spectral_centroid, sr, times
 
+@profile('feature')
 def calculate_filtered_section_averages(sections, feature_values, sr, times, audio_path, rms_threshold=0.01):
-    y, _ = librosa.load(audio_path, sr=None)
+    y, _ = load_analysis_audio(audio_path, sr=const.SPECTRAL_SR)
     section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
     feature_values = feature_values.flatten()
 
@@ -69,6 +54,7 @@ def filter_by_rms(y, sr, start_index, end_index, rms_threshold):
     valid_indices = section_rms >= rms_threshold
     return valid_indices
 
+@profile('plot')
 def plot_bar_graph(section_averages, title):
     total_averages = {section: np.mean([avg for avg in avgs if avg is not None])
                       for section, avgs in section_averages.items()}
@@ -83,6 +69,7 @@ def plot_bar_graph(section_averages, title):
     plt.legend()
     plt.show()
 
+@profile('plot')
 def plot_combined_bar_graph(component_averages, components):
     colors = ['blue', 'green', 'red', 'purple']
     bar_width = 0.45
@@ -113,6 +100,7 @@ def plot_combined_bar_graph(component_averages, components):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_box_plot(section_averages, title):
     data_to_plot = [avgs for avgs in section_averages.values()]
     plt.boxplot(data_to_plot, labels=section_averages.keys())
@@ -128,6 +116,7 @@ def plot_box_plot(section_averages, title):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_violin_plot(section_averages, title):
     data_to_plot = [avgs for avgs in section_averages.values() if avgs]
     plt.violinplot(data_to_plot)
@@ -138,6 +127,7 @@ def plot_violin_plot(section_averages, title):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_combined_box_plot(component_averages, components):
     colors = ['blue', 'green', 'red', 'purple']
     positions = np.arange(1, len(components) * 4, 4)
@@ -164,6 +154,7 @@ def plot_combined_box_plot(component_averages, components):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_combined_violin_plot(component_averages, components):
     colors = ['blue', 'yellow', 'green', 'red']
     positions = np.arange(1, len(components) * 4, 4)
@@ -186,20 +177,17 @@ def plot_combined_violin_plot(component_averages, components):
     plt.tight_layout()
     plt.show()
 
-def process_files(json_directory, song_directory, allin1, component_averages, components):
-    for root, dirs, files in tqdm(os.walk(json_directory), desc="Processing files"):
-        for file in tqdm(files, desc="Overall Progress", leave=False):
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, song_directory, component_averages, allin1, components)
+def process_files(manifest, allin1, component_averages, components):
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            process_file(entry, component_averages, allin1, components)
 
-def process_file(json_path, song_directory, component_averages, allin1, components):
-    section_data = allin1.load_section_data(json_path)
-    song_name = os.path.splitext(os.path.basename(json_path))[0]
+def process_file(entry, component_averages, allin1, components):
+    section_data = allin1.load_section_data(entry['json'])
 
     for component in components:
-        file_path = os.path.join(song_directory, song_name, f"{component}.mp3")
-        if os.path.exists(file_path):
+        file_path = entry['stems'].get(component)
+        if file_path is not None:
             spectral_centroid, sr, times = get_spectral_centroid(file_path)
             section_averages = calculate_filtered_section_averages(section_data['segments'], spectral_centroid, sr, times, file_path)
 
@@ -214,27 +202,31 @@ def main(process_mode):
     allin1 = Allin1()
 
     components = ['bass', 'drums', 'other', 'vocals']
-    component_averages = {component: {'intro': [], 'drop': [], 'break': [], 'outro': []} for component in components}
+    component_averages = {component: SectionAccumulator() for component in components}
 
-    process_files(json_directory, demucs_directory, allin1, component_averages, components)
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, demucs_directory=demucs_directory)
+    process_files(manifest, allin1, component_averages, components)
 
     perform_anova_on_components(component_averages)
 
+    # コンポーネントごとの図はプロセスプールで並列に描画して保存する
+    figure_queue = FigureQueue(os.path.join(const.PROD_FIGURE_DIRECTORY, 'experiment2'))
     if process_mode == 'bar':
         for component in components:
-            plot_bar_graph(component_averages[component], f"Bar Graph for {component.capitalize()}")
+            figure_queue.add(plot_bar_graph, component_averages[component], f"Bar Graph for {component.capitalize()}", name=f"bar_{component}")
     elif process_mode == 'combined_bar':
         plot_combined_bar_graph(component_averages, components)
     elif process_mode == 'box':
         for component in components:
-            plot_box_plot(component_averages[component], f"Box Plot for {component.capitalize()}")
+            figure_queue.add(plot_box_plot, component_averages[component], f"Box Plot for {component.capitalize()}", name=f"box_{component}")
     elif process_mode == 'combined_box':
         plot_combined_box_plot(component_averages, components)
     elif process_mode == 'violin':
         for component in components:
-            plot_violin_plot(component_averages[component], f"Violin Plot for {component.capitalize()}")
+            figure_queue.add(plot_violin_plot, component_averages[component], f"Violin Plot for {component.capitalize()}", name=f"violin_{component}")
     elif process_mode == 'combined_violin':
         plot_combined_violin_plot(component_averages, components)
+    figure_queue.render()
 
 
 if __name__ == "__main__":
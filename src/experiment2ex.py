@@ -1,7 +1,11 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
+from audio_io import load_analysis_audio
+from instrumentation import profile, song_context
 
+@profile('plot')
 def plot_stack_bar(total_play_times_by_component):
     sections = ['intro', 'drop', 'break', 'outro']
     components = total_play_times_by_component.keys()
@@ -25,6 +29,7 @@ def plot_stack_bar(total_play_times_by_component):
     plt.tight_layout()
     plt.show()
 
+@profile('feature')
 def calculate_filtered_play_time_by_section_and_component(sections, y, sr, rms_threshold):
     section_play_time = {'intro': 0, 'drop': 0, 'break': 0, 'outro': 0}
 
@@ -46,15 +51,14 @@ def filter_by_rms(y, sr, start_time, end_time, rms_threshold):
     valid_indices = rms[start_index:end_index] >= rms_threshold
     return valid_indices
 
-def process_file_for_play_time(json_path, song_directory, allin1, components, rms_threshold):
-    section_data = allin1.load_section_data(json_path)
-    song_name = os.path.splitext(os.path.basename(json_path))[0]
+def process_file_for_play_time(entry, allin1, components, rms_threshold):
+    section_data = allin1.load_section_data(entry['json'])
     component_play_times = {component: {'intro': 0, 'drop': 0, 'break': 0, 'outro': 0} for component in components}
 
     for component in components:
-        file_path = os.path.join(song_directory, song_name, f"{component}.mp3")
-        if os.path.exists(file_path):
-            y, sr = librosa.load(file_path, sr=None)
+        file_path = entry['stems'].get(component)
+        if file_path is not None:
+            y, sr = load_analysis_audio(file_path)
             section_play_time = calculate_filtered_play_time_by_section_and_component(section_data['segments'], y, sr, rms_threshold)
             for section, time in section_play_time.items():
                 component_play_times[component][section] += time
@@ -69,20 +73,13 @@ def main(process_mode):
     rms_threshold = 0.01
     total_play_times_by_component = {component: {'intro': 0, 'drop': 0, 'break': 0, 'outro': 0} for component in components}
 
-    total_files = sum([len(files) for r, d, files in os.walk(json_directory) if any(file.endswith(".json") for file in files)])
-    progress_bar = tqdm(total=total_files, desc="Overall Progress")
-
-    for root, dirs, files in os.walk(json_directory):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                play_times = process_file_for_play_time(json_path, demucs_directory, allin1, components, rms_threshold)
-                for component, times in play_times.items():
-                    for section, time in times.items():
-                        total_play_times_by_component[component][section] += time
-                progress_bar.update(1)
-
-    progress_bar.close()
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, demucs_directory=demucs_directory)
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            play_times = process_file_for_play_time(entry, allin1, components, rms_threshold)
+        for component, times in play_times.items():
+            for section, time in times.items():
+                total_play_times_by_component[component][section] += time
 
     if process_mode == 'stack_bar':
         plot_stack_bar(total_play_times_by_component)
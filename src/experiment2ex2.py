@@ -2,65 +2,35 @@ from external_libraries import *
 from modules import *
 import data_const as const
 from experiment2 import *
-
-def perform_kruskal_wallis_test_by_component(component_averages, component):
-    data = [component_averages[component][section] for section in component_averages[component] if component_averages[component][section]]
-    if len(data) > 1:
-        stat, p = kruskal(*data)
-        print(f"Kruskal-Wallis test for {component}: Statistics = {stat}, p-value = {p}")
-        return p < 0.05
-    return False
-
-def perform_dunn_test_by_component(component_averages, component):
-    data = []
-    groups = []
-    for section in component_averages[component]:
-        for value in component_averages[component][section]:
-            if value is not None:
-                data.append(value)
-                groups.append(section)
-    if data and groups:
-        df = pd.DataFrame({'Value': data, 'Group': groups})
-        dunn_p_values = scikit_posthocs.posthoc_dunn(df, val_col='Value', group_col='Group', p_adjust='bonferroni')
-        print(f"Dunn's test results for {component} (p-values):")
-        print(dunn_p_values)
+from manifest import CorpusManifest
+from figure_queue import FigureQueue
+from stats import run_tests
+from resampling import perform_resampling_tests_by_component
+from prefetch import PrefetchLoader, load_stems
+from results_db import ResultsStore
+from audio_io import load_analysis_audio
+from instrumentation import profile, song_context
+from precision import SECTION_LABELS, section_means, to_storage
 
 def perform_anova_on_components(component_averages):
-    for component in component_averages:
-        if perform_kruskal_wallis_test_by_component(component_averages, component):
-            perform_dunn_test_by_component(component_averages, component)
+    # 全コンポーネントを一度に順位付けし，Kruskal-WallisとDunnをまとめて計算する
+    return run_tests(component_averages, p_adjust='bonferroni')
 
 def get_rms(file_path):
-    y, sr = librosa.load(file_path)
-    rms = librosa.feature.rms(y=y)
+    y, sr = load_analysis_audio(file_path)
+    return get_rms_from_audio(y, sr)
+
+@profile('feature')
+def get_rms_from_audio(y, sr):
+    rms = to_storage(librosa.feature.rms(y=y))
     times = librosa.times_like(rms, sr=sr)
     return rms, sr, times
 
 def calculate_section_averages(sections, feature_values, sr, times):
-    section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
-    feature_values = feature_values.flatten()
-
-    for section in sections:
-        label = section['label']
-        if label in section_averages:
-            start_index = np.argmax(times >= section['start'])
-            end_index = np.argmax(times >= section['end'])
-            if end_index == 0:
-                end_index = len(feature_values)
-
-            section_centroid = feature_values[start_index:end_index]
-            if len(section_centroid) > 0:
-                section_average = section_centroid.mean()
-                section_averages[label].append(section_average)
-
-    for label in section_averages:
-        if section_averages[label]:
-            section_averages[label] = sum(section_averages[label]) / len(section_averages[label])
-        else:
-            section_averages[label] = None
-
-    return section_averages
+    means = section_means(sections, feature_values, times)
+    return {label: means.get(label) for label in SECTION_LABELS}
 
+@profile('plot')
 def plot_box_plot(section_averages, title):
     data_to_plot = [avgs for avgs in section_averages.values()]
     plt.boxplot(data_to_plot, labels=section_averages.keys())
@@ -76,26 +46,44 @@ def plot_box_plot(section_averages, title):
     plt.tight_layout()
     plt.show()
 
-def process_file(json_path, song_directory, component_averages, allin1, components):
-    section_data = allin1.load_section_data(json_path)
-    song_name = os.path.splitext(os.path.basename(json_path))[0]
+def process_file(entry, component_averages, allin1, components, stems=None, store=None, params=None):
+    section_data = allin1.load_section_data(entry['json'])
 
     for component in components:
-        file_path = os.path.join(song_directory, song_name, f"{component}.mp3")
-        if os.path.exists(file_path):
+        if stems is not None:
+            if component not in stems:
+                continue
+            rms, sr, times = get_rms_from_audio(*stems[component])
+        else:
+            file_path = entry['stems'].get(component)
+            if file_path is None:
+                continue
             rms, sr, times = get_rms(file_path)
-            section_averages = calculate_section_averages(section_data['segments'], rms, sr, times)
 
-            for section, average in section_averages.items():
-                if average is not None:
+        section_averages = calculate_section_averages(section_data['segments'], rms, sr, times)
+        for section, average in section_averages.items():
+            if average is not None:
+                if component_averages is not None:
                     component_averages[component][section].append(average)
-
-def process_files(json_directory, song_directory, allin1, component_averages, components):
-    for root, dirs, files in tqdm(os.walk(json_directory), desc="Processing files"):
-        for file in tqdm(files, desc="Overall Progress", leave=False):
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, song_directory, component_averages, allin1, components)
+                if store is not None:
+                    store.add(entry['song_name'], component, 'rms', section, average, params)
+
+    if store is not None:
+        store.mark_computed(entry['song_name'], 'rms', params, entry.get('hash'))
+
+def process_files(manifest, allin1, component_averages, components, prefetch=8, store=None, params=None):
+    # 結果DBに無い曲だけを計算する
+    entries = list(manifest.songs()) if store is None else store.missing(manifest.songs(), 'rms', params)
+    print(f"{colored('process_files', 'blue')}: {len(entries)} of {len(manifest)} songs need computing.")
+
+    # 現在の曲の特徴量計算中に次の曲のステムをスレッドプールでデコードしておく
+    loader = PrefetchLoader(lambda entry: load_stems(entry['stems'], components), prefetch=prefetch)
+    for entry, stems in tqdm(loader.iterate(entries), total=len(entries), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            process_file(entry, component_averages, allin1, components, stems, store, params)
+    loader.metrics.print_summary()
+    if store is not None:
+        store.flush()
 
 def main(process_mode):
     song_directory = const.PROD_SONG_DIRECTORY
@@ -104,28 +92,42 @@ def main(process_mode):
     allin1 = Allin1()
 
     components = ['bass', 'drums', 'other', 'vocals']
-    component_averages = {component: {'intro': [], 'drop': [], 'break': [], 'outro': []} for component in components}
-
-    process_files(json_directory, demucs_directory, allin1, component_averages, components)
-
-    perform_anova_on_components(component_averages)
 
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, demucs_directory=demucs_directory)
+    with ResultsStore(os.path.join(const.PROD_CACHE_DIRECTORY, 'results.sqlite')) as store:
+        params = store.register_params({'experiment': 'experiment2ex2', 'feature': 'rms', 'sr': const.ANALYSIS_SR, 'frame_length': 2048, 'hop_length': 512,
+                                        'json_directory': json_directory})
+        # 目録から消えた曲の値を消してから，足りない曲だけを計算してDBに書く
+        song_names = [entry['song_name'] for entry in manifest.songs()]
+        store.purge('rms', params, song_names)
+        process_files(manifest, allin1, None, components, store=store, params=params)
+        # 以前の実行で計算済みの曲も含めてDBから集計する
+        component_averages = store.component_values('rms', params, components, songs=song_names)
+
+        results = perform_anova_on_components(component_averages)
+        store.add_test_results('rms', params, results)
+
+    # コンポーネントごとの図はプロセスプールで並列に描画して保存する
+    figure_queue = FigureQueue(os.path.join(const.PROD_FIGURE_DIRECTORY, 'experiment2ex2'))
     if process_mode == 'bar':
         for component in components:
-            plot_bar_graph(component_averages[component], f"Bar Graph for {component.capitalize()}")
+            figure_queue.add(plot_bar_graph, component_averages[component], f"Bar Graph for {component.capitalize()}", name=f"bar_{component}")
     elif process_mode == 'combined_bar':
         plot_combined_bar_graph(component_averages, components)
     elif process_mode == 'box':
         for component in components:
-            plot_box_plot(component_averages[component], f"Box Plot for {component.capitalize()}")
+            figure_queue.add(plot_box_plot, component_averages[component], f"Box Plot for {component.capitalize()}", name=f"box_{component}")
     elif process_mode == 'combined_box':
         plot_combined_box_plot(component_averages, components)
     elif process_mode == 'violin':
         for component in components:
-            plot_violin_plot(component_averages[component], f"Violin Plot for {component.capitalize()}")
+            figure_queue.add(plot_violin_plot, component_averages[component], f"Violin Plot for {component.capitalize()}", name=f"violin_{component}")
     elif process_mode == 'combined_violin':
         plot_combined_violin_plot(component_averages, components)
+    elif process_mode == 'resampling':
+        perform_resampling_tests_by_component(component_averages, pairs=[('drop', 'break'), ('drop', 'intro'), ('drop', 'outro')])
+    figure_queue.render()
 
 if __name__ == "__main__":
-    process_mode = 'box'  # 'bar' | 'combined_bar' | 'box' | 'combined_box' | 'violin' | 'combined_violin'
+    process_mode = 'box'  # 'bar' | 'combined_bar' | 'box' | 'combined_box' | 'violin' | 'combined_violin' | 'resampling'
     main(process_mode)
@@ -1,7 +1,12 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
+from audio_io import load_analysis_audio
+from packed_audio import PackedAudioStore, packed_directory
+from instrumentation import profile, song_context
 
+@profile('feature')
 def calculate_section_rms(y, sr, sections):
     rms_values = {}
     for section in sections:
@@ -13,21 +18,25 @@ def calculate_section_rms(y, sr, sections):
         rms_values[section['label']].append(rms)
     return rms_values
 
-def combine_audio_files(file1_path, file2_path):
-    sound1 = AudioSegment.from_file(file1_path)
-    sound2 = AudioSegment.from_file(file2_path)
-    combined = sound1.overlay(sound2)
-    return np.array(combined.get_array_of_samples(), dtype=np.float32) / (2**15)
-
-def calculate_rms_for_part(part, demucs_directory, song_name, section_data):
-    if part == 'other':
-        other_path = os.path.join(demucs_directory, song_name, 'other.mp3')
-        vocals_path = os.path.join(demucs_directory, song_name, 'vocals.mp3')
-        y = combine_audio_files(other_path, vocals_path)
-        sr = 44100
+def combine_audio_files(file1_path, file2_path, sr=const.ANALYSIS_SR):
+    # 同じレートのモノラルPCMを足し合わせる(長さが違えば短い方に揃える)
+    y1, _ = load_analysis_audio(file1_path, sr=sr)
+    y2, _ = load_analysis_audio(file2_path, sr=sr)
+    length = min(len(y1), len(y2))
+    return y1[:length] + y2[:length]
+
+def calculate_rms_for_part(part, stem_paths, section_data, packed=None, song_name=None):
+    if packed is not None and song_name in packed:
+        # memmapのスライスを渡すので，セクションが触れるページだけが読まれる
+        y = packed.get(song_name, part)
+        if part == 'other':
+            y = y + packed.get(song_name, 'vocals')
+        sr = packed.sr
+    elif part == 'other':
+        sr = const.ANALYSIS_SR
+        y = combine_audio_files(stem_paths['other'], stem_paths['vocals'], sr)
     else:
-        file_path = os.path.join(demucs_directory, song_name, f"{part}.mp3")
-        y, sr = librosa.load(file_path, sr=None)
+        y, sr = load_analysis_audio(stem_paths[part])
 
     return calculate_section_rms(y, sr, section_data['segments'])
 
@@ -38,6 +47,7 @@ def find_max_rms(all_rms_values):
             max_rms = max(max_rms, max(all_rms_values[section][part]))
     return max_rms
 
+@profile('plot')
 def plot_3d_rms(all_rms_values, max_rms):
     fig = plt.figure(figsize=(12, 8))
 
@@ -55,6 +65,7 @@ def plot_3d_rms(all_rms_values, max_rms):
     plt.tight_layout()
     plt.show()
 
+@profile('plot')
 def plot_3d_rms_combined(all_rms_values, max_rms):
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
@@ -74,13 +85,13 @@ def plot_3d_rms_combined(all_rms_values, max_rms):
     plt.tight_layout()
     plt.show()
 
-def process_file(json_path, demucs_directory, allin1, all_rms_values, song_section_rms):
-    section_data = allin1.load_section_data(json_path)
-    song_name = os.path.splitext(os.path.basename(json_path))[0]
+def process_file(entry, allin1, all_rms_values, song_section_rms, packed=None):
+    section_data = allin1.load_section_data(entry['json'])
+    song_name = entry['song_name']
 
     song_rms_values = {'bass': {}, 'drums': {}, 'other': {}}
     for part in tqdm(song_rms_values, desc=f"Processing parts for {song_name}", leave=False):
-        rms = calculate_rms_for_part(part, demucs_directory, song_name, section_data)
+        rms = calculate_rms_for_part(part, entry['stems'], section_data, packed, song_name)
         for label, values in rms.items():
             if label not in all_rms_values:
                 all_rms_values[label] = {'bass': [], 'drums': [], 'other': []}
@@ -91,21 +102,17 @@ def process_file(json_path, demucs_directory, allin1, all_rms_values, song_secti
 def main(plot_mode):
     json_directory = const.PROD_JSON_DIRECTORY
     demucs_directory = const.PROD_DEMUCS_DIRECTORY
+    cache_directory = const.PROD_CACHE_DIRECTORY
     allin1 = Allin1()
     all_rms_values = {}
     song_section_rms = {}
 
-    total_files = sum([len(files) for r, d, files in os.walk(json_directory) if any(file.endswith(".json") for file in files)])
-    progress_bar = tqdm(total=total_files, desc="Overall Progress")
-
-    for root, dirs, files in os.walk(json_directory):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, demucs_directory, allin1, all_rms_values, song_section_rms)
-                progress_bar.update(1)
-
-    progress_bar.close()
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, demucs_directory=demucs_directory)
+    # 全ステムを解析用のレートで一度だけデコードして連結し，2回目以降はmemmapから読む
+    packed = PackedAudioStore.from_manifest(manifest, packed_directory(cache_directory, const.ANALYSIS_SR), sr=const.ANALYSIS_SR)
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        with song_context(entry['song_name']):
+            process_file(entry, allin1, all_rms_values, song_section_rms, packed)
 
     max_rms = find_max_rms(all_rms_values)
 
@@ -1,6 +1,10 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
+from drum_store import DrumEventStore, store_directory
+from figure_queue import FigureQueue
+from result_log import record_table
 
 def process_midi_file_single(midi_path, section_data, drum_mapping):
     drum = Drum()
@@ -69,17 +73,20 @@ def plot_drum_section_counts(song_name, section_counts, existing_drums):
     plt.tight_layout()
     plt.show()
 
-def process_file(json_path, midi_directory, allin1, all_section_counts, all_existing_drums, process_mode):
-    midi_path = os.path.join(midi_directory, os.path.splitext(os.path.basename(json_path))[0] + '.mid')
-    if not os.path.exists(midi_path):
+def process_file(entry, allin1, all_section_counts, all_existing_drums, process_mode, figure_queue=None):
+    midi_path = entry['midi']
+    if midi_path is None:
         return
 
-    song_name = os.path.splitext(os.path.basename(json_path))[0]
-    section_data = allin1.load_section_data(json_path)
+    song_name = entry['song_name']
+    section_data = allin1.load_section_data(entry['json'])
 
     if process_mode == 'single':
         section_counts, existing_drums = process_midi_file_single(midi_path, section_data, Drum().drum_mapping)
-        plot_drum_section_counts(song_name, section_counts, existing_drums)
+        if figure_queue is not None:
+            figure_queue.add(plot_drum_section_counts, song_name, section_counts, existing_drums, name=song_name)
+        else:
+            plot_drum_section_counts(song_name, section_counts, existing_drums)
     elif process_mode == 'combined':
         process_midi_file_combined(midi_path, section_data, Drum().drum_mapping, all_section_counts, all_existing_drums)
 
@@ -111,20 +118,21 @@ def main(process_mode):
     all_section_counts = {'intro': {}, 'drop': {}, 'break': {}, 'outro': {}}
     all_existing_drums = set()
 
-    total_files = sum([len(files) for r, d, files in os.walk(json_directory) if any(file.endswith(".json") for file in files)])
-    progress_bar = tqdm(total=total_files, desc="Overall Progress")
-
-    for root, dirs, files in os.walk(json_directory):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, midi_directory, allin1, all_section_counts, all_existing_drums, process_mode)
-                progress_bar.update(1)
-
-    progress_bar.close()
-
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, midi_directory=midi_directory)
     if process_mode == 'combined':
+        store = DrumEventStore.from_manifest(manifest, store_directory(const.PROD_CACHE_DIRECTORY, manifest))
+        segments_by_song = {entry['song_name']: allin1.load_section_data(entry['json'])['segments'] for entry in manifest.songs(require=('midi',))}
+        all_section_counts, all_existing_drums = store.section_count_dicts(segments_by_song)
+        record_table("Drum counts by section", {section: {drum: count for drum, count in counts.items() if drum in all_existing_drums}
+                                                for section, counts in all_section_counts.items()})
         plot_combined_drum_section_counts(all_section_counts, all_existing_drums)
+        return
+
+    # 曲ごとの図は解析が終わってからまとめて並列に描画する
+    figure_queue = FigureQueue(os.path.join(const.PROD_FIGURE_DIRECTORY, 'experiment4'))
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        process_file(entry, allin1, all_section_counts, all_existing_drums, process_mode, figure_queue)
+    figure_queue.render()
 
 if __name__ == "__main__":
     process_mode = 'combined'  # 'single' | 'combined'
@@ -1,6 +1,7 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
 
 def plot_spaghetti(drum_times_all_songs, drum_mapping):
     target_drums = set(['Acoustic Bass Drum', 'Acoustic Snare', 'Closed Hi-Hat'])
@@ -41,15 +42,14 @@ def process_midi_file(midi_path, section_data, drum_mapping):
 
     return section_counts, existing_drums, drum_times
 
-def process_file(json_path, midi_directory, allin1, all_section_counts, all_existing_drums, drum_times_all_songs):
-    base_name = os.path.splitext(os.path.basename(json_path))[0]
-    midi_path = os.path.join(midi_directory, base_name + '.mid')
-    if not os.path.exists(midi_path):
+def process_file(entry, allin1, all_section_counts, all_existing_drums, drum_times_all_songs):
+    midi_path = entry['midi']
+    if midi_path is None:
         return
 
-    song_name = base_name
+    song_name = entry['song_name']
 
-    section_data = allin1.load_section_data(json_path)
+    section_data = allin1.load_section_data(entry['json'])
     section_counts, existing_drums, drum_times = process_midi_file(midi_path, section_data, Drum().drum_mapping)
     for drum, times in drum_times.items():
         drum_times_all_songs[drum][song_name].extend(times)
@@ -64,27 +64,16 @@ def main():
     all_existing_drums = set()
     drum_times_all_songs = defaultdict(lambda: defaultdict(list))
 
-    total_files = sum([len(files) for r, d, files in os.walk(json_directory) if any(file.endswith(".json") for file in files)])
-    progress_bar = tqdm(total=total_files, desc="Overall Progress")
-
-    for root, dirs, files in os.walk(json_directory):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, midi_directory, allin1, all_section_counts, all_existing_drums, drum_times_all_songs)
-                song_name = os.path.splitext(file)[0]
-                midi_path = os.path.join(midi_directory, song_name + '.mid')
-                if not os.path.exists(midi_path):
-                    continue
-                section_data = allin1.load_section_data(json_path)
-                _, _, drum_times = process_midi_file(midi_path, section_data, Drum().drum_mapping)
-
-                for drum, times in drum_times.items():
-                    drum_times_all_songs[drum][song_name].extend(times)
-
-                progress_bar.update(1)
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, midi_directory=midi_directory)
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        process_file(entry, allin1, all_section_counts, all_existing_drums, drum_times_all_songs)
+        if entry['midi'] is None:
+            continue
+        section_data = allin1.load_section_data(entry['json'])
+        _, _, drum_times = process_midi_file(entry['midi'], section_data, Drum().drum_mapping)
 
-    progress_bar.close()
+        for drum, times in drum_times.items():
+            drum_times_all_songs[drum][entry['song_name']].extend(times)
 
     plot_spaghetti(drum_times_all_songs, Drum().drum_mapping)
 
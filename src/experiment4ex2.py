@@ -1,6 +1,8 @@
 from external_libraries import *
 from modules import *
 import data_const as const
+from manifest import CorpusManifest
+from drum_store import DrumEventStore, store_directory
 
 def calculate_bar_length(bpm):
     beats_per_bar = 4
@@ -36,15 +38,22 @@ def plot_spaghetti(drum_counts_per_bar_all_songs, note_to_drum):
         plt.tight_layout()
         plt.show()
 
-def process_file(json_path, midi_directory, drum_mapping, drum_counts_per_bar_all_songs):
-    base_name = os.path.splitext(os.path.basename(json_path))[0]
-    midi_path = os.path.join(midi_directory, base_name + '.mid')
-    if not os.path.exists(midi_path):
+def process_file(entry, drum_mapping, drum_counts_per_bar_all_songs, store=None):
+    base_name = entry['song_name']
+    midi_path = entry['midi']
+    if midi_path is None:
         return
 
-    bpm = get_bpm_from_json(json_path)
+    bpm = get_bpm_from_json(entry['json'])
     bar_length = calculate_bar_length(bpm)
 
+    if store is not None:
+        for drum_name in drum_mapping.values():
+            bar_counts = store.bar_counts(base_name, drum_name, bar_length)
+            if bar_counts:
+                drum_counts_per_bar_all_songs[drum_name][base_name] = bar_counts
+        return
+
     drum = Drum()
     drum_events = drum.get_drum_events(midi_path)
 
@@ -69,17 +78,11 @@ def main():
 
     drum_counts_per_bar_all_songs = defaultdict(lambda: defaultdict(dict))
 
-    total_files = sum([len(files) for r, d, files in os.walk(json_directory) if any(file.endswith(".json") for file in files)])
-    progress_bar = tqdm(total=total_files, desc="Overall Progress")
-
-    for root, dirs, files in os.walk(json_directory):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                process_file(json_path, midi_directory, drum_mapping, drum_counts_per_bar_all_songs)
-                progress_bar.update(1)
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, midi_directory=midi_directory)
+    store = DrumEventStore.from_manifest(manifest, store_directory(const.PROD_CACHE_DIRECTORY, manifest))
+    for entry in tqdm(manifest.songs(), total=len(manifest), desc="Overall Progress"):
+        process_file(entry, drum_mapping, drum_counts_per_bar_all_songs, store)
 
-    progress_bar.close()
     plot_spaghetti(drum_counts_per_bar_all_songs, note_to_drum)
 
 if __name__ == "__main__":
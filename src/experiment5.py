@@ -1,33 +1,30 @@
 from external_libraries import *
 from modules import *
 import data_const as const
-
-def calculate_section_based_matching_rate(pattern_changes, section_changes, song_duration):
-    matched_count = 0
-    matched_times_percent = []
-
-    for section_change in section_changes:
-        if any(section_change - 1 <= pattern_change <= section_change + 1 for pattern_change in pattern_changes):
-            matched_count += 1
-            matched_percent = (section_change / song_duration) * 100
-            matched_times_percent.append(matched_percent)
-
-    matching_rate = (matched_count / len(section_changes)) * 100 if section_changes else 0
-    return matching_rate, matched_times_percent
-
-
-def calculate_drum_based_matching_rate(pattern_changes, section_changes, song_duration):
-    matched_count = 0
-    matched_times_percent = []
-
-    for pattern_change in pattern_changes:
-        if any(pattern_change - 1 <= section_change <= pattern_change + 1 for section_change in section_changes):
-            matched_count += 1
-            matched_percent = (pattern_change / song_duration) * 100
-            matched_times_percent.append(matched_percent)
-
-    matching_rate = (matched_count / len(pattern_changes)) * 100
-    return matching_rate, matched_times_percent
+from manifest import CorpusManifest
+from matching import match_change_points, match_corpus
+from novelty import detect_novelty_changes
+from result_log import record_sample, record_table, record_value
+
+def calculate_section_based_matching_rate(pattern_changes, section_changes, song_duration, tolerance=1):
+    result = match_change_points(pattern_changes, section_changes, song_duration, tolerances=[tolerance])
+    return result['section_based_rate'][0], result['section_matched_percent'][0].tolist()
+
+
+def calculate_drum_based_matching_rate(pattern_changes, section_changes, song_duration, tolerance=1):
+    # パターン変化が無い曲は0%を返す(セクション基準と同じ扱い)
+    result = match_change_points(pattern_changes, section_changes, song_duration, tolerances=[tolerance])
+    return result['drum_based_rate'][0], result['drum_matched_percent'][0].tolist()
+
+def print_tolerance_table(change_points, tolerances):
+    result = match_corpus(change_points, tolerances)
+    print(f"{'tolerance':>10} {'section':>8} {'drum':>8} {'P':>6} {'R':>6} {'F':>6}")
+    for i, tolerance in enumerate(result['tolerances']):
+        print(f"{tolerance:>9.1f}s {result['section_based_rate'][:, i].mean():7.2f}% {result['drum_based_rate'][:, i].mean():7.2f}% "
+              f"{result['precision'][:, i].mean():6.3f} {result['recall'][:, i].mean():6.3f} {result['f_measure'][:, i].mean():6.3f}")
+    record_table("Tolerance", {f"{tolerance}s": {key: result[key][:, i].mean() for key in ('section_based_rate', 'drum_based_rate', 'precision', 'recall', 'f_measure')}
+                               for i, tolerance in enumerate(result['tolerances'])})
+    return result
 
 def plot_matching_rates(all_matching_rates):
     plt.hist(all_matching_rates, bins=range(0, 101, 10), histtype="bar", edgecolor="black")
@@ -54,23 +51,34 @@ def detect_section_changes(section_data):
             previous_label = segment['label']
     return sorted(set(section_changes))
 
-def process_midi_file(midi_path, json_directory, allin1, all_matching_rates, all_matched_times_percent):
-    song_name = os.path.splitext(os.path.basename(midi_path))[0]
-    json_path = os.path.join(json_directory, f"{song_name}.json")
-    section_data = allin1.load_section_data(json_path)
-
+def collect_change_points(song, detector='interval'):
     drum = Drum()
-    events = drum.get_drum_events(midi_path)
+    events = song.drum_events
 
     events_with_times = {note: event for note, event in events.items() if event['times']}
     if not events_with_times:
-        print(f"No drum events found in {song_name}. Skipping.")
+        print(f"No drum events found in {song.name}. Skipping.")
+        return None
+
+    if detector == 'novelty':
+        pattern_changes = detect_novelty_changes(song)
+    elif detector == 'grid':
+        # 16分音符グリッド上で小節パターンが前の小節と変わった小節線を変化点とする
+        pattern_changes = sorted(set(int(round(time)) for time in song.drum_grid().change_times()))
+    else:
+        pattern_changes = drum.detect_pattern_changes(events)
+    section_changes = detect_section_changes(song.section_data)
+
+    # ヘッダから取得した曲長があればそれを使い，なければ最後のドラムイベントで代用する
+    song_duration = song.duration or max(max(event['times']) for event in events.values())
+    return pattern_changes, section_changes, song_duration
+
+def process_midi_file(song, all_matching_rates, all_matched_times_percent, detector='interval'):
+    change_points = collect_change_points(song, detector)
+    if change_points is None:
         return
 
-    pattern_changes = drum.detect_pattern_changes(events)
-    section_changes = detect_section_changes(section_data)
-
-    song_duration = max(max(event['times']) for event in events.values())
+    pattern_changes, section_changes, song_duration = change_points
     matching_rate, matched_times_percent = calculate_drum_based_matching_rate(pattern_changes, section_changes, song_duration)
     # matching_rate, matched_times_percent = calculate_section_based_matching_rate(pattern_changes, section_changes, song_duration)
 
@@ -79,34 +87,40 @@ def process_midi_file(midi_path, json_directory, allin1, all_matching_rates, all
     if all_matched_times_percent is not None:
         all_matched_times_percent.extend(matched_times_percent)
 
-    # drum.plot_drum_with_pattern_and_sections(song_name, events, pattern_changes, section_changes)
+    # Drum().plot_drum_with_pattern_and_sections(song.name, song.drum_events, pattern_changes, section_changes)
 
-def main(process_mode):
+def main(process_mode, detector='interval'):
     midi_directory = const.PROD_MIDI_DIRECTORY
     json_directory = const.PROD_JSON_DIRECTORY
-    allin1 = Allin1()
 
-    midi_files = [os.path.join(root, file) for root, dirs, files in os.walk(midi_directory) for file in files if file.endswith(".mid")]
-    progress_bar = tqdm(total=len(midi_files), desc="Overall Progress")
+    corpus = Corpus(CorpusManifest.load_or_build(json_directory=json_directory, midi_directory=midi_directory))
+    songs = list(corpus.songs(require=('midi',)))
+    progress_bar = tqdm(total=len(songs), desc="Overall Progress")
 
     all_matching_rates = []
-    for midi_path in midi_files:
-        process_midi_file(midi_path, json_directory, allin1, all_matching_rates, None)
+    for song in songs:
+        process_midi_file(song, all_matching_rates, None, detector)
         progress_bar.update(1)
 
     average_matching_rate = sum(all_matching_rates) / len(all_matching_rates) if all_matching_rates else 0
     print(f"Average Matching Rate: {average_matching_rate:.2f}%")
+    record_value("Average Matching Rate", average_matching_rate)
+    record_sample("Matching Rate", all_matching_rates)
 
     if process_mode == 'timeseries':
         all_matched_times_percent = []
-        for midi_path in midi_files:
-            process_midi_file(midi_path, json_directory, allin1, None, all_matched_times_percent)
+        for song in songs:
+            process_midi_file(song, None, all_matched_times_percent, detector)
         plot_matched_times_percent(all_matched_times_percent)
     elif process_mode == 'distribution':
         plot_matching_rates(all_matching_rates)
+    elif process_mode == 'tolerance':
+        change_points = [points for points in (collect_change_points(song, detector) for song in songs) if points is not None]
+        print_tolerance_table(change_points, tolerances=[0.5, 1, 2, 3, 4])
 
     progress_bar.close()
 
 if __name__ == "__main__":
-    process_mode = 'distribution'  # 'timeseries' | 'distribution'
-    main(process_mode)
+    process_mode = 'distribution'  # 'timeseries' | 'distribution' | 'tolerance'
+    detector = 'interval'  # 'interval' | 'grid' | 'novelty'
+    main(process_mode, detector)
@@ -1,8 +1,5 @@
-import librosa
-import librosa.display
-import matplotlib.pyplot as plt
+import importlib
 import numpy as np
-import IPython.display
 import io
 import os
 from pathlib import Path
@@ -11,21 +8,84 @@ from shutil import rmtree
 import subprocess as sp
 import sys
 from typing import Dict, Tuple, Optional, IO
-import mido
 import pprint
 from abc import ABC
-import os
 import json
 from termcolor import colored
 from typing import List
-import pydub
-from pydub import AudioSegment
 from tqdm import tqdm
-from mido import MidiFile
-import pprint
 from collections import defaultdict
-from scipy.stats import f_oneway, ttest_ind, normaltest, levene, kruskal
 from itertools import combinations
-import scikit_posthocs
-import pandas as pd
-from vistats import boxplot_annotate_brackets
+
+# 重いライブラリは最初に属性へアクセスした時点で読み込む(star importでも遅延が効くようにプロキシを置く)
+class _LazyModule:
+    def __init__(self, name, submodules=()):
+        self.__dict__['_name'] = name
+        self.__dict__['_submodules'] = submodules
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(f"{self._name}.{submodule}")
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_module'] is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+class _LazyAttr:
+    def __init__(self, module_name, attr):
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_attr'] = attr
+        self.__dict__['_target'] = None
+
+    def _load(self):
+        target = self.__dict__['_target']
+        if target is None:
+            target = getattr(importlib.import_module(self._module_name), self._attr)
+            self.__dict__['_target'] = target
+        return target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy {self._module_name}.{self._attr}>"
+
+
+librosa = _LazyModule('librosa', submodules=('display',))
+plt = _LazyModule('matplotlib.pyplot')
+IPython = _LazyModule('IPython', submodules=('display',))
+mido = _LazyModule('mido')
+MidiFile = _LazyAttr('mido', 'MidiFile')
+pydub = _LazyModule('pydub')
+AudioSegment = _LazyAttr('pydub', 'AudioSegment')
+f_oneway = _LazyAttr('scipy.stats', 'f_oneway')
+ttest_ind = _LazyAttr('scipy.stats', 'ttest_ind')
+normaltest = _LazyAttr('scipy.stats', 'normaltest')
+levene = _LazyAttr('scipy.stats', 'levene')
+kruskal = _LazyAttr('scipy.stats', 'kruskal')
+chi2 = _LazyAttr('scipy.stats', 'chi2')
+norm = _LazyAttr('scipy.stats', 'norm')
+fftconvolve = _LazyAttr('scipy.signal', 'fftconvolve')
+find_peaks = _LazyAttr('scipy.signal', 'find_peaks')
+scikit_posthocs = _LazyModule('scikit_posthocs')
+pd = _LazyModule('pandas')
+boxplot_annotate_brackets = _LazyAttr('vistats', 'boxplot_annotate_brackets')
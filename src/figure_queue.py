@@ -0,0 +1,68 @@
+from external_libraries import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import re
+from instrumentation import profile
+
+# 解析中はプロットの関数と引数だけを記録し，最後にプロセスプールでまとめて描画・保存する
+class FigureJob:
+    __slots__ = ('plot_fn', 'args', 'kwargs', 'path')
+
+    def __init__(self, plot_fn, args, kwargs, path):
+        self.plot_fn = plot_fn
+        self.args = args
+        self.kwargs = kwargs
+        self.path = path
+
+    def __repr__(self):
+        return f"FigureJob({self.plot_fn.__name__}, {self.path!r})"
+
+
+class FigureQueue:
+    def __init__(self, out_directory, max_workers=None, dpi=100, fmt='png'):
+        self.out_directory = out_directory
+        self.max_workers = max_workers
+        self.dpi = dpi
+        self.fmt = fmt
+        self.jobs = []
+
+    def add(self, plot_fn, *args, name=None, **kwargs):
+        # plot_fnはpickleできるモジュールレベルの関数であること
+        name = _safe_name(name or f"{plot_fn.__name__}_{len(self.jobs):04d}")
+        job = FigureJob(plot_fn, args, kwargs, os.path.join(self.out_directory, f"{name}.{self.fmt}"))
+        self.jobs.append(job)
+        return job
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @profile('plot')
+    def render(self):
+        if not self.jobs:
+            return []
+        os.makedirs(self.out_directory, exist_ok=True)
+        jobs, self.jobs = self.jobs, []
+
+        paths = []
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker) as executor:
+            futures = {executor.submit(_render, job, self.dpi): job for job in jobs}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering figures"):
+                paths.append(future.result())
+        print(f"{colored('FigureQueue', 'blue')}: Saved {len(paths)} figures to '{self.out_directory}'.")
+        return sorted(paths)
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+    # 既存のプロット関数は最後にplt.show()を呼ぶので，ワーカーでは何もしないようにする
+    plt.show = lambda *args, **kwargs: None
+
+def _render(job, dpi):
+    plt.close('all')
+    job.plot_fn(*job.args, **job.kwargs)
+    plt.gcf().savefig(job.path, dpi=dpi)
+    plt.close('all')
+    return job.path
+
+def _safe_name(name):
+    return re.sub(r'[^\w\-. ()]+', '_', name).strip()
@@ -0,0 +1,170 @@
+from external_libraries import *
+from contextlib import contextmanager
+from functools import wraps
+import atexit
+import resource
+import threading
+import time
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_rss():
+    # /proc が無い環境では最大RSSで代用する
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+def peak_rss():
+    # Linuxではru_maxrssはKB単位，macOSではバイト単位
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# ステージごとの壁時計時間・CPU時間・RSSを記録する．無効の時はほぼ何もしない
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+        self.origin = time.perf_counter()
+
+    @property
+    def current_song(self):
+        return getattr(self.local, 'song', None)
+
+    @contextmanager
+    def song(self, song):
+        # このスレッドで記録するステージに曲名を付ける
+        previous = self.current_song
+        self.local.song = song
+        try:
+            yield
+        finally:
+            self.local.song = previous
+
+    @contextmanager
+    def stage(self, name, song=None, **args):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        song = song if song is not None else self.current_song
+        start_peak = peak_rss()
+        start_children = children_cpu()
+        start_cpu = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - start_cpu
+            child_wall = stack.pop()
+            if stack:
+                stack[-1] += wall
+            end_peak = peak_rss()
+            event = {'name': name, 'category': name.split(':')[0], 'song': song, 'start': start - self.origin, 'wall': wall,
+                     'self_wall': wall - child_wall, 'cpu': cpu, 'child_cpu': children_cpu() - start_children,
+                     'rss': current_rss(), 'peak_rss': end_peak, 'peak_growth': end_peak - start_peak,
+                     'tid': threading.get_ident(), 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def profile(self, category, name=None):
+        def decorator(fn):
+            stage_name = f"{category}:{name or fn.__qualname__}"
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.stage(stage_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self, by='name'):
+        rows = {}
+        for event in self.events:
+            key = event[by]
+            row = rows.setdefault(key, {by: key, 'calls': 0, 'wall': 0.0, 'self_wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0,
+                                        'peak_rss': 0, 'peak_growth': 0})
+            row['calls'] += 1
+            for field in ('wall', 'self_wall', 'cpu', 'child_cpu'):
+                row[field] += event[field]
+            row['peak_rss'] = max(row['peak_rss'], event['peak_rss'])
+            row['peak_growth'] = max(row['peak_growth'], event['peak_growth'])
+        return sorted(rows.values(), key=lambda row: row['self_wall'], reverse=True)
+
+    def print_summary(self, by='name', limit=None):
+        rows = self.summary(by)[:limit]
+        total = sum(row['self_wall'] for row in rows) or 1.0
+        print(colored(f"Profile by {by}", 'blue'))
+        print(f"{by:>32} {'calls':>7} {'wall s':>9} {'self s':>9} {'self %':>7} {'cpu s':>9} {'child s':>9} {'peak MB':>9} {'grow MB':>9}")
+        for row in rows:
+            print(f"{str(row[by])[-32:]:>32} {row['calls']:7d} {row['wall']:9.3f} {row['self_wall']:9.3f} {row['self_wall'] / total:7.1%} "
+                  f"{row['cpu']:9.3f} {row['child_cpu']:9.3f} {row['peak_rss'] / 2**20:9.1f} {row['peak_growth'] / 2**20:9.1f}")
+        return rows
+
+    def chrome_trace(self):
+        # chrome://tracing や Perfetto で開ける形式(時間はマイクロ秒)
+        pid = os.getpid()
+        trace = [{'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                  'ts': event['start'] * 1e6, 'dur': event['wall'] * 1e6,
+                  'args': {'song': event['song'], 'cpu': event['cpu'], 'child_cpu': event['child_cpu'],
+                           'rss_mb': event['rss'] / 2**20, 'peak_rss_mb': event['peak_rss'] / 2**20, **event['args']}}
+                 for event in self.events]
+        trace += [{'name': 'rss_mb', 'ph': 'C', 'pid': pid, 'ts': (event['start'] + event['wall']) * 1e6, 'args': {'rss': event['rss'] / 2**20}}
+                  for event in self.events]
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file, default=str)
+        print(f"{colored('Trace', 'blue')}: {path} ({len(self.events)} events)")
+
+    def report(self, trace_path=None):
+        if not self.events:
+            return
+        self.print_summary('category')
+        self.print_summary('name', limit=30)
+        if any(event['song'] is not None for event in self.events):
+            self.print_summary('song', limit=10)
+        if trace_path:
+            self.write_chrome_trace(trace_path)
+
+
+# 環境変数 PROFILE=1 で有効にすると，終了時に集計表とトレースを出力する
+PROFILER = Profiler(enabled=os.environ.get('PROFILE', '') not in ('', '0'))
+stage = PROFILER.stage
+profile = PROFILER.profile
+song_context = PROFILER.song
+
+def _report_at_exit():
+    import data_const as const
+    PROFILER.report(os.environ.get('PROFILE_TRACE') or os.path.join(const.PROD_CACHE_DIRECTORY, 'profile', f"trace_{os.getpid()}.json"))
+
+if PROFILER.enabled:
+    atexit.register(_report_at_exit)
@@ -0,0 +1,168 @@
+from external_libraries import *
+import data_const as const
+from audio_io import probe_audio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import struct
+import threading
+
+COMPONENTS = ['bass', 'drums', 'other', 'vocals']
+# 記録内容を変えたら上げて古い目録を作り直させる
+MANIFEST_VERSION = 3
+
+# 曲ごとのJSON・ミックス・ステム・MIDI・長さ・サンプルレート・内容ハッシュを記録したコーパス目録
+class CorpusManifest:
+    def __init__(self, json_directory, song_directory=None, demucs_directory=None, midi_directory=None,
+                 components=COMPONENTS, path=None, max_workers=8):
+        self.json_directory = json_directory
+        self.song_directory = song_directory
+        self.demucs_directory = demucs_directory
+        self.midi_directory = midi_directory
+        self.components = components
+        self.path = path
+        self.max_workers = max_workers
+        self.entries = {}
+
+    @classmethod
+    def load_or_build(cls, json_directory=const.PROD_JSON_DIRECTORY, song_directory=const.PROD_SONG_DIRECTORY,
+                      demucs_directory=const.PROD_DEMUCS_DIRECTORY, midi_directory=const.PROD_MIDI_DIRECTORY,
+                      cache_directory=const.PROD_CACHE_DIRECTORY, components=COMPONENTS):
+        name = os.path.basename(os.path.normpath(json_directory))
+        manifest = cls(json_directory, song_directory, demucs_directory, midi_directory, components,
+                       path=os.path.join(cache_directory, f"manifest_{name}.json"))
+        manifest.load()
+        manifest.refresh()
+        return manifest
+
+    def load(self):
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data['songs']
+        return self
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 別プロセス・別スレッドが同時に保存しても一時ファイルが重ならないようにする
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': MANIFEST_VERSION, 'songs': self.entries}, file, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        # ディレクトリごとに1回だけscandirし，変化した曲だけファイルを開く
+        # (ステムは上書きしてもディレクトリのmtimeが変わらないので，ファイルごとのサイズと更新時刻も見る)
+        json_files = _scan(self.json_directory, '.json')
+        mix_files = _scan(self.song_directory, '.mp3')
+        midi_files = _scan(self.midi_directory, '.mid')
+        demucs_dirs = _scan(self.demucs_directory, None)
+
+        changed = []
+        for song_name, (json_path, json_mtime) in json_files.items():
+            demucs_dir = demucs_dirs.get(song_name)
+            signature = [json_mtime, mix_files.get(song_name, (None, None))[1], midi_files.get(song_name, (None, None))[1],
+                         demucs_dir[1] if demucs_dir else None, _stem_signature(demucs_dir[0], self.components) if demucs_dir else None]
+            entry = self.entries.get(song_name)
+            if entry is None or entry['signature'] != signature:
+                changed.append((song_name, signature, json_path, mix_files.get(song_name), midi_files.get(song_name),
+                                demucs_dirs.get(song_name)))
+
+        removed = set(self.entries) - set(json_files)
+        for song_name in removed:
+            del self.entries[song_name]
+
+        if changed:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for entry in tqdm(executor.map(lambda args: self._build_entry(*args), changed), total=len(changed),
+                                  desc="Updating manifest"):
+                    self.entries[entry['song_name']] = entry
+        if changed or removed:
+            self.save()
+        return changed
+
+    def _build_entry(self, song_name, signature, json_path, mix, midi, demucs_dir):
+        stems = {}
+        if demucs_dir is not None:
+            stem_files = _scan(demucs_dir[0], '.mp3')
+            stems = {component: stem_files[component][0] for component in self.components if component in stem_files}
+
+        entry = {
+                'song_name': song_name,
+                'signature': signature,
+                'json': json_path,
+                'mix': mix[0] if mix else None,
+                'midi': midi[0] if midi else None,
+                'stems': stems,
+                'duration': None,
+                'sr': None,
+                }
+
+        audio_path = entry['mix'] or next(iter(stems.values()), None)
+        if audio_path is not None:
+            entry['duration'], entry['sr'] = probe_duration(audio_path)
+
+        digest = hashlib.blake2b(digest_size=16)
+        for path in [json_path, entry['mix'], entry['midi']] + [stems[c] for c in sorted(stems)]:
+            if path is not None:
+                digest.update(_file_hash(path).encode())
+        entry['hash'] = digest.hexdigest()
+        return entry
+
+    def songs(self, require=()):
+        for song_name in sorted(self.entries):
+            entry = self.entries[song_name]
+            if all(entry.get(key) for key in require):
+                yield entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return self.songs()
+
+    def __getitem__(self, song_name):
+        return self.entries[song_name]
+
+
+def probe_duration(path):
+    try:
+        info = probe_audio(path)
+        return info['duration'], info['sr']
+    except (ValueError, OSError, struct.error):
+        pass
+    try:
+        return librosa.get_duration(path=path), librosa.get_samplerate(path)
+    except Exception:
+        return None, None
+
+def _scan(directory, extension):
+    found = {}
+    if directory is None or not os.path.isdir(directory):
+        return found
+    with os.scandir(directory) as it:
+        for entry in it:
+            if extension is None and entry.is_dir():
+                found[entry.name] = (entry.path, entry.stat().st_mtime)
+            elif extension is not None and entry.is_file() and entry.name.endswith(extension):
+                found[os.path.splitext(entry.name)[0]] = (entry.path, entry.stat().st_mtime)
+    return found
+
+def _stem_signature(demucs_dir, components):
+    signature = []
+    with os.scandir(demucs_dir) as it:
+        for entry in it:
+            name, extension = os.path.splitext(entry.name)
+            if extension == '.mp3' and name in components and entry.is_file():
+                stat = entry.stat()
+                signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return sorted(signature)
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
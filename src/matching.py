@@ -0,0 +1,70 @@
+from external_libraries import *
+
+# ドラムパターン変化とセクション変化を±許容誤差で照合する(ソート + searchsorted)
+def match_change_points(pattern_changes, section_changes, song_duration, tolerances=(1,)):
+    result = match_corpus([(pattern_changes, section_changes, song_duration)], tolerances)
+    return {key: value[0] if key != 'tolerances' else value for key, value in result.items()}
+
+# 変化点が1つも無い曲の率は0%とする(以前のドラム基準のループはZeroDivisionErrorで止まっていた)
+def match_corpus(songs, tolerances=(1,)):
+    tolerances = np.atleast_1d(np.asarray(tolerances, dtype=np.float64))
+    n_songs = len(songs)
+
+    pattern_ids, patterns = _concatenate([song[0] for song in songs])
+    section_ids, sections = _concatenate([song[1] for song in songs])
+    durations = np.array([song[2] for song in songs], dtype=np.float64)
+
+    n_sections = np.bincount(section_ids, minlength=n_songs)
+    n_patterns = np.bincount(pattern_ids, minlength=n_songs)
+    section_bounds = np.concatenate([[0], np.cumsum(n_sections)])
+    pattern_bounds = np.concatenate([[0], np.cumsum(n_patterns)])
+
+    # 曲ごとに元の時刻のまま探す(曲IDでずらした1本の時間軸にすると，足し算の丸めで許容誤差の端の判定が変わる)
+    section_matched = np.zeros((len(tolerances), len(sections)), dtype=bool)
+    pattern_matched = np.zeros((len(tolerances), len(patterns)), dtype=bool)
+    for song in range(n_songs):
+        song_sections = sections[section_bounds[song]:section_bounds[song + 1]]
+        song_patterns = patterns[pattern_bounds[song]:pattern_bounds[song + 1]]
+        section_matched[:, section_bounds[song]:section_bounds[song + 1]] = _within(song_sections, np.sort(song_patterns), tolerances)
+        pattern_matched[:, pattern_bounds[song]:pattern_bounds[song + 1]] = _within(song_patterns, np.sort(song_sections), tolerances)
+    section_hits = np.stack([np.bincount(section_ids, weights=row, minlength=n_songs) for row in section_matched], axis=1)
+    pattern_hits = np.stack([np.bincount(pattern_ids, weights=row, minlength=n_songs) for row in pattern_matched], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = np.where(n_sections[:, None] > 0, section_hits / n_sections[:, None], 0.0)
+        precision = np.where(n_patterns[:, None] > 0, pattern_hits / n_patterns[:, None], 0.0)
+        f_measure = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        section_percent = sections / durations[section_ids] * 100
+        pattern_percent = patterns / durations[pattern_ids] * 100
+
+    return {
+            'tolerances': tolerances,
+            'section_based_rate': recall * 100,
+            'drum_based_rate': precision * 100,
+            'precision': precision,
+            'recall': recall,
+            'f_measure': f_measure,
+            'section_matched_percent': _split_matched(section_percent, section_matched, n_sections),
+            'drum_matched_percent': _split_matched(pattern_percent, pattern_matched, n_patterns),
+            }
+
+def _split_matched(values, matched, counts):
+    bounds = np.cumsum(counts)[:-1]
+    value_parts = np.split(values, bounds)
+    mask_parts = [np.split(row, bounds) for row in matched]
+    return [[part[masks[i]] for masks in mask_parts] for i, part in enumerate(value_parts)]
+
+def _concatenate(arrays):
+    arrays = [np.asarray(array, dtype=np.float64).ravel() for array in arrays]
+    ids = np.repeat(np.arange(len(arrays)), [len(array) for array in arrays])
+    values = np.concatenate(arrays) if arrays else np.zeros(0)
+    return ids, values
+
+def _within(queries, sorted_targets, tolerances):
+    # 以前のループの any(query - tolerance <= target <= query + tolerance) と同じ比較を許容誤差ごとに行う
+    if len(sorted_targets) == 0:
+        return np.zeros((len(tolerances), len(queries)), dtype=bool)
+    lower = queries[None, :] - tolerances[:, None]
+    index = np.searchsorted(sorted_targets, lower, side='left')
+    nearest = sorted_targets[np.minimum(index, len(sorted_targets) - 1)]
+    return (index < len(sorted_targets)) & (nearest <= queries[None, :] + tolerances[:, None])
@@ -1,4 +1,9 @@
 from external_libraries import *
+from manifest import CorpusManifest
+from audio_io import load_analysis_audio
+from instrumentation import profile, stage, song_context
+from precision import to_storage
+import data_const as const
 
 class Visualizer(ABC):
     def plot(self):
@@ -18,6 +23,7 @@ class AudioSeparator:
         self.int24 = int24
         self.stems = ['bass.mp3', 'drums.mp3', 'vocals.mp3', 'other.mp3']
 
+    @profile('separate')
     def separate(self, inp=None, outp=None):
         inp = inp or self.in_path
         outp = outp or self.out_path
@@ -90,7 +96,7 @@ class AudioSeparator:
 
 
 class RMS(Visualizer):
-    def __init__(self, in_path, demucs_in_path, out_path, threshold = 0.8, sr=44100, frame_length=65000, hop_length=16250, n_ignore=10):
+    def __init__(self, in_path, demucs_in_path, out_path, threshold = 0.8, sr=const.SPECTRAL_SR, frame_length=65000, hop_length=16250, n_ignore=10):
         self.in_path = in_path
         self.sr = sr
         self.frame_length = frame_length
@@ -112,21 +118,23 @@ class RMS(Visualizer):
 
         self._plot_rms_with_color(times, rms_data, rms, labels)
 
+    @profile('feature')
     def compute_rms(self, file):
-        y, _ = librosa.load(file, sr=self.sr, mono=True)
-        rms = librosa.feature.rms(y=y, frame_length=self.frame_length, hop_length=self.hop_length)[0]
+        y, _ = load_analysis_audio(file, sr=self.sr)
+        rms = to_storage(librosa.feature.rms(y=y, frame_length=self.frame_length, hop_length=self.hop_length)[0])
         rms /= np.max(rms)
-        times = np.floor(librosa.times_like(rms, hop_length=self.hop_length, sr=self.sr))
+        times = np.floor(librosa.times_like(rms, hop_length=self.hop_length, sr=self.sr)).astype(np.float32)
 
         return rms, times
 
+    @profile('feature')
     def _compute_splited_rms(self, file, s_file):
-        s_y, s_sr = librosa.load(s_file, sr=44100, mono=True)
-        y, _ = librosa.load(file, sr=44100, mono=True)
-        s_rms = librosa.feature.rms(y=s_y, frame_length=self.frame_length, hop_length=self.hop_length)[0]
+        s_y, s_sr = load_analysis_audio(s_file, sr=self.sr)
+        y, _ = load_analysis_audio(file, sr=self.sr)
+        s_rms = to_storage(librosa.feature.rms(y=s_y, frame_length=self.frame_length, hop_length=self.hop_length)[0])
         rms = librosa.feature.rms(y=y, frame_length=self.frame_length, hop_length=self.hop_length)[0]
         s_rms /= np.max(rms)
-        times = np.floor(librosa.times_like(s_rms, hop_length=self.hop_length, sr=s_sr))
+        times = np.floor(librosa.times_like(s_rms, hop_length=self.hop_length, sr=s_sr)).astype(np.float32)
 
         return s_rms, times
 
@@ -162,6 +170,138 @@ class RMS(Visualizer):
         plt.legend()
         plt.show()
 
+    def get_pyramid(self, file, cache_directory=None):
+        if cache_directory is not None:
+            cache_path = RMSPyramid.cache_path(cache_directory, file)
+            if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file):
+                return RMSPyramid.load(cache_path)
+
+        y, _ = load_analysis_audio(file, sr=self.sr)
+        pyramid = RMSPyramid().build(y, self.sr)
+
+        if cache_directory is not None:
+            pyramid.save(cache_path)
+        return pyramid
+
+    def plot_pyramid(self, start=0.0, end=None, max_points=2000, cache_directory=None):
+        stems = ["bass", "drums", "other", "vocals"]
+        pyramid = self.get_pyramid(self.in_path, cache_directory)
+        level = pyramid.level_for(start, end, max_points)
+        times, rms, _ = pyramid.window(start, end, level=level)
+        norm = pyramid.max_rms[level]
+
+        rms_data = []
+        for stem in stems:
+            s_pyramid = self.get_pyramid(f"{self.demucs_in_path}/{stem}.mp3", cache_directory)
+            rms_data.append(s_pyramid.window(start, end, level=level)[1] / norm)
+
+        self._plot_rms_with_color(times, rms_data, rms / norm, stems)
+
+
+# 2倍ずつホップ長を伸ばしたRMS/ピークの多重解像度ピラミッド(ミップマップ)
+class RMSPyramid:
+    def __init__(self, base_hop=512, dtype=np.float16):
+        self.base_hop = base_hop
+        self.dtype = dtype
+        self.sr = None
+        self.duration = 0.0
+        self.rms_levels = []
+        self.peak_levels = []
+        self.max_rms = []
+
+    def build(self, y, sr):
+        self.sr = sr
+        self.duration = len(y) / sr
+        n_frames = int(np.ceil(len(y) / self.base_hop))
+        frames = np.zeros(n_frames * self.base_hop, dtype=np.float32)
+        frames[:len(y)] = y
+        frames = frames.reshape(n_frames, self.base_hop)
+
+        # 非重複フレームの平均二乗値は子フレーム2つの平均で親レベルを厳密に計算できる
+        power = np.mean(frames ** 2, axis=1)
+        peak = np.max(np.abs(frames), axis=1)
+
+        self.rms_levels, self.peak_levels, self.max_rms = [], [], []
+        while True:
+            rms = np.sqrt(power)
+            self.rms_levels.append(rms.astype(self.dtype))
+            self.peak_levels.append(peak.astype(self.dtype))
+            self.max_rms.append(float(rms.max()) if len(rms) else 0.0)
+            if len(power) <= 1:
+                break
+            if len(power) % 2:
+                power = np.append(power, power[-1])
+                peak = np.append(peak, peak[-1])
+            power = (power[0::2] + power[1::2]) / 2
+            peak = np.maximum(peak[0::2], peak[1::2])
+        return self
+
+    @property
+    def n_levels(self):
+        return len(self.rms_levels)
+
+    def hop_length(self, level):
+        return self.base_hop * 2 ** level
+
+    def level_for(self, start=0.0, end=None, max_points=2000):
+        end = self.duration if end is None else end
+        for level in range(self.n_levels):
+            if (end - start) * self.sr / self.hop_length(level) <= max_points:
+                return level
+        return self.n_levels - 1
+
+    def window(self, start=0.0, end=None, level=0):
+        end = self.duration if end is None else end
+        hop = self.hop_length(level)
+        start_index = max(int(start * self.sr // hop), 0)
+        end_index = int(np.ceil(end * self.sr / hop))
+        rms = self.rms_levels[level][start_index:end_index].astype(np.float32)
+        peak = self.peak_levels[level][start_index:end_index].astype(np.float32)
+        times = (np.arange(start_index, start_index + len(rms)) * hop) / self.sr
+        return times, rms, peak
+
+    def section_mean(self, start, end, level=0, kind='rms'):
+        times, rms, peak = self.window(start, end, level=level)
+        values = rms if kind == 'rms' else peak
+        if len(values) == 0:
+            return None
+        return float(values.mean())
+
+    def section_averages(self, sections, level=0, kind='rms'):
+        section_averages = {'intro': [], 'drop': [], 'break': [], 'outro': []}
+        for section in sections:
+            mean = self.section_mean(section['start'], section['end'], level, kind)
+            if section['label'] in section_averages and mean is not None:
+                section_averages[section['label']].append(mean)
+        return section_averages
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {'meta': np.array([self.base_hop, self.sr, self.duration], dtype=np.float64),
+                  'max_rms': np.array(self.max_rms, dtype=np.float32)}
+        for level in range(self.n_levels):
+            arrays[f"rms_{level}"] = self.rms_levels[level]
+            arrays[f"peak_{level}"] = self.peak_levels[level]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            base_hop, sr, duration = data['meta']
+            pyramid = cls(base_hop=int(base_hop))
+            pyramid.sr = int(sr)
+            pyramid.duration = float(duration)
+            pyramid.max_rms = data['max_rms'].tolist()
+            pyramid.rms_levels = [data[f"rms_{level}"] for level in range(len(pyramid.max_rms))]
+            pyramid.peak_levels = [data[f"peak_{level}"] for level in range(len(pyramid.max_rms))]
+            pyramid.dtype = pyramid.rms_levels[0].dtype.type
+        return pyramid
+
+    @staticmethod
+    def cache_path(cache_directory, file):
+        path = Path(file)
+        return os.path.join(cache_directory, "rms_pyramid", path.parent.name, f"{path.stem}.npz")
+
 
 class Drum(Visualizer):
     def __init__(self):
@@ -218,6 +358,7 @@ class Drum(Visualizer):
                 81: 'Open Triangle'
                 }
 
+    @profile('midi')
     def get_drum_events(self, in_path):
         mid = mido.MidiFile(in_path)
         events = self._extract_events(mid)
@@ -242,6 +383,24 @@ class Drum(Visualizer):
                     events[msg.note]['times'].append(time)
         return events
 
+    def get_drum_event_array(self, in_path):
+        mid = mido.MidiFile(in_path)
+        notes, times, velocities = [], [], []
+        time = 0
+        tempo = mido.bpm2tempo(120)
+
+        for track in mid.tracks:
+            for msg in track:
+                time += mido.tick2second(msg.time, mid.ticks_per_beat, tempo)
+                new_tempo = self._extract_tempo(msg)
+                if new_tempo is not None:
+                    tempo = new_tempo
+                elif self._is_drum_part(msg):
+                    notes.append(msg.note)
+                    times.append(time)
+                    velocities.append(msg.velocity)
+        return np.array(notes, dtype=np.uint8), np.array(times, dtype=np.float64), np.array(velocities, dtype=np.uint8)
+
     def _plot_events(self, events):
         plt.figure(figsize=(15, 5))
         for drum_note, event in events.items():
@@ -363,14 +522,16 @@ class Frequency:
     def __init__(self):
         pass
 
+    @profile('feature')
     def get_spectral_centroid(self, audio_file: str, n_fft=2048*2) -> Tuple[np.ndarray, float, np.ndarray]:
-        y, sr = librosa.load(audio_file, sr=None)
+        y, sr = load_analysis_audio(audio_file, sr=const.SPECTRAL_SR)
         spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr, n_fft=n_fft)
         times = librosa.times_like(spectral_centroid, sr=sr)
         return spectral_centroid, sr, times
 
+    @profile('feature')
     def get_spectrogram(self, audio_file: str) -> List[List[float]]:
-        y, sr = librosa.load(audio_file, sr=None)
+        y, sr = load_analysis_audio(audio_file, sr=const.SPECTRAL_SR)
         spectrogram = librosa.amplitude_to_db(librosa.stft(y), ref=np.max)
         # self._plot_spectrogram(spectrogram)
         return spectrogram, sr
@@ -394,6 +555,9 @@ class Frequency:
 
 
 class Allin1:
+    # ビートグリッドは拍/小節単位の集計に使うので残す
+    KEEP_KEYS = ('path', 'bpm', 'beats', 'downbeats', 'beat_positions', 'segments')
+
     def format_json(self, path):
         json_files = [file for file in os.listdir(path) if file.endswith('.json')]
 
@@ -404,7 +568,7 @@ class Allin1:
                 data = json.load(file)
 
             for item in list(data.keys()):
-                if item not in ('path', 'segments'):
+                if item not in self.KEEP_KEYS:
                     del data[item]
 
             with open(file_path, 'w') as file:
@@ -432,6 +596,21 @@ class Allin1:
 
         print("All json files have been updated.")
 
+    def format_file(self, in_path, out_path):
+        # format_json・update_path_json・modify_jsonを1ファイル分まとめて行う
+        with open(in_path, 'r') as file:
+            data = json.load(file)
+
+        data = {key: value for key, value in data.items() if key in self.KEEP_KEYS}
+        data['path'] = out_path
+        for segment in data.get('segments', []):
+            if 'label' in segment:
+                segment['label'] = self.modify_label(segment['label'])
+
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'w') as file:
+            json.dump(data, file, indent=4)
+
     def modify_label(self, label):
         label_mappings = {
                 'start': 'intro',
@@ -526,6 +705,325 @@ class Allin1:
         print("All json files have been updated.")
 
 
+# フレーム単位の特徴量を拍/小節単位にまとめる(np.add.reduceat)
+class BeatSync:
+    def __init__(self, beats, downbeats=None, end=None):
+        self.beats = np.asarray(beats, dtype=np.float64)
+        self.downbeats = np.asarray(downbeats if downbeats is not None else [], dtype=np.float64)
+        self.end = end
+
+    @classmethod
+    def from_data(cls, data, end=None):
+        return cls(data.get('beats', []), data.get('downbeats'), end)
+
+    def grid(self, unit='beat'):
+        if unit == 'beat':
+            return self.beats
+        elif unit == 'bar':
+            return self.downbeats
+        raise ValueError(f"Unknown grid unit: {unit}")
+
+    def boundaries(self, times, unit='beat'):
+        end = len(times) if self.end is None else int(np.searchsorted(times, self.end, side='left'))
+        starts = np.minimum(np.searchsorted(times, self.grid(unit), side='left'), end)
+        stops = np.append(starts[1:], end)
+        return starts, stops
+
+    def pool(self, values, times, unit='beat', how='mean'):
+        values = np.asarray(values, dtype=np.float64)
+        starts, stops = self.boundaries(times, unit)
+        counts = stops - starts
+        nonempty = counts > 0
+        sums = np.zeros((len(starts),) + values.shape[1:])
+        if nonempty.any():
+            # 区間は連続しているので，空でない区間の開始位置だけでreduceatすれば各区間の和になる
+            sums[nonempty] = np.add.reduceat(values[:stops[-1]], starts[nonempty], axis=0)
+        if how == 'sum':
+            return sums
+        elif how == 'mean':
+            shape = (-1,) + (1,) * (values.ndim - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(nonempty.reshape(shape), sums / counts.reshape(shape), np.nan)
+        raise ValueError(f"Unknown pooling: {how}")
+
+    def count(self, onsets, unit='beat'):
+        grid = self.grid(unit)
+        index = np.searchsorted(grid, np.asarray(onsets, dtype=np.float64), side='right') - 1
+        valid = index >= 0
+        if self.end is not None:
+            valid &= np.asarray(onsets) < self.end
+        return np.bincount(index[valid], minlength=len(grid))
+
+    def labels(self, segments, unit='beat'):
+        grid = self.grid(unit)
+        starts = np.array([segment['start'] for segment in segments], dtype=np.float64)
+        index = np.clip(np.searchsorted(starts, grid, side='right') - 1, 0, None)
+        return np.array([segments[i]['label'] for i in index]) if segments else np.array([], dtype=str)
+
+
+# 小節ごとに16分音符グリッドへ量子化し，楽器ごとのパターンを整数のビットマスクに詰める
+class DrumGrid:
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def __init__(self, masks, notes, downbeats, steps_per_bar=16):
+        self.masks = masks
+        self.notes = list(notes)
+        self.downbeats = np.asarray(downbeats, dtype=np.float64)
+        self.steps_per_bar = steps_per_bar
+
+    @classmethod
+    def from_events(cls, events, downbeats=None, bpm=None, end=None, steps_per_bar=16):
+        if steps_per_bar not in (8, 16, 32):
+            raise ValueError(f"steps_per_bar must be 8, 16 or 32, got {steps_per_bar}")
+        dtype = {8: np.uint8, 16: np.uint16, 32: np.uint32}[steps_per_bar]
+        notes = sorted(note for note, event in events.items() if event['times'])
+        last_time = max((max(events[note]['times']) for note in notes), default=0.0)
+        end = max(end or 0.0, last_time)
+
+        downbeats = np.asarray(downbeats if downbeats is not None else [], dtype=np.float64)
+        if len(downbeats) < 2:
+            if not bpm:
+                raise ValueError("Either two or more downbeats or a bpm is required")
+            # 拍情報が無ければ4/4拍子として一定テンポで小節線を引く
+            start = downbeats[0] if len(downbeats) else 0.0
+            downbeats = np.arange(start, end, 240.0 / bpm)
+            if len(downbeats) < 2:
+                # 2小節に満たない曲でも小節の長さが決まるよう，小節線を2本は引く
+                downbeats = start + np.arange(2) * 240.0 / bpm
+
+        # 前後に1小節ずつ足して，最初の小節線の直前や最後の小節の後ろも量子化できるようにする
+        bar_lengths = np.diff(downbeats)
+        edges = np.concatenate([[downbeats[0] - bar_lengths[0]], downbeats, [downbeats[-1] + bar_lengths[-1]]])
+        while edges[-1] <= end:
+            edges = np.append(edges, edges[-1] + bar_lengths[-1])
+        lengths = np.diff(edges)
+
+        masks = np.zeros((len(notes), len(edges) - 2), dtype=dtype)
+        for row, note in enumerate(notes):
+            times = np.asarray(events[note]['times'], dtype=np.float64)
+            bar = np.clip(np.searchsorted(edges, times, side='right') - 1, 0, len(lengths) - 1)
+            step = np.floor((times - edges[bar]) / lengths[bar] * steps_per_bar + 0.5).astype(np.int64)
+            bar = bar + step // steps_per_bar
+            step = step % steps_per_bar
+            # 追加した前後の小節を除き，本来の小節番号に戻す
+            bar -= 1
+            valid = (bar >= 0) & (bar < masks.shape[1])
+            np.bitwise_or.at(masks[row], bar[valid], dtype(1) << step[valid].astype(dtype))
+
+        return cls(masks, notes, edges[1:-1], steps_per_bar)
+
+    @classmethod
+    def from_song(cls, song, steps_per_bar=16):
+        return cls.from_events(song.drum_events or {}, song.downbeats, song.beat_data.get('bpm'), song.duration, steps_per_bar)
+
+    @property
+    def n_bars(self):
+        return self.masks.shape[1]
+
+    def patterns(self, notes=None):
+        # 指定した楽器の順に並べ，この曲で鳴っていない楽器は0の行にする
+        if notes is None:
+            return self.masks
+        masks = np.zeros((len(notes), self.n_bars), dtype=self.masks.dtype)
+        for row, note in enumerate(notes):
+            if note in self.notes:
+                masks[row] = self.masks[self.notes.index(note)]
+        return masks
+
+    def changes(self, notes=None, threshold=0):
+        # 前の小節とのハミング距離がthresholdを超えた小節を変化とみなす
+        changed = np.zeros(self.n_bars, dtype=bool)
+        changed[1:] = self.hamming(notes=notes) > threshold
+        return changed
+
+    def change_times(self, notes=None, threshold=0):
+        return self.downbeats[self.changes(notes, threshold)]
+
+    def unique_patterns(self, notes=None):
+        masks = self.patterns(notes)
+        patterns, inverse, counts = np.unique(masks.T, axis=0, return_inverse=True, return_counts=True)
+        return patterns, inverse.ravel(), counts
+
+    def hamming(self, other=None, notes=None):
+        # other=Noneなら隣り合う小節との距離，他のDrumGridなら同じ小節同士の距離
+        masks = self.patterns(notes)
+        if other is None:
+            return self.popcount(masks[:, 1:] ^ masks[:, :-1]).sum(axis=0)
+        # 楽器の集合が違うグリッド同士は，両方の楽器を合わせた並びに揃えて比べる
+        notes = notes if notes is not None else sorted(set(self.notes) | set(other.notes))
+        masks = self.patterns(notes)
+        other_masks = other.patterns(notes)
+        n = min(masks.shape[1], other_masks.shape[1])
+        return self.popcount(masks[:, :n] ^ other_masks[:, :n]).sum(axis=0)
+
+    def distance_matrix(self, notes=None):
+        masks = self.patterns(notes)
+        return self.popcount(masks[:, :, None] ^ masks[:, None, :]).sum(axis=0)
+
+    @classmethod
+    def popcount(cls, values):
+        values = np.ascontiguousarray(values)
+        counts = cls._POPCOUNT8[values.view(np.uint8)].reshape(values.shape + (values.dtype.itemsize,))
+        return counts.sum(axis=-1, dtype=np.int64)
+
+
+# 1曲分のデータを必要になった時点で読み込み，以降はメモ化して使い回す
+class Song:
+    __slots__ = ('entry', 'sr', '_section_data', '_beat_data', '_drum_events', '_audio', '_features')
+
+    FEATURES = {
+            'rms': lambda y, sr, **params: librosa.feature.rms(y=y, **params)[0],
+            'spectral_centroid': lambda y, sr, **params: librosa.feature.spectral_centroid(y=y, sr=sr, **params)[0],
+            }
+
+    def __init__(self, entry, sr=const.ANALYSIS_SR):
+        self.entry = entry
+        self.sr = sr
+        self._section_data = None
+        self._beat_data = None
+        self._drum_events = None
+        self._audio = {}
+        self._features = {}
+
+    def __repr__(self):
+        return f"Song({self.name!r})"
+
+    @property
+    def name(self):
+        return self.entry['song_name']
+
+    @property
+    def duration(self):
+        return self.entry.get('duration')
+
+    @property
+    def section_data(self):
+        if self._section_data is None:
+            self._section_data = Allin1().load_section_data(self.entry['json'])
+        return self._section_data
+
+    @property
+    def segments(self):
+        return self.section_data['segments']
+
+    @property
+    def beat_data(self):
+        # 整形済みJSONに拍が無ければテンポ付きJSONから読む
+        if self._beat_data is None:
+            data = self.section_data
+            if 'beats' not in data:
+                tempo_path = os.path.join(const.PROD_JSON_DIRECTORY_TEMPO, os.path.basename(self.entry['json']))
+                data = Allin1().load_section_data(tempo_path) if os.path.exists(tempo_path) else {}
+            self._beat_data = {key: data.get(key) for key in ('bpm', 'beats', 'downbeats', 'beat_positions')}
+        return self._beat_data
+
+    @property
+    def beats(self):
+        return np.asarray(self.beat_data['beats'] or [], dtype=np.float64)
+
+    @property
+    def downbeats(self):
+        return np.asarray(self.beat_data['downbeats'] or [], dtype=np.float64)
+
+    @property
+    def beat_sync(self):
+        return BeatSync(self.beats, self.downbeats, end=self.duration)
+
+    def pooled_feature(self, name, unit='bar', stem='mix', how='mean', **params):
+        values, times = self.feature(name, stem, **params)
+        return self.beat_sync.pool(values, times, unit, how)
+
+    def drum_grid(self, steps_per_bar=16):
+        return DrumGrid.from_song(self, steps_per_bar)
+
+    def drum_counts(self, unit='bar'):
+        beat_sync = self.beat_sync
+        return {note: beat_sync.count(event['times'], unit) for note, event in (self.drum_events or {}).items()}
+
+    @property
+    def drum_events(self):
+        if self._drum_events is None and self.entry.get('midi'):
+            self._drum_events = Drum().get_drum_events(self.entry['midi'])
+        return self._drum_events
+
+    @property
+    def mix(self):
+        return self.audio('mix')
+
+    def stem(self, component):
+        return self.audio(component)
+
+    def has_audio(self, stem='mix'):
+        return self._audio_path(stem) is not None
+
+    def audio(self, stem='mix', sr=None):
+        sr = sr or self.sr
+        key = (stem, sr)
+        if key not in self._audio:
+            path = self._audio_path(stem)
+            if path is None:
+                raise FileNotFoundError(f"{self.name} has no {stem} audio")
+            with song_context(self.name):
+                self._audio[key] = load_analysis_audio(path, sr=sr)
+        return self._audio[key]
+
+    def feature(self, name, stem='mix', sr=None, **params):
+        key = (name, stem, sr or self.sr, tuple(sorted(params.items())))
+        if key not in self._features:
+            y, sr = self.audio(stem, sr)
+            with stage(f"feature:{name}", song=self.name, stem=stem):
+                values = self.FEATURES[name](y, sr, **params)
+            # 値は保存用の型で持ち，時刻はフレーム数から作り直す(フレームごとの時刻配列は持たない)
+            self._features[key] = (to_storage(values), sr, params.get('hop_length', 512))
+        values, sr, hop_length = self._features[key]
+        return values, librosa.times_like(values, sr=sr, hop_length=hop_length)
+
+    def release(self, features=False):
+        self._audio = {}
+        if features:
+            self._features = {}
+            self._drum_events = None
+            self._section_data = None
+            self._beat_data = None
+
+    def _audio_path(self, stem):
+        if stem == 'mix':
+            return self.entry.get('mix')
+        return self.entry.get('stems', {}).get(stem)
+
+
+class Corpus:
+    __slots__ = ('manifest', 'sr', '_songs')
+
+    def __init__(self, manifest, sr=const.ANALYSIS_SR):
+        self.manifest = manifest
+        self.sr = sr
+        self._songs = {}
+
+    @classmethod
+    def from_directories(cls, sr=const.ANALYSIS_SR, **directories):
+        return cls(CorpusManifest.load_or_build(**directories), sr=sr)
+
+    def songs(self, require=()):
+        for entry in self.manifest.songs(require=require):
+            yield self[entry['song_name']]
+
+    def __iter__(self):
+        return self.songs()
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, song_name):
+        if song_name not in self._songs:
+            self._songs[song_name] = Song(self.manifest[song_name], sr=self.sr)
+        return self._songs[song_name]
+
+    def release(self, features=False):
+        for song in self._songs.values():
+            song.release(features)
+
+
 # matplotlibで箱ひげ図の上に検定のP値を表示する関数
 def barplot_annotate_brackets(num1, num2, data, center, height, yerr=None, dh=.05, barh=.05, fs=None, maxasterix=None):
     """
@@ -0,0 +1,46 @@
+from external_libraries import *
+from modules import DrumGrid
+
+# 小節ごとのドラムパターンから自己類似行列を作り，チェッカーボードカーネルでノベルティ曲線を求める
+def bar_features(grid, notes=None):
+    masks = grid.patterns(notes)
+    steps = np.arange(grid.steps_per_bar, dtype=masks.dtype)
+    bits = (masks[:, :, None] >> steps) & 1
+    features = bits.transpose(1, 0, 2).reshape(grid.n_bars, -1).astype(np.float32)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return np.divide(features, norms, out=np.zeros_like(features), where=norms > 0)
+
+def self_similarity(features):
+    return features @ features.T
+
+def checkerboard_kernel(half_width, sigma=0.5):
+    offsets = np.arange(-half_width, half_width) + 0.5
+    taper = np.exp(-0.5 * (offsets / (half_width * sigma)) ** 2)
+    sign = np.sign(offsets)
+    return np.outer(sign * taper, sign * taper).astype(np.float32)
+
+def novelty_curve(ssm, half_width=8, sigma=0.5):
+    # N(i) = Σ K(m, n) S(i+m, i+n) をFFT畳み込みの対角成分として一度に計算する
+    kernel = checkerboard_kernel(half_width, sigma)
+    full = fftconvolve(ssm, kernel[::-1, ::-1], mode='full')
+    n = len(ssm)
+    index = np.arange(n) + half_width - 1
+    novelty = full[index, index]
+    return np.clip(novelty, 0, None)
+
+def pick_change_bars(novelty, min_distance=4, threshold=1.0):
+    if len(novelty) == 0 or not np.any(novelty > 0):
+        return np.zeros(0, dtype=np.int64)
+    height = novelty.mean() + threshold * novelty.std()
+    peaks, _ = find_peaks(novelty, height=height, distance=min_distance)
+    return peaks
+
+def analyze_grid(grid, notes=None, half_width=8, sigma=0.5, min_distance=4, threshold=1.0):
+    ssm = self_similarity(bar_features(grid, notes))
+    novelty = novelty_curve(ssm, half_width, sigma)
+    bars = pick_change_bars(novelty, min_distance, threshold)
+    return {'ssm': ssm, 'novelty': novelty, 'bars': bars, 'times': grid.downbeats[bars]}
+
+def detect_novelty_changes(song, **params):
+    result = analyze_grid(song.drum_grid(), **params)
+    return sorted(set(int(round(time)) for time in result['times']))
@@ -0,0 +1,143 @@
+from external_libraries import *
+import data_const as const
+from manifest import CorpusManifest
+from prefetch import PrefetchLoader, load_stems
+
+COMPONENTS = ['bass', 'drums', 'other', 'vocals']
+# 索引の形式を変えたら上げて作り直させる
+PACKED_VERSION = 1
+SHARD_BYTES = 2 * 1024 ** 3
+
+def packed_directory(cache_directory, sr):
+    return os.path.join(cache_directory, 'packed_audio', f"sr{sr}")
+
+# 全曲のステムを解析用のサンプルレートでデコードし，数個の大きなfloat32ファイルに連結して持つ
+# (曲, ステム) -> (シャード, 開始サンプル, 長さ) の索引から np.memmap のスライスをコピーなしで返す
+class PackedAudioStore:
+    def __init__(self, directory, sr, index=None):
+        self.directory = directory
+        self.sr = sr
+        self.index = index or {'version': PACKED_VERSION, 'sr': sr, 'shards': [], 'songs': {}, 'hashes': {}}
+        self._maps = {}
+
+    @classmethod
+    def open(cls, directory, sr=const.ANALYSIS_SR):
+        path = os.path.join(directory, 'index.json')
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                index = json.load(file)
+            if index.get('version') == PACKED_VERSION and index.get('sr') == sr:
+                return cls(directory, sr, index)
+        return cls(directory, sr)
+
+    @classmethod
+    def from_manifest(cls, manifest, directory, sr=const.ANALYSIS_SR, components=COMPONENTS, shard_bytes=SHARD_BYTES, prefetch=4):
+        store = cls.open(directory, sr)
+        store.update(manifest, components, shard_bytes, prefetch)
+        return store
+
+    def update(self, manifest, components=COMPONENTS, shard_bytes=SHARD_BYTES, prefetch=4):
+        # 新しい曲と内容ハッシュが変わった曲だけを末尾に追記する(古い領域は索引から外れるだけ)
+        entries = [entry for entry in manifest.songs() if entry['stems']]
+        for song_name in set(self.index['songs']) - {entry['song_name'] for entry in entries}:
+            self._drop(song_name)
+        missing = [entry for entry in entries if self.index['hashes'].get(entry['song_name']) != entry.get('hash')
+                   or set(self.index['songs'].get(entry['song_name'], {})) != set(components) & set(entry['stems'])]
+        if not missing:
+            return []
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._maps = {}
+        loader = PrefetchLoader(lambda entry: load_stems(entry['stems'], components, sr=self.sr, cache=False), prefetch=prefetch)
+        file = None
+        try:
+            for entry, stems in tqdm(loader.iterate(missing), total=len(missing), desc="Packing stems"):
+                song = {}
+                for component, (y, _) in stems.items():
+                    y = np.ascontiguousarray(y, dtype='<f4')
+                    if file is None or (file.tell() > 0 and file.tell() + y.nbytes > shard_bytes):
+                        if file is not None:
+                            file.close()
+                        file = self._open_shard(shard_bytes, reuse=file is None)
+                    song[component] = [len(self.index['shards']) - 1, file.tell() // 4, len(y)]
+                    file.write(memoryview(y))
+                self.index['songs'][entry['song_name']] = song
+                self.index['hashes'][entry['song_name']] = entry.get('hash')
+        finally:
+            if file is not None:
+                file.close()
+            # データを書き終えてから索引を置き換えるので，途中で止まっても既存の索引は壊れない
+            self.save()
+        return [entry['song_name'] for entry in missing]
+
+    def _open_shard(self, shard_bytes, reuse):
+        shards = self.index['shards']
+        if reuse and shards:
+            # 最後のシャードに空きがあれば続きから書く
+            path = os.path.join(self.directory, shards[-1])
+            if os.path.getsize(path) < shard_bytes:
+                return open(path, 'ab')
+        name = f"shard_{len(shards):04d}.f32"
+        shards.append(name)
+        return open(os.path.join(self.directory, name), 'ab')
+
+    def _drop(self, song_name):
+        self.index['songs'].pop(song_name, None)
+        self.index['hashes'].pop(song_name, None)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'index.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _shard(self, shard):
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.directory, self.index['shards'][shard]), dtype='<f4', mode='r')
+        return self._maps[shard]
+
+    def __contains__(self, song_name):
+        return song_name in self.index['songs']
+
+    def __len__(self):
+        return len(self.index['songs'])
+
+    def stems(self, song_name):
+        return list(self.index['songs'].get(song_name, {}))
+
+    def get(self, song_name, stem):
+        shard, offset, length = self.index['songs'][song_name][stem]
+        return self._shard(shard)[offset:offset + length]
+
+    def window(self, song_name, stem, start, end=None):
+        # librosa.time_to_samples と同じく秒×srの切り捨てでサンプル位置にする
+        y = self.get(song_name, stem)
+        start_sample = int(start * self.sr)
+        end_sample = len(y) if end is None else int(end * self.sr)
+        return y[start_sample:end_sample]
+
+    def section_windows(self, song_name, stem, sections):
+        return [(section, self.window(song_name, stem, section['start'], section['end'])) for section in sections]
+
+    def stale_bytes(self):
+        # 更新で索引から外れた領域の大きさ(大きくなったらディレクトリを消して作り直す)
+        used = sum(length for song in self.index['songs'].values() for _, _, length in song.values()) * 4
+        total = sum(os.path.getsize(os.path.join(self.directory, shard)) for shard in self.index['shards'])
+        return total - used
+
+
+def main(process_mode):
+    json_directory = const.PROD_JSON_DIRECTORY
+    demucs_directory = const.PROD_DEMUCS_DIRECTORY
+
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, demucs_directory=demucs_directory)
+    if process_mode == 'build':
+        store = PackedAudioStore.from_manifest(manifest, packed_directory(const.PROD_CACHE_DIRECTORY, const.ANALYSIS_SR), sr=const.ANALYSIS_SR)
+        print(f"{colored('PackedAudioStore', 'blue')}: {len(store)} songs, {len(store.index['shards'])} shards, "
+              f"{store.stale_bytes() / 2**20:.1f} MB stale")
+
+if __name__ == "__main__":
+    process_mode = 'build'  # 'build'
+    main(process_mode)
@@ -0,0 +1,309 @@
+from external_libraries import *
+from modules import *
+import data_const as const
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import threading
+
+COMPONENTS = ['bass', 'drums', 'other', 'vocals']
+
+# 入力と出力を宣言した処理単位．per_song=Falseなら全曲分の出力をまとめて扱う(実験など)
+class Stage:
+    def __init__(self, name, inputs, outputs, run, depends=(), per_song=True, cpu=1, version=1):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+        self.depends = tuple(depends)
+        self.per_song = per_song
+        self.cpu = cpu
+        self.version = version
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+class Task:
+    __slots__ = ('stage', 'song', 'depends')
+
+    def __init__(self, stage, song, depends):
+        self.stage = stage
+        self.song = song
+        self.depends = depends
+
+    @property
+    def key(self):
+        return f"{self.stage.name}:{self.song}" if self.song is not None else self.stage.name
+
+    def inputs(self, songs):
+        return self.stage.inputs(self.song) if self.stage.per_song else self.stage.inputs(songs)
+
+    def outputs(self, songs):
+        return self.stage.outputs(self.song) if self.stage.per_song else self.stage.outputs(songs)
+
+    def execute(self, songs):
+        return self.stage.run(self.song) if self.stage.per_song else self.stage.run(songs)
+
+
+# ファイル内容のハッシュ．サイズと更新時刻が変わらない限り前回の値を使う
+# cacheを他の処理と共有する時は，その処理と同じlockを渡す
+class ContentHasher:
+    def __init__(self, cache=None, lock=None):
+        self.cache = cache if cache is not None else {}
+        self.lock = lock or threading.Lock()
+
+    def __call__(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.cache[path] = [signature, digest.hexdigest()]
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages, songs, state_path, cpu_budget=None, max_workers=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.songs = sorted(songs)
+        self.state_path = state_path
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.max_workers = max_workers or self.cpu_budget
+        self.state = self._load_state()
+        # ハッシュの書き込みと状態の保存(json.dump)が同時に走らないよう，同じロックを使う
+        self.lock = threading.Lock()
+        self.hasher = ContentHasher(self.state.setdefault('hashes', {}), self.lock)
+
+    def tasks(self, targets=None):
+        # 依存関係をたどり，(ステージ, 曲) 単位のタスクを作る
+        tasks = {}
+
+        def add(stage_name, song):
+            stage = self.stages[stage_name]
+            song = song if stage.per_song else None
+            key = (stage_name, song)
+            if key in tasks:
+                return tasks[key]
+            depends = []
+            for dependency in stage.depends:
+                if self.stages[dependency].per_song and song is None:
+                    depends.extend(add(dependency, other) for other in self.songs)
+                else:
+                    depends.append(add(dependency, song))
+            tasks[key] = Task(stage, song, depends)
+            return tasks[key]
+
+        for name in targets or self.stages:
+            if self.stages[name].per_song:
+                for song in self.songs:
+                    add(name, song)
+            else:
+                add(name, None)
+        return list(tasks.values())
+
+    def is_stale(self, task):
+        record = self.state['tasks'].get(task.key)
+        if record is None or record['version'] != task.stage.version:
+            return True
+        outputs = task.outputs(self.songs)
+        if any(self.hasher(path) != record['outputs'].get(path) for path in outputs):
+            return True
+        inputs = {path: self.hasher(path) for path in task.inputs(self.songs)}
+        return inputs != record['inputs']
+
+    def plan(self, targets=None):
+        # 上流が作り直されるタスクは，今の入力が古くても作り直しに含める
+        stale = set()
+        for task in self._topological(self.tasks(targets)):
+            if task.key in stale or any(dependency.key in stale for dependency in task.depends) or self.is_stale(task):
+                stale.add(task.key)
+        return [task for task in self._topological(self.tasks(targets)) if task.key in stale]
+
+    def run(self, targets=None, dry_run=False):
+        pending = self.plan(targets)
+        print(f"{colored('Pipeline', 'blue')}: {len(pending)} stale tasks "
+              f"({', '.join(f'{name} x{count}' for name, count in self._count_by_stage(pending).items()) or 'nothing to do'})")
+        if dry_run or not pending:
+            return pending
+
+        planned = list(pending)
+        pending_keys = {task.key for task in pending}
+        done, failed = set(), set()
+        running = {}
+        cpu_used = 0
+        progress_bar = tqdm(total=len(pending), desc="Pipeline")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # 依存が全て終わり，CPU予算に収まるタスクから投入する(予算より重いタスクは単独なら走らせる)
+                for task in list(pending):
+                    blocked = [dependency.key for dependency in task.depends if dependency.key in pending_keys and dependency.key not in done]
+                    if any(key in failed for key in blocked):
+                        pending.remove(task)
+                        failed.add(task.key)
+                        progress_bar.update(1)
+                        continue
+                    if blocked:
+                        continue
+                    cpu = min(task.stage.cpu, self.cpu_budget)
+                    if cpu_used + cpu > self.cpu_budget or len(running) >= self.max_workers:
+                        continue
+                    pending.remove(task)
+                    cpu_used += cpu
+                    running[executor.submit(self._execute, task)] = (task, cpu)
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task, cpu = running.pop(future)
+                    cpu_used -= cpu
+                    progress_bar.update(1)
+                    try:
+                        future.result()
+                        done.add(task.key)
+                    except Exception as error:
+                        failed.add(task.key)
+                        print(f"{colored(task.key, 'red')}: {error}")
+                self._save_state()
+
+        progress_bar.close()
+        self._save_state()
+        print(f"{colored('Pipeline', 'blue')}: {len(done)} done, {len(failed)} failed")
+        # 実行した(失敗した依存のために飛ばしたものも含む)タスクを計画の順で返す
+        return [task for task in planned if task.key in done or task.key in failed]
+
+    def _execute(self, task):
+        task.execute(self.songs)
+        outputs = task.outputs(self.songs)
+        missing = [path for path in outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"missing outputs: {', '.join(missing)}")
+        record = {'version': task.stage.version,
+                  'inputs': {path: self.hasher(path) for path in task.inputs(self.songs)},
+                  'outputs': {path: self.hasher(path) for path in outputs}}
+        with self.lock:
+            self.state['tasks'][task.key] = record
+
+    def _topological(self, tasks):
+        ordered, seen = [], set()
+
+        def visit(task):
+            if task.key in seen:
+                return
+            seen.add(task.key)
+            for dependency in task.depends:
+                visit(dependency)
+            ordered.append(task)
+
+        for task in tasks:
+            visit(task)
+        return ordered
+
+    def _count_by_stage(self, tasks):
+        counts = {}
+        for task in tasks:
+            counts[task.stage.name] = counts.get(task.stage.name, 0) + 1
+        return counts
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as file:
+                return json.load(file)
+        return {'tasks': {}, 'hashes': {}}
+
+    def _save_state(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(self.state, file, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+
+
+def _check_call(cmd, **kwargs):
+    result = sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE, text=True, **kwargs)
+    if result.returncode != 0:
+        raise RuntimeError(f"{cmd[0]} failed: {result.stderr.strip()[-500:]}")
+
+def find_songs(song_directory):
+    if not os.path.isdir(song_directory):
+        print(f"{colored('Pipeline', 'blue')}: {song_directory} not found")
+        return []
+    return [os.path.splitext(file)[0] for file in os.listdir(song_directory) if file.endswith('.mp3')]
+
+def experiment_stage(module, process_mode, inputs, depends, cache_directory, cpu=1):
+    stamp = os.path.join(cache_directory, 'pipeline', f"{module}_{process_mode}.stamp")
+
+    def run(songs):
+        # 実験は別プロセスで動かし，図はAggで描画する
+        _check_call([sys.executable, "-c", f"import {module}; {module}.main({process_mode!r})"],
+                    cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, 'MPLBACKEND': 'Agg'})
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp, 'w') as file:
+            file.write(f"{len(songs)} songs\n")
+
+    return Stage(f"{module}:{process_mode}", inputs, lambda songs: [stamp], run, depends=depends, per_song=False, cpu=cpu)
+
+def default_stages(song_directory=const.PROD_SONG_DIRECTORY, wav_directory=const.PROD_WAV_DIRECTORY, allin1_directory=const.PROD_ALLIN1_DIRECTORY,
+                   json_directory=const.PROD_JSON_DIRECTORY, demucs_directory=const.PROD_DEMUCS_DIRECTORY, midi_directory=const.PROD_MIDI_DIRECTORY,
+                   cache_directory=const.PROD_CACHE_DIRECTORY):
+    mp3 = lambda song: os.path.join(song_directory, f"{song}.mp3")
+    wav = lambda song: os.path.join(wav_directory, f"{song}.wav")
+    raw_json = lambda song: os.path.join(allin1_directory, f"{song}.json")
+    formatted_json = lambda song: os.path.join(json_directory, f"{song}.json")
+    stems = lambda song: [os.path.join(demucs_directory, song, f"{component}.mp3") for component in COMPONENTS]
+    midi = lambda song: os.path.join(midi_directory, f"{song}.mid")
+
+    def to_wav(song):
+        os.makedirs(wav_directory, exist_ok=True)
+        _check_call(["ffmpeg", "-y", "-v", "error", "-i", mp3(song), wav(song)])
+
+    def analyze(song):
+        _check_call(["allin1", "-o", allin1_directory, wav(song)])
+
+    def separate(song):
+        AudioSeparator(mp3(song), os.path.dirname(demucs_directory), model=os.path.basename(demucs_directory)).separate()
+
+    def transcribe(song):
+        os.makedirs(midi_directory, exist_ok=True)
+        _check_call(["omnizart", "drum", "transcribe", mp3(song), "--output", midi(song)])
+
+    per_song_json = lambda songs: [formatted_json(song) for song in songs]
+    return [
+            Stage('ffmpeg', lambda song: [mp3(song)], lambda song: [wav(song)], to_wav),
+            Stage('allin1', lambda song: [wav(song)], lambda song: [raw_json(song)], analyze, depends=['ffmpeg'], cpu=4),
+            Stage('format', lambda song: [raw_json(song)], lambda song: [formatted_json(song)],
+                  lambda song: Allin1().format_file(raw_json(song), formatted_json(song)), depends=['allin1']),
+            Stage('separate', lambda song: [mp3(song)], stems, separate, cpu=4),
+            Stage('omnizart', lambda song: [mp3(song)], lambda song: [midi(song)], transcribe, cpu=2),
+            experiment_stage('experiment1', 'box', lambda songs: per_song_json(songs) + [mp3(song) for song in songs], ['format'], cache_directory),
+            experiment_stage('experiment2ex2', 'box', lambda songs: per_song_json(songs) + sum((stems(song) for song in songs), []),
+                             ['format', 'separate'], cache_directory),
+            experiment_stage('experiment4', 'combined', lambda songs: per_song_json(songs) + [midi(song) for song in songs], ['format', 'omnizart'], cache_directory),
+            experiment_stage('experiment5', 'distribution', lambda songs: per_song_json(songs) + [midi(song) for song in songs], ['format', 'omnizart'], cache_directory),
+            ]
+
+def main(process_mode):
+    song_directory = const.PROD_SONG_DIRECTORY
+    cache_directory = const.PROD_CACHE_DIRECTORY
+
+    pipeline = Pipeline(default_stages(), find_songs(song_directory), os.path.join(cache_directory, 'pipeline', 'state.json'))
+    if process_mode == 'plan':
+        pipeline.run(dry_run=True)
+    elif process_mode == 'run':
+        pipeline.run()
+
+if __name__ == "__main__":
+    process_mode = 'plan'  # 'plan' | 'run'
+    main(process_mode)
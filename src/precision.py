@@ -0,0 +1,119 @@
+from external_libraries import *
+
+SECTION_LABELS = ['intro', 'drop', 'break', 'outro']
+# フレーム単位の特徴量は小さい型で持ち，和や平均はfloat64で計算する(曲ごとの集計値はfloat32)
+PRECISION_POLICY = {'storage': np.float32, 'summary': np.float32, 'accumulate': np.float64}
+
+def set_storage_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float16, np.float32, np.float64):
+        raise ValueError(f"Unsupported storage dtype: {dtype}")
+    PRECISION_POLICY['storage'] = dtype.type
+
+def to_storage(values):
+    return np.asarray(values).astype(PRECISION_POLICY['storage'], copy=False)
+
+def as_float_array(values, dtype=np.float64):
+    # リスト・配列・FloatColumnのどれでも受け取り，None/nanを除いた配列にする
+    array = np.asarray(values)
+    if array.dtype == object:
+        array = np.asarray([value for value in values if value is not None], dtype=dtype)
+    array = array.astype(dtype, copy=False).reshape(-1)
+    return array[~np.isnan(array)]
+
+def section_means(sections, feature_values, times, labels=SECTION_LABELS):
+    # セクションごとのフレーム平均を累積和の差で求め，ラベルごとにセクション平均の平均をとる
+    values = np.asarray(feature_values).reshape(-1)
+    times = np.asarray(times).reshape(-1)
+    label_index = {label: i for i, label in enumerate(labels)}
+    rows = [(label_index[section['label']], section['start'], section['end']) for section in sections if section['label'] in label_index]
+    if not rows or not len(values):
+        return {}
+
+    label_ids, starts, ends = (np.array(column) for column in zip(*rows))
+    # np.argmax(times >= t) と同じく，該当なしは0(終了側はさらに末尾)とみなす
+    start_index = np.searchsorted(times, starts, side='left')
+    start_index[start_index == len(times)] = 0
+    end_index = np.searchsorted(times, ends, side='left')
+    end_index[(end_index == len(times)) | (end_index == 0)] = len(values)
+    start_index = np.minimum(start_index, len(values))
+    end_index = np.minimum(end_index, len(values))
+
+    cumulative = np.zeros(len(values) + 1, dtype=PRECISION_POLICY['accumulate'])
+    np.cumsum(values, dtype=PRECISION_POLICY['accumulate'], out=cumulative[1:])
+    lengths = end_index - start_index
+    valid = lengths > 0
+    means = (cumulative[end_index[valid]] - cumulative[start_index[valid]]) / lengths[valid]
+    sums = np.bincount(label_ids[valid], weights=means, minlength=len(labels))
+    counts = np.bincount(label_ids[valid], minlength=len(labels))
+    return {label: float(sums[i] / counts[i]) for i, label in enumerate(labels) if counts[i]}
+
+
+# appendできる連続配列．リストの代わりに使い，値1つあたりdtypeの大きさしか使わない
+class FloatColumn:
+    __slots__ = ('data', 'size')
+
+    def __init__(self, capacity=64, dtype=None):
+        self.data = np.empty(capacity, dtype=dtype or PRECISION_POLICY['summary'])
+        self.size = 0
+
+    def append(self, value):
+        if value is None:
+            return
+        if self.size == len(self.data):
+            self._grow(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = as_float_array(values, self.data.dtype)
+        if self.size + len(values) > len(self.data):
+            self._grow(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def _grow(self, needed):
+        data = np.empty(max(needed, 2 * len(self.data), 16), dtype=self.data.dtype)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+    def __repr__(self):
+        return f"FloatColumn({self.values!r})"
+
+
+# {ラベル: 値の列} の辞書．これまでの {ラベル: []} と同じように使える
+class SectionAccumulator(dict):
+    def __init__(self, labels=SECTION_LABELS, capacity=64, dtype=None):
+        super().__init__({label: FloatColumn(capacity, dtype) for label in labels})
+
+    def add(self, section_averages):
+        for label, value in section_averages.items():
+            if label in self:
+                self[label].append(value)
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.values())
+
+    def as_arrays(self, dtype=None):
+        return {label: np.array(column, dtype=dtype) for label, column in self.items()}
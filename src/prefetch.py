@@ -0,0 +1,128 @@
+from external_libraries import *
+import data_const as const
+from audio_io import load_audio, load_analysis_audio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+# デコード(I/O)を計算の裏で先読みするプロデューサ/コンシューマ段
+class PrefetchLoader:
+    def __init__(self, load_fn, max_workers=4, prefetch=8, memory_budget=2 * 1024 ** 3):
+        self.load_fn = load_fn
+        self.max_workers = max_workers
+        self.prefetch = max(prefetch, 1)
+        self.memory_budget = memory_budget
+        self.metrics = PrefetchMetrics()
+        self._lock = threading.Lock()
+
+    def iterate(self, items):
+        items = iter(items)
+        pending = deque()
+        state = {'exhausted': False, 'bytes_ready': 0, 'loaded': 0, 'loaded_bytes': 0}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def refill():
+                with self._lock:
+                    while not state['exhausted'] and self._has_room(pending, state):
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            state['exhausted'] = True
+                            break
+                        job = {'item': item, 'future': None, 'nbytes': 0}
+                        job['future'] = executor.submit(self._load, job, state, refill)
+                        pending.append(job)
+
+            refill()
+            try:
+                while pending:
+                    job = pending[0]
+                    with self._lock:
+                        self.metrics.record_depth(sum(j['future'].done() for j in pending), len(pending), state['bytes_ready'])
+
+                    wait_start = time.perf_counter()
+                    result = job['future'].result()
+                    self.metrics.wait_time += time.perf_counter() - wait_start
+
+                    with self._lock:
+                        pending.popleft()
+                    yield job['item'], result
+
+                    with self._lock:
+                        state['bytes_ready'] -= job['nbytes']
+                    refill()
+            finally:
+                with self._lock:
+                    state['exhausted'] = True
+                    for job in pending:
+                        job['future'].cancel()
+
+    def _has_room(self, pending, state):
+        if not pending:
+            return True
+        if len(pending) >= self.prefetch:
+            return False
+        # 未完了ジョブのサイズはこれまでの平均で見積もる
+        average = state['loaded_bytes'] / state['loaded'] if state['loaded'] else 0
+        in_flight = sum(1 for job in pending if not job['future'].done())
+        return state['bytes_ready'] + average * (in_flight + 1) <= self.memory_budget
+
+    def _load(self, job, state, refill):
+        start = time.perf_counter()
+        result = self.load_fn(job['item'])
+        nbytes = _nbytes(result)
+        with self._lock:
+            job['nbytes'] = nbytes
+            state['bytes_ready'] += nbytes
+            state['loaded'] += 1
+            state['loaded_bytes'] += nbytes
+            self.metrics.decode_time += time.perf_counter() - start
+            self.metrics.peak_bytes = max(self.metrics.peak_bytes, state['bytes_ready'])
+        refill()
+        return result
+
+
+class PrefetchMetrics:
+    def __init__(self):
+        self.ready_depths = []
+        self.pending_depths = []
+        self.peak_bytes = 0
+        self.wait_time = 0.0
+        self.decode_time = 0.0
+
+    def record_depth(self, ready, pending, bytes_ready):
+        self.ready_depths.append(ready)
+        self.pending_depths.append(pending)
+        self.peak_bytes = max(self.peak_bytes, bytes_ready)
+
+    def summary(self):
+        ready = np.array(self.ready_depths) if self.ready_depths else np.zeros(1)
+        return {
+                'items': len(self.ready_depths),
+                'mean_ready_depth': float(ready.mean()),
+                'starved_ratio': float(np.mean(ready == 0)),
+                'max_pending_depth': max(self.pending_depths, default=0),
+                'peak_bytes': self.peak_bytes,
+                'consumer_wait_time': self.wait_time,
+                'decode_time': self.decode_time,
+                }
+
+    def print_summary(self):
+        for key, value in self.summary().items():
+            print(f"{colored('prefetch', 'blue')}: {key} = {value}")
+
+
+def load_stems(stem_paths, components, sr=const.ANALYSIS_SR, cache=True):
+    # cache=False は自前で保存する側(PackedAudioStoreなど)が使う
+    load = load_analysis_audio if cache else lambda path, sr: load_audio(path, sr=sr)
+    return {component: load(stem_paths[component], sr=sr) for component in components if component in stem_paths}
+
+def _nbytes(result):
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(_nbytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(_nbytes(value) for value in result)
+    return 0
@@ -0,0 +1,108 @@
+from external_libraries import *
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from instrumentation import profile
+from precision import as_float_array
+
+# (リサンプル数, 標本数) の行列を受け取り，行ごとの統計量を返す
+STATISTICS = {
+        'mean_diff': lambda a, b: a.mean(axis=1) - b.mean(axis=1),
+        'median_diff': lambda a, b: np.median(a, axis=1) - np.median(b, axis=1),
+        }
+
+def worker_pool(max_workers=None):
+    # withを抜けるとワーカーも終わる．複数回の検定で使い回す時は呼び出し側で開いてexecutorに渡す
+    return nullcontext() if max_workers == 1 else ProcessPoolExecutor(max_workers=max_workers)
+
+def _clean(values):
+    return as_float_array(values)
+
+def _seed_sequence(seed):
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+def _block_sizes(n_resamples, block_size):
+    return [min(block_size, n_resamples - start) for start in range(0, n_resamples, block_size)]
+
+def _permutation_block(a, b, statistic, observed, seed, size):
+    # 並べ替えのインデックス行列をブロック単位で作り，統計量をまとめて計算する
+    rng = np.random.default_rng(seed)
+    pooled = np.concatenate([a, b])
+    index = rng.permuted(np.broadcast_to(np.arange(len(pooled)), (size, len(pooled))), axis=1)
+    resampled = pooled[index]
+    values = STATISTICS[statistic](resampled[:, :len(a)], resampled[:, len(a):])
+    return int(np.count_nonzero(np.abs(values) >= np.abs(observed) - 1e-12))
+
+def _bootstrap_block(a, b, statistic, seed, size):
+    rng = np.random.default_rng(seed)
+    a_index = rng.integers(0, len(a), size=(size, len(a)))
+    b_index = rng.integers(0, len(b), size=(size, len(b)))
+    return STATISTICS[statistic](a[a_index], b[b_index])
+
+def _run_blocks(fn, arguments, executor):
+    if executor is None:
+        return [fn(*args) for args in arguments]
+    return list(executor.map(fn, *zip(*arguments)))
+
+def permutation_test(a, b, statistic='mean_diff', n_resamples=10000, block_size=1000, seed=0, executor=None):
+    a, b = _clean(a), _clean(b)
+    observed = float(STATISTICS[statistic](a[None, :], b[None, :])[0])
+    sizes = _block_sizes(n_resamples, block_size)
+    # ブロックごとに子シードを割り当てるので，ワーカー数に関係なく同じ結果になる
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    counts = _run_blocks(_permutation_block, [(a, b, statistic, observed, s, size) for s, size in zip(seeds, sizes)], executor)
+    return observed, (1 + sum(counts)) / (1 + n_resamples)
+
+def bootstrap_ci(a, b, statistic='mean_diff', n_resamples=10000, block_size=1000, seed=0, confidence=0.95, executor=None):
+    a, b = _clean(a), _clean(b)
+    sizes = _block_sizes(n_resamples, block_size)
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    values = np.concatenate(_run_blocks(_bootstrap_block, [(a, b, statistic, s, size) for s, size in zip(seeds, sizes)], executor))
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(values, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+@profile('stats')
+def section_effects(all_section_averages, pairs=None, statistic='mean_diff', n_resamples=10000, block_size=1000, seed=0,
+                    confidence=0.95, max_workers=None, executor=None):
+    if executor is None:
+        with worker_pool(max_workers) as executor:
+            return _section_effects(all_section_averages, pairs, statistic, n_resamples, block_size, seed, confidence, executor)
+    return _section_effects(all_section_averages, pairs, statistic, n_resamples, block_size, seed, confidence, executor)
+
+def _section_effects(all_section_averages, pairs, statistic, n_resamples, block_size, seed, confidence, executor):
+    sections = [section for section, values in all_section_averages.items() if len(_clean(values)) > 1]
+    pairs = pairs or list(combinations(sections, 2))
+    # 組ごとに別の子シードを使う
+    pair_seeds = _seed_sequence(seed).spawn(len(pairs))
+
+    results = {}
+    for (first, second), pair_seed in zip(pairs, pair_seeds):
+        permutation_seed, bootstrap_seed = pair_seed.spawn(2)
+        a, b = _clean(all_section_averages.get(first, [])), _clean(all_section_averages.get(second, []))
+        # 値が1つ以下のセクションを含む組は検定できないのでnanにする(pairsを指定した時も同じ)
+        if len(a) < 2 or len(b) < 2:
+            results[(first, second)] = {'statistic': np.nan, 'p': np.nan, 'ci': (np.nan, np.nan)}
+            continue
+        observed, p = permutation_test(a, b, statistic, n_resamples, block_size, permutation_seed, executor)
+        ci = bootstrap_ci(a, b, statistic, n_resamples, block_size, bootstrap_seed, confidence, executor)
+        results[(first, second)] = {'statistic': observed, 'p': p, 'ci': ci}
+    return results
+
+def print_section_effects(results, title=None, confidence=0.95):
+    if title:
+        print(colored(title, 'blue'))
+    print(f"{'pair':>16} {'diff':>12} {'p':>10} {f'{confidence:.0%} CI':>26}")
+    for (first, second), result in results.items():
+        low, high = result['ci']
+        print(f"{first + ' - ' + second:>16} {result['statistic']:12.4g} {result['p']:10.4g} [{low:11.4g}, {high:11.4g}]")
+
+def perform_resampling_tests(all_section_averages, title=None, **params):
+    results = section_effects(all_section_averages, **params)
+    print_section_effects(results, title, params.get('confidence', 0.95))
+    return results
+
+def perform_resampling_tests_by_component(component_averages, max_workers=None, **params):
+    # コンポーネントごとにワーカーを起動し直さないよう，1つのプールを全コンポーネントで使う
+    with worker_pool(max_workers) as executor:
+        return {component: perform_resampling_tests(section_averages, title=component, executor=executor, **params)
+                for component, section_averages in component_averages.items()}
@@ -0,0 +1,60 @@
+from external_libraries import *
+import atexit
+import threading
+
+# 実験の検定結果・集計値をそのままの形で残す(標準出力の文字列を後から拾わなくて済むように)
+class ResultLog:
+    def __init__(self, path=None):
+        self.path = path
+        self.tests = {}
+        self.values = {}
+        self.tables = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def test(self, name, statistic, p, groups=None, dunn=None):
+        with self.lock:
+            self.tests[name] = {'statistic': float(statistic), 'p': float(p), 'groups': None if groups is None else list(groups),
+                                'dunn': None if dunn is None else np.asarray(dunn, dtype=np.float64).tolist()}
+
+    def value(self, name, value):
+        with self.lock:
+            self.values[name] = float(value)
+
+    def table(self, name, rows):
+        # {行: {列: 数値}} (ドラムの要素ごとの打数など)
+        with self.lock:
+            self.tables[name] = {str(row): {str(column): float(value) for column, value in columns.items()} for row, columns in rows.items()}
+
+    def sample(self, name, values):
+        with self.lock:
+            self.samples[name] = [float(value) for value in values]
+
+    def to_dict(self):
+        with self.lock:
+            return {'tests': dict(self.tests), 'values': dict(self.values), 'tables': dict(self.tables), 'samples': dict(self.samples)}
+
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=4, allow_nan=True)
+        os.replace(tmp_path, path)
+
+
+# 環境変数 RESULTS_JSON にパスを渡すと，終了時にそこへ書き出す(subset.pyが実験ごとに設定する)
+RESULTS = ResultLog(os.environ.get('RESULTS_JSON') or None)
+record_test = RESULTS.test
+record_value = RESULTS.value
+record_table = RESULTS.table
+record_sample = RESULTS.sample
+
+if RESULTS.enabled:
+    atexit.register(RESULTS.save)
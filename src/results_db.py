@@ -0,0 +1,143 @@
+from external_libraries import *
+from precision import SectionAccumulator
+import hashlib
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS section_values (
+    params TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    song TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    section TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (params, feature, song, stem, section)
+);
+CREATE TABLE IF NOT EXISTS computed_songs (
+    params TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    song TEXT NOT NULL,
+    song_hash TEXT,
+    PRIMARY KEY (params, feature, song)
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    params TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS test_results (
+    params TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    study TEXT NOT NULL,
+    test TEXT NOT NULL,
+    statistic REAL,
+    p REAL,
+    detail TEXT,
+    created REAL NOT NULL
+);
+"""
+
+# 曲ごとのセクション集計値をSQLiteに貯め，次回は足りない曲だけ計算する
+class ResultsStore:
+    def __init__(self, path, batch_size=1000):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._values = []
+        self._computed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def params_hash(params):
+        encoded = json.dumps(params, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+    def register_params(self, params):
+        key = self.params_hash(params)
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO parameters VALUES (?, ?)", (key, json.dumps(params, sort_keys=True, default=str)))
+        return key
+
+    def computed_songs(self, feature, params):
+        rows = self.connection.execute("SELECT song, song_hash FROM computed_songs WHERE params = ? AND feature = ?", (params, feature))
+        return dict(rows.fetchall())
+
+    def missing(self, entries, feature, params):
+        # ハッシュが変わった曲(JSONや音源が更新された曲)も計算し直す
+        computed = self.computed_songs(feature, params)
+        return [entry for entry in entries if computed.get(entry['song_name'], object()) != entry.get('hash')]
+
+    def add(self, song, stem, feature, section, value, params):
+        self._values.append((params, feature, song, stem, section, float(value)))
+
+    def mark_computed(self, song, feature, params, song_hash=None):
+        # 曲の区切りでだけ書き込むので，1曲分の値が別々のトランザクションに分かれることはない
+        self._computed.append((params, feature, song, song_hash))
+        if len(self._values) >= self.batch_size or len(self._computed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._values and not self._computed:
+            return
+        # 1回のトランザクションでまとめて書き込む
+        with self.connection:
+            songs = {(params, feature, song) for params, feature, song, _ in self._computed}
+            self.connection.executemany("DELETE FROM section_values WHERE params = ? AND feature = ? AND song = ?", sorted(songs))
+            self.connection.executemany("INSERT OR REPLACE INTO section_values VALUES (?, ?, ?, ?, ?, ?)", self._values)
+            self.connection.executemany("INSERT OR REPLACE INTO computed_songs VALUES (?, ?, ?, ?)", self._computed)
+        self._values, self._computed = [], []
+
+    def purge(self, feature, params, songs):
+        # 目録から消えた曲(削除・差し替え)の値と計算済みの印を消す
+        songs = set(songs)
+        stale = [song for song in self.computed_songs(feature, params) if song not in songs]
+        stale += [song for (song,) in self.connection.execute("SELECT DISTINCT song FROM section_values WHERE params = ? AND feature = ?", (params, feature))
+                  if song not in songs and song not in stale]
+        with self.connection:
+            for table in ('section_values', 'computed_songs'):
+                self.connection.executemany(f"DELETE FROM {table} WHERE params = ? AND feature = ? AND song = ?",
+                                            [(params, feature, song) for song in stale])
+        return stale
+
+    def section_values(self, feature, params, stem='mix', sections=('intro', 'drop', 'break', 'outro'), songs=None):
+        # songsを渡すとその曲の値だけを返す(今の目録に無い曲を検定に混ぜない)
+        songs = None if songs is None else set(songs)
+        values = SectionAccumulator(sections)
+        rows = self.connection.execute("SELECT song, section, value FROM section_values WHERE params = ? AND feature = ? AND stem = ? ORDER BY song",
+                                       (params, feature, stem))
+        for song, section, value in rows:
+            if section in values and (songs is None or song in songs):
+                values[section].append(value)
+        return values
+
+    def component_values(self, feature, params, stems, sections=('intro', 'drop', 'break', 'outro'), songs=None):
+        return {stem: self.section_values(feature, params, stem, sections, songs) for stem in stems}
+
+    def add_test_results(self, feature, params, results, test='kruskal_dunn'):
+        rows = [(params, feature, study, test, float(result['H']), float(result['p']),
+                 json.dumps({'groups': result['groups'], 'dunn': None if result['dunn'] is None else np.asarray(result['dunn']).tolist()}),
+                 time.time())
+                for study, result in results.items()]
+        with self.connection:
+            self.connection.executemany("INSERT INTO test_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def test_results(self, feature, params, test='kruskal_dunn'):
+        # 検定ごとに最新の結果だけを返す
+        rows = self.connection.execute("SELECT study, statistic, p, detail FROM test_results WHERE params = ? AND feature = ? AND test = ? ORDER BY created",
+                                       (params, feature, test))
+        return {study: {'statistic': statistic, 'p': p, **json.loads(detail)} for study, statistic, p, detail in rows}
+
+    def close(self):
+        # 計算済みの印が付いていない途中の値は捨てる(次回その曲は計算し直す)
+        self._values = [row for row in self._values if (row[0], row[1], row[2]) in {(p, f, s) for p, f, s, _ in self._computed}]
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,165 @@
+from external_libraries import *
+from modules import *
+import data_const as const
+from manifest import CorpusManifest
+from audio_io import load_audio, load_analysis_audio
+from precision import SECTION_LABELS, section_means
+from stats import GroupedSamples, kruskal_wallis
+from experiment3 import calculate_section_rms
+
+COMPONENTS = ['bass', 'drums', 'other', 'vocals']
+# 各実験が以前読み込んでいたレート(Noneは元ファイルのまま)と，今の解析用レート
+RATE_CHANGES = [
+        {'name': 'experiment1:spectral_centroid', 'source': 'mix', 'legacy_sr': None, 'sr': const.SPECTRAL_SR,
+         'feature': 'spectral_centroid', 'params': {'n_fft': 2048 * 2}},
+        {'name': 'experiment1ex:rms', 'source': 'mix', 'legacy_sr': 22050, 'sr': const.ANALYSIS_SR, 'feature': 'rms', 'params': {}},
+        {'name': 'experiment2:spectral_centroid', 'source': 'stems', 'legacy_sr': None, 'sr': const.SPECTRAL_SR,
+         'feature': 'spectral_centroid', 'params': {}},
+        {'name': 'experiment2ex:rms', 'source': 'stems', 'legacy_sr': None, 'sr': const.ANALYSIS_SR, 'feature': 'rms', 'params': {}},
+        {'name': 'experiment2ex2:rms', 'source': 'stems', 'legacy_sr': 22050, 'sr': const.ANALYSIS_SR, 'feature': 'rms', 'params': {}},
+        # bass/drumsは元のレートのまま，otherはpydubでvocalsと重ねたものを読んでいた(_legacy_audio参照)
+        {'name': 'experiment3:rms', 'source': 'experiment3', 'legacy_sr': None, 'sr': const.ANALYSIS_SR, 'feature': 'section_rms', 'params': {}},
+        {'name': 'RMS:rms', 'source': 'mix', 'legacy_sr': 44100, 'sr': const.SPECTRAL_SR, 'feature': 'rms',
+         'params': {'frame_length': 65000, 'hop_length': 16250}},
+        ]
+# セクション平均の相対差の中央値がこれを超えるか，検定の有意/非有意が入れ替わったら「変化あり」とする
+RELATIVE_TOLERANCE = 1e-3
+
+def _streams(entry, source):
+    # (ストリーム名, 足し合わせるファイル, 旧処理での読み込み方) の組
+    if source == 'mix':
+        return [('mix', [entry['mix']], 'load_audio')] if entry.get('mix') else []
+    stems = entry.get('stems', {})
+    if source == 'experiment3':
+        parts = {'bass': ['bass'], 'drums': ['drums'], 'other': ['other', 'vocals']}
+        return [(part, [stems[name] for name in names], 'pydub_overlay' if len(names) > 1 else 'load_audio')
+                for part, names in parts.items() if all(name in stems for name in names)]
+    return [(component, [stems[component]], 'load_audio') for component in COMPONENTS if component in stems]
+
+def _mix(signals):
+    length = min(len(y) for y, _ in signals)
+    return sum(y[:length] for y, _ in signals), signals[0][1]
+
+def legacy_pydub_overlay(file1_path, file2_path):
+    # 以前のexperiment3の重ね合わせ(元のレートのままpydubのoverlayで重ねる)
+    # (int16で飽和する足し算で，ステレオのサンプルが交互に並んだ列を44100Hzのモノラルとして扱っていた)
+    sound1 = AudioSegment.from_file(file1_path)
+    sound2 = AudioSegment.from_file(file2_path)
+    combined = sound1.overlay(sound2)
+    return np.array(combined.get_array_of_samples(), dtype=np.float32) / (2**15), 44100
+
+def _legacy_audio(paths, sr, loader):
+    # 戻り値の最後は近似かどうか(pydubが使えない環境では44100Hzのモノラルの和で代用する)
+    if loader == 'pydub_overlay':
+        try:
+            return (*legacy_pydub_overlay(*paths), False)
+        except Exception as error:
+            print(f"{colored('pydub', 'red')}: {error}; using a 44100 Hz mono sum instead")
+            return (*_mix([load_audio(path, sr=44100) for path in paths]), True)
+    return (*_mix([load_audio(path, sr=sr) for path in paths]), False)
+
+def _section_feature(y, sr, sections, feature, params):
+    if feature == 'section_rms':
+        # experiment3と同じく，セクションごとに切り出した区間のRMSをラベルごとに平均する
+        return {label: float(np.mean(values)) for label, values in calculate_section_rms(y, sr, sections).items() if label in SECTION_LABELS}
+    values = Song.FEATURES[feature](y, sr, **params)
+    times = librosa.times_like(values, sr=sr, hop_length=params.get('hop_length', 512))
+    return section_means(sections, values, times)
+
+def compare_song(entry, sections, specs=RATE_CHANGES):
+    # 1曲分について，旧レートと解析用レートのセクション平均を並べる
+    legacy_audio, canonical_audio = {}, {}
+    rows = []
+    for spec in specs:
+        for stream, paths, loader in _streams(entry, spec['source']):
+            legacy_key, canonical_key = (tuple(paths), spec['legacy_sr'], loader), (tuple(paths), spec['sr'])
+            if legacy_key not in legacy_audio:
+                legacy_audio[legacy_key] = _legacy_audio(paths, spec['legacy_sr'], loader)
+            if canonical_key not in canonical_audio:
+                canonical_audio[canonical_key] = _mix([load_analysis_audio(path, sr=spec['sr']) for path in paths])
+            (legacy_y, legacy_sr, approximate), (y, sr) = legacy_audio[legacy_key], canonical_audio[canonical_key]
+            legacy = _section_feature(legacy_y, legacy_sr, sections, spec['feature'], spec['params'])
+            canonical = _section_feature(y, sr, sections, spec['feature'], spec['params'])
+            for label in legacy.keys() & canonical.keys():
+                rows.append({'feature': spec['name'], 'stream': stream, 'song': entry['song_name'], 'label': label,
+                             'legacy_sr': legacy_sr, 'sr': sr, 'legacy': legacy[label], 'canonical': canonical[label],
+                             'approximate': approximate})
+    return rows
+
+def _kruskal_p(rows, column):
+    studies = {'p': {label: [row[column] for row in rows if row['label'] == label] for label in SECTION_LABELS}}
+    return float(kruskal_wallis(GroupedSamples(studies))['p'][0])
+
+def summarize(rows, alpha=0.05):
+    summary = []
+    for key in dict.fromkeys((row['feature'], row['stream']) for row in rows):
+        group = [row for row in rows if (row['feature'], row['stream']) == key]
+        legacy = np.array([row['legacy'] for row in group])
+        canonical = np.array([row['canonical'] for row in group])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.abs(canonical - legacy) / np.abs(legacy)
+        relative = relative[np.isfinite(relative)]
+        legacy_p, p = _kruskal_p(group, 'legacy'), _kruskal_p(group, 'canonical')
+        median = float(np.median(relative)) if len(relative) else 0.0
+        summary.append({'feature': key[0], 'stream': key[1], 'n': len(group),
+                        'legacy_sr': sorted({row['legacy_sr'] for row in group}), 'sr': group[0]['sr'],
+                        'median_relative_diff': median, 'max_relative_diff': float(np.max(relative)) if len(relative) else 0.0,
+                        'correlation': float(np.corrcoef(legacy, canonical)[0, 1]) if len(group) > 1 and np.std(legacy) > 0 else np.nan,
+                        'legacy_p': legacy_p, 'p': p, 'approximate': any(row.get('approximate') for row in group),
+                        'changed': median > RELATIVE_TOLERANCE or ((legacy_p < alpha) != (p < alpha))})
+    return summary
+
+def print_report(summary):
+    print(colored('Sample rate validation', 'blue'))
+    print(f"{'feature':>30} {'stream':>7} {'n':>5} {'legacy sr':>12} {'sr':>6} {'median rel':>11} {'max rel':>9} {'corr':>7} "
+          f"{'legacy p':>9} {'p':>9}  changed")
+    for row in summary:
+        legacy_sr = '/'.join(str(sr) for sr in row['legacy_sr'])
+        print(f"{row['feature']:>30} {row['stream']:>7} {row['n']:5d} {legacy_sr:>12} {row['sr']:6d} {row['median_relative_diff']:11.2e} "
+              f"{row['max_relative_diff']:9.2e} {row['correlation']:7.4f} {row['legacy_p']:9.2e} {row['p']:9.2e}  "
+              f"{colored('yes', 'red') if row['changed'] else 'no'}{' *' if row['approximate'] else ''}")
+    if any(row['approximate'] for row in summary):
+        # pydubが使えず旧処理をそのまま再現できなかった行
+        print(f"{colored('*', 'yellow')} approximate: legacy pydub overlay unavailable, compared against a 44100 Hz mono sum")
+
+def validate(manifest, allin1=None, specs=RATE_CHANGES, max_songs=None, report_directory=None):
+    allin1 = allin1 or Allin1()
+    entries = [entry for entry in manifest.songs() if entry.get('mix') or entry.get('stems')][:max_songs]
+    if not entries:
+        print(f"{colored('Sample rate validation', 'blue')}: no songs with audio")
+        return []
+
+    rows = []
+    for entry in tqdm(entries, desc="Validating sample rates"):
+        with song_context(entry['song_name']):
+            rows.extend(compare_song(entry, allin1.load_section_data(entry['json'])['segments'], specs))
+    summary = summarize(rows)
+    print_report(summary)
+
+    if report_directory is not None:
+        os.makedirs(report_directory, exist_ok=True)
+        pd.DataFrame(rows).to_csv(os.path.join(report_directory, 'sections.csv'), index=False)
+        with open(os.path.join(report_directory, 'summary.json'), 'w') as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+    return summary
+
+def main(process_mode):
+    json_directory = const.PROD_JSON_DIRECTORY
+    song_directory = const.PROD_SONG_DIRECTORY
+    demucs_directory = const.PROD_DEMUCS_DIRECTORY
+    cache_directory = const.PROD_CACHE_DIRECTORY
+
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, song_directory=song_directory, demucs_directory=demucs_directory)
+    if process_mode == 'validate':
+        validate(manifest, report_directory=os.path.join(cache_directory, 'sample_rate'))
+    elif process_mode == 'ingest':
+        # 全曲を解析用のレートで一度だけリサンプルしてキャッシュに置く
+        for entry in tqdm(manifest.songs(), total=len(manifest), desc="Resampling"):
+            paths = ([entry['mix']] if entry.get('mix') else []) + list(entry.get('stems', {}).values())
+            for path in paths:
+                for sr in (const.ANALYSIS_SR, const.SPECTRAL_SR):
+                    load_analysis_audio(path, sr=sr)
+
+if __name__ == "__main__":
+    process_mode = 'validate'  # 'validate' | 'ingest'
+    main(process_mode)
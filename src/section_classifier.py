@@ -0,0 +1,261 @@
+from external_libraries import *
+from modules import *
+import data_const as const
+from manifest import CorpusManifest
+import time
+
+SECTION_LABELS = ['intro', 'drop', 'break', 'outro']
+DRUM_NOTES = [35, 38, 42]
+KICK_NOTES = [35, 36]
+BEAT_HOP_LENGTH = 512
+
+def drum_onset_envelope(drum_events, end, sr=const.ANALYSIS_SR, hop_length=BEAT_HOP_LENGTH):
+    # ドラムMIDIの発音をフレームごとに数えたものをオンセット強度の代わりにする
+    envelope = np.zeros(int(np.ceil(end * sr / hop_length)) + 1)
+    for event in drum_events.values():
+        frames = np.round(np.asarray(event['times'], dtype=np.float64) * sr / hop_length).astype(np.int64)
+        np.add.at(envelope, frames[(frames >= 0) & (frames < len(envelope))], 1.0)
+    return envelope
+
+def estimate_bar_grid(song, beats_per_bar=4, tolerance=0.07):
+    # allin1の拍を使わずに小節線を求める．ミックスがあれば音声から，無ければドラムMIDIの発音から拍を追跡する
+    # (omnizartのMIDIのテンポマップは120BPM固定なので使えない)
+    drum_events = song.drum_events or {}
+    last_onset = max((max(event['times']) for event in drum_events.values() if event['times']), default=0.0)
+    end = song.duration or last_onset
+    if song.has_audio():
+        y, sr = song.mix
+        envelope = librosa.onset.onset_strength(y=y, sr=sr, hop_length=BEAT_HOP_LENGTH)
+    else:
+        sr = const.ANALYSIS_SR
+        envelope = drum_onset_envelope(drum_events, end, sr)
+    if not np.any(envelope):
+        return BeatSync([], [], end)
+    _, beats = librosa.beat.beat_track(onset_envelope=envelope, sr=sr, hop_length=BEAT_HOP_LENGTH, units='time')
+
+    # 4/4拍子とし，キックが最も多く重なる拍を小節の頭にする
+    kicks = np.concatenate([np.asarray(drum_events[note]['times'], dtype=np.float64) for note in KICK_NOTES if note in drum_events] or [np.zeros(0)])
+    phase = max(range(beats_per_bar), key=lambda phase: _count_near(kicks, beats[phase::beats_per_bar], tolerance))
+    return BeatSync(beats, beats[phase::beats_per_bar], end)
+
+def _count_near(onsets, grid, tolerance):
+    if not len(onsets) or not len(grid):
+        return 0
+    index = np.searchsorted(grid, onsets)
+    left = grid[np.clip(index - 1, 0, len(grid) - 1)]
+    right = grid[np.clip(index, 0, len(grid) - 1)]
+    return int(np.sum(np.minimum(np.abs(onsets - left), np.abs(onsets - right)) <= tolerance))
+
+def unlabeled_songs(midi_directory=const.PROD_MIDI_DIRECTORY, song_directory=const.PROD_SONG_DIRECTORY):
+    # allin1のJSONが無い曲も含め，MIDIかミックスのある曲をすべて推定の対象にする
+    def scan(directory, extension):
+        if directory is None or not os.path.isdir(directory):
+            return {}
+        return {os.path.splitext(name)[0]: os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(extension)}
+
+    midi_files, mix_files = scan(midi_directory, '.mid'), scan(song_directory, '.mp3')
+    return [Song({'song_name': song_name, 'json': None, 'mix': mix_files.get(song_name), 'midi': midi_files.get(song_name), 'stems': {}})
+            for song_name in sorted(midi_files.keys() | mix_files.keys())]
+
+
+# allin1を回さずに，小節単位の特徴量から多クラスロジスティック回帰でセクションを推定する
+# grid='estimated' なら小節線も拍追跡で求めるので，allin1の通っていない曲にも使える('allin1'は比較用)
+class SectionClassifier:
+    def __init__(self, labels=SECTION_LABELS, stems=(), context=4, l2=1e-2, learning_rate=0.5, n_iter=500, grid='estimated'):
+        if grid not in ('estimated', 'allin1'):
+            raise ValueError(f"Unknown bar grid: {grid}")
+        self.grid = grid
+        self.labels = list(labels)
+        self.stems = tuple(stems)
+        self.context = context
+        self.l2 = l2
+        self.learning_rate = learning_rate
+        self.n_iter = n_iter
+        self.mean = None
+        self.std = None
+        self.weights = None
+        self._grids = {}
+
+    def bar_grid(self, song):
+        if song.name not in self._grids:
+            self._grids[song.name] = song.beat_sync if self.grid == 'allin1' else estimate_bar_grid(song)
+        return self._grids[song.name]
+
+    def bar_features(self, song):
+        beat_sync = self.bar_grid(song)
+        n_bars = len(beat_sync.downbeats)
+        if n_bars == 0:
+            return np.zeros((0, self.n_features), dtype=np.float32)
+
+        drum_counts = {note: beat_sync.count(event['times'], 'bar') for note, event in (song.drum_events or {}).items()}
+        density = np.stack([drum_counts.get(note, np.zeros(n_bars)) for note in DRUM_NOTES]).astype(np.float64)
+        density = np.vstack([density, sum(drum_counts.values(), np.zeros(n_bars))[None, :]])
+        columns = [np.log1p(density)]
+        # 曲ごとの平均に対する相対値(曲全体の音数の多さに左右されないように)
+        columns.append(density / (density.mean(axis=1, keepdims=True) + 1e-6))
+
+        for stem in self.stems:
+            for name in ('rms', 'spectral_centroid'):
+                values = beat_sync.pool(*song.feature(name, stem), 'bar')
+                values = np.nan_to_num(values, nan=np.nanmean(values) if np.any(np.isfinite(values)) else 0.0)
+                columns.append((values / (values.mean() + 1e-6))[None, :])
+
+        local = np.vstack(columns)
+        # 前後の小節の平均との差でセクションの切り替わりを捉える
+        kernel = np.ones(2 * self.context + 1) / (2 * self.context + 1)
+        smoothed = np.vstack([np.convolve(row, kernel, mode='same') for row in local])
+
+        position = (np.arange(n_bars) + 0.5) / n_bars
+        positional = np.vstack([position, position ** 2, (1 - position) ** 2])
+        return np.vstack([local, smoothed, local - smoothed, positional]).T.astype(np.float32)
+
+    @property
+    def n_features(self):
+        return 3 * (8 + 2 * len(self.stems)) + 3
+
+    def bar_labels(self, song):
+        labels = self.bar_grid(song).labels(song.segments, 'bar')
+        index = {label: i for i, label in enumerate(self.labels)}
+        return np.array([index.get(label, -1) for label in labels], dtype=np.int64)
+
+    def dataset(self, songs):
+        features, targets = [], []
+        for song in tqdm(songs, desc="Extracting features"):
+            x = self.bar_features(song)
+            y = self.bar_labels(song)
+            valid = y >= 0
+            features.append(x[valid])
+            targets.append(y[valid])
+        return np.concatenate(features), np.concatenate(targets)
+
+    def fit(self, features, targets):
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0) + 1e-6
+        x = self._design(features)
+        onehot = np.eye(len(self.labels), dtype=np.float32)[targets]
+        # クラスの偏り(dropが大半)を打ち消す重み
+        class_weights = len(targets) / (len(self.labels) * np.maximum(np.bincount(targets, minlength=len(self.labels)), 1))
+        sample_weights = class_weights[targets][:, None]
+
+        self.weights = np.zeros((x.shape[1], len(self.labels)), dtype=np.float32)
+        for _ in range(self.n_iter):
+            probabilities = self._softmax(x @ self.weights)
+            gradient = x.T @ ((probabilities - onehot) * sample_weights) / len(x)
+            gradient[1:] += self.l2 * self.weights[1:]
+            self.weights -= self.learning_rate * gradient
+        return self
+
+    def predict_proba(self, features):
+        return self._softmax(self._design(features) @ self.weights)
+
+    def predict(self, features):
+        return np.argmax(self.predict_proba(features), axis=1)
+
+    def predict_segments(self, song):
+        beat_sync = self.bar_grid(song)
+        downbeats = beat_sync.downbeats
+        if len(downbeats) == 0:
+            return []
+        predicted = self.predict(self.bar_features(song))
+        end = song.duration or beat_sync.end or downbeats[-1] + (np.median(np.diff(downbeats)) if len(downbeats) > 1 else 0.0)
+        boundaries = np.flatnonzero(np.diff(predicted)) + 1
+        starts = np.concatenate([[0], boundaries])
+        stops = np.append(boundaries, len(predicted))
+        return [{'start': float(downbeats[start]) if i > 0 else 0.0,
+                 'end': float(downbeats[stop]) if stop < len(downbeats) else float(end),
+                 'label': self.labels[predicted[start]]}
+                for i, (start, stop) in enumerate(zip(starts, stops))]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, weights=self.weights, mean=self.mean, std=self.std, labels=np.array(self.labels), stems=np.array(self.stems, dtype=str),
+                 params=np.array([self.context, self.l2, self.learning_rate, self.n_iter]), grid=np.array(self.grid))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            context, l2, learning_rate, n_iter = data['params']
+            # grid の無い古いモデルはallin1の小節線で学習したもの
+            grid = str(data['grid']) if 'grid' in data.files else 'allin1'
+            classifier = cls(list(data['labels']), tuple(data['stems']), int(context), float(l2), float(learning_rate), int(n_iter), grid)
+            classifier.weights, classifier.mean, classifier.std = data['weights'], data['mean'], data['std']
+        return classifier
+
+    def _design(self, features):
+        x = (features - self.mean) / self.std
+        return np.hstack([np.ones((len(x), 1), dtype=np.float32), x.astype(np.float32)])
+
+    @staticmethod
+    def _softmax(logits):
+        logits = logits - logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+
+def split_songs(songs, test_ratio=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(songs))
+    n_test = int(round(len(songs) * test_ratio))
+    return [songs[i] for i in order[n_test:]], [songs[i] for i in order[:n_test]]
+
+def time_agreement(predicted_segments, reference_segments, resolution=0.1):
+    end = max(segment['end'] for segment in reference_segments)
+    grid = np.arange(0, end, resolution)
+
+    def labels_at(segments):
+        starts = np.array([segment['start'] for segment in segments])
+        index = np.clip(np.searchsorted(starts, grid, side='right') - 1, 0, len(segments) - 1)
+        return np.array([segments[i]['label'] for i in index])
+
+    return float(np.mean(labels_at(predicted_segments) == labels_at(reference_segments)))
+
+def report_agreement(classifier, songs):
+    x, y = classifier.dataset(songs)
+    predicted = classifier.predict(x)
+    print(f"{colored('Bar agreement', 'blue')}: {np.mean(predicted == y) * 100:.2f}% ({len(y)} bars, {len(songs)} songs)")
+
+    confusion = np.zeros((len(classifier.labels), len(classifier.labels)), dtype=np.int64)
+    np.add.at(confusion, (y, predicted), 1)
+    print(f"{'allin1 / predicted':>20}" + ''.join(f"{label:>8}" for label in classifier.labels))
+    for label, row in zip(classifier.labels, confusion):
+        print(f"{label:>20}" + ''.join(f"{count:>8}" for count in row))
+
+    agreements, elapsed = [], []
+    for song in songs:
+        start = time.perf_counter()
+        segments = classifier.predict_segments(song)
+        elapsed.append(time.perf_counter() - start)
+        if segments:
+            agreements.append(time_agreement(segments, song.segments))
+    print(f"{colored('Time agreement', 'blue')}: {np.mean(agreements) * 100:.2f}%")
+    print(f"{colored('Prediction time', 'blue')}: median {np.median(elapsed) * 1000:.1f} ms, max {np.max(elapsed) * 1000:.1f} ms per song")
+
+def main(process_mode):
+    json_directory = const.PROD_JSON_DIRECTORY
+    midi_directory = const.PROD_MIDI_DIRECTORY
+    song_directory = const.PROD_SONG_DIRECTORY
+    model_path = os.path.join(const.PROD_CACHE_DIRECTORY, 'section_classifier.npz')
+
+    if process_mode == 'predict':
+        classifier = SectionClassifier.load(model_path)
+        for song in unlabeled_songs(midi_directory, song_directory):
+            print(song.name, [(round(segment['start'], 2), segment['label']) for segment in classifier.predict_segments(song)])
+        return
+
+    corpus = Corpus(CorpusManifest.load_or_build(json_directory=json_directory, midi_directory=midi_directory))
+    songs = list(corpus.songs(require=('midi',)))
+
+    if process_mode == 'evaluate':
+        train_songs, test_songs = split_songs(songs)
+        classifier = SectionClassifier()
+        classifier.fit(*classifier.dataset(train_songs))
+        report_agreement(classifier, test_songs)
+    elif process_mode == 'train':
+        classifier = SectionClassifier()
+        classifier.fit(*classifier.dataset(songs))
+        classifier.save(model_path)
+        print(f"{colored('Saved', 'blue')}: {model_path}")
+
+if __name__ == "__main__":
+    process_mode = 'evaluate'  # 'evaluate' | 'train' | 'predict'
+    main(process_mode)
@@ -0,0 +1,133 @@
+from external_libraries import *
+from instrumentation import profile
+from precision import as_float_array
+from result_log import record_test
+
+# 複数の検定(コンポーネント×特徴量など)をまとめて扱うため，全データを1本の配列に詰める
+class GroupedSamples:
+    def __init__(self, studies):
+        self.names = list(studies)
+        self.groups = []
+        values, study_ids, group_ids = [], [], []
+        for i, name in enumerate(self.names):
+            groups = [(group, as_float_array(data)) for group, data in studies[name].items()]
+            groups = [(group, data) for group, data in groups if len(data)]
+            self.groups.append([group for group, _ in groups])
+            for j, (_, data) in enumerate(groups):
+                values.append(data)
+                study_ids.append(np.full(len(data), i))
+                group_ids.append(np.full(len(data), j))
+
+        self.values = np.concatenate(values) if values else np.zeros(0)
+        self.study_ids = np.concatenate(study_ids) if study_ids else np.zeros(0, dtype=np.int64)
+        self.group_ids = np.concatenate(group_ids) if group_ids else np.zeros(0, dtype=np.int64)
+        self.n_studies = len(self.names)
+        self.max_groups = max((len(groups) for groups in self.groups), default=0)
+        self.n_groups = np.array([len(groups) for groups in self.groups], dtype=np.int64)
+        self.ranks, self.tie_sums = rank_within(self.values, self.study_ids, self.n_studies)
+
+    @property
+    def n(self):
+        return np.bincount(self.study_ids, minlength=self.n_studies).astype(np.float64)
+
+    def group_stats(self):
+        # (検定, 群)ごとの件数と順位和
+        cell = self.study_ids * self.max_groups + self.group_ids
+        size = self.n_studies * self.max_groups
+        counts = np.bincount(cell, minlength=size).reshape(self.n_studies, self.max_groups).astype(np.float64)
+        rank_sums = np.bincount(cell, weights=self.ranks, minlength=size).reshape(self.n_studies, self.max_groups)
+        return counts, rank_sums
+
+
+def rank_within(values, study_ids, n_studies):
+    # 検定ごとに平均順位を付け，同順位の補正項 Σ(t³ - t) も同時に求める
+    if len(values) == 0:
+        return np.zeros(0), np.zeros(n_studies)
+    order = np.lexsort((values, study_ids))
+    sorted_values, sorted_studies = values[order], study_ids[order]
+
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_studies[1:] != sorted_studies[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(values)))
+
+    study_starts = np.searchsorted(sorted_studies, np.arange(n_studies))
+    first_rank = run_starts - study_starts[sorted_studies[run_starts]] + 1
+    run_ranks = first_rank + (run_lengths - 1) / 2.0
+
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(run_ranks, run_lengths)
+    tie_sums = np.bincount(sorted_studies[run_starts], weights=run_lengths ** 3.0 - run_lengths, minlength=n_studies)
+    return ranks, tie_sums
+
+def kruskal_wallis(samples):
+    n = samples.n
+    counts, rank_sums = samples.group_stats()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = 12.0 / (n * (n + 1)) * np.nansum(np.where(counts > 0, rank_sums ** 2 / counts, 0.0), axis=1) - 3 * (n + 1)
+        h /= 1 - samples.tie_sums / (n ** 3 - n)
+    df = samples.n_groups - 1
+    h = np.where(df > 0, h, np.nan)
+    return {'H': h, 'p': chi2.sf(h, np.maximum(df, 1)), 'df': df}
+
+def dunn(samples, p_adjust='bonferroni'):
+    # 群数が検定ごとに違うので (検定, 最大群数, 最大群数) の配列にし，無い群はnanにする
+    n = samples.n[:, None, None]
+    counts, rank_sums = samples.group_stats()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_ranks = rank_sums / counts
+        ties = (samples.tie_sums / (12.0 * (samples.n - 1)))[:, None, None]
+        spread = np.sqrt((n * (n + 1) / 12.0 - ties) * (1 / counts[:, :, None] + 1 / counts[:, None, :]))
+        z = np.abs(mean_ranks[:, :, None] - mean_ranks[:, None, :]) / spread
+
+    p = 2 * norm.sf(z)
+    upper = np.triu_indices(samples.max_groups, 1)
+    pairs = p[:, upper[0], upper[1]]
+    if p_adjust:
+        pairs = adjust_p_values(pairs, p_adjust)
+
+    adjusted = np.full_like(p, np.nan)
+    adjusted[:, upper[0], upper[1]] = pairs
+    adjusted[:, upper[1], upper[0]] = pairs
+    present = counts > 0
+    diagonal = np.arange(samples.max_groups)
+    adjusted[:, diagonal, diagonal] = np.where(present, 1.0, np.nan)
+    return {'z': z, 'p': adjusted}
+
+def adjust_p_values(p, method='bonferroni'):
+    # 行ごとに1つの検定族として補正する(nanは族に含めない)
+    p = np.atleast_2d(np.asarray(p, dtype=np.float64))
+    m = np.sum(~np.isnan(p), axis=1, keepdims=True)
+    if method == 'bonferroni':
+        return np.minimum(p * m, 1.0)
+    elif method == 'holm':
+        order = np.argsort(np.where(np.isnan(p), np.inf, p), axis=1)
+        sorted_p = np.take_along_axis(p, order, axis=1)
+        scaled = sorted_p * (m - np.arange(p.shape[1])[None, :])
+        scaled = np.minimum(np.fmax.accumulate(np.where(np.isnan(scaled), -np.inf, scaled), axis=1), 1.0)
+        scaled = np.where(np.isnan(sorted_p), np.nan, scaled)
+        adjusted = np.empty_like(p)
+        np.put_along_axis(adjusted, order, scaled, axis=1)
+        return adjusted
+    raise ValueError(f"Unknown p_adjust method: {method}")
+
+@profile('stats')
+def run_tests(studies, alpha=0.05, p_adjust='bonferroni', label=None):
+    samples = GroupedSamples(studies)
+    kw = kruskal_wallis(samples)
+    post_hoc = dunn(samples, p_adjust)
+
+    results = {}
+    for i, name in enumerate(samples.names):
+        title = f"{label} for {name}" if label else name
+        print(f"Kruskal-Wallis test for {title}: Statistics = {kw['H'][i]}, p-value = {kw['p'][i]}")
+        groups = samples.groups[i]
+        result = {'H': kw['H'][i], 'p': kw['p'][i], 'groups': groups, 'dunn': None}
+        if kw['p'][i] < alpha:
+            k = len(groups)
+            result['dunn'] = post_hoc['p'][i, :k, :k]
+            print(f"Dunn's test results for {title} (p-values):")
+            print(pd.DataFrame(result['dunn'], index=groups, columns=groups))
+        record_test(f"Kruskal-Wallis test for {title}", result['H'], result['p'], groups, result['dunn'])
+        results[name] = result
+    return results
@@ -0,0 +1,242 @@
+from external_libraries import *
+import data_const as const
+from audio_io import load_audio
+from abc import abstractmethod
+from collections import deque
+import time
+
+class AudioSource(ABC):
+    sr = 22050
+
+    @abstractmethod
+    def read(self, n_samples) -> Optional[Tuple[np.ndarray, float]]:
+        # (ブロック, ブロック末尾のサンプルが届いた時刻) を返し，終わりならNone
+        pass
+
+    def close(self):
+        pass
+
+
+# ファイルを読み込んでブロックごとに流す(ライブ入力の代わり)
+class FileReplaySource(AudioSource):
+    def __init__(self, path=None, y=None, sr=22050, realtime=False, backend='librosa'):
+        if y is None:
+            y, sr = load_audio(path, sr=sr, mono=True, backend=backend)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.sr = sr
+        self.realtime = realtime
+        self.position = 0
+        self.start_time = None
+
+    def read(self, n_samples):
+        if self.position >= len(self.y):
+            return None
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+        block = self.y[self.position:self.position + n_samples]
+        self.position += len(block)
+        arrival = self.start_time + self.position / self.sr
+        if self.realtime:
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            arrival = time.perf_counter()
+        return block, arrival
+
+
+class RingBuffer:
+    def __init__(self, capacity, dtype=np.float32):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.written = 0
+
+    def write(self, block):
+        block = block[-self.capacity:]
+        start = self.written % self.capacity
+        head = min(len(block), self.capacity - start)
+        self.buffer[start:start + head] = block[:head]
+        self.buffer[:len(block) - head] = block[head:]
+        self.written += len(block)
+
+    def latest(self, n_samples, offset=0):
+        # 末尾からoffsetサンプル前までのn_samplesを時系列順に返す
+        n_samples = min(n_samples, self.written - offset, self.capacity - offset)
+        if n_samples <= 0:
+            return np.zeros(0, dtype=self.buffer.dtype)
+        end = (self.written - offset) % self.capacity
+        start = end - n_samples
+        if start >= 0:
+            return self.buffer[start:end]
+        return np.concatenate([self.buffer[start:], self.buffer[:end]])
+
+
+# 1ホップごとにO(hop)の計算でRMS・スペクトル重心・ドロップ状態を更新する
+class StreamingAnalyzer:
+    def __init__(self, sr=22050, frame_length=2048, hop_length=512, threshold=0.8, hysteresis=0.1, min_hold=2.0,
+                 peak_decay=0.9999, centroid_smoothing=0.9, change_ratio=2.0, change_refractory=4.0, max_latencies=100000):
+        if frame_length % hop_length != 0:
+            raise ValueError("frame_length must be a multiple of hop_length")
+        self.sr = sr
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.min_hold = min_hold
+        self.peak_decay = peak_decay
+        self.centroid_smoothing = centroid_smoothing
+        self.change_ratio = change_ratio
+        self.change_refractory = change_refractory
+
+        self.ring = RingBuffer(frame_length + hop_length)
+        self.window = np.hanning(hop_length).astype(np.float32)
+        self.frequencies = np.fft.rfftfreq(hop_length, 1.0 / sr).astype(np.float32)
+        self.latencies = deque(maxlen=max_latencies)
+        self.reset()
+
+    def reset(self):
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.sum_squares = 0.0
+        self.peak = 1e-12
+        self.spectrum = np.zeros(len(self.frequencies), dtype=np.float32)
+        self.short_energy = None
+        self.long_energy = None
+        self.quiet_energy = None
+        self.change_armed = True
+        self.in_drop = False
+        self.candidate_since = None
+        self.last_change = -np.inf
+        self.n_hops = 0
+        self.state = {}
+        self.latencies.clear()
+
+    @property
+    def time(self):
+        return self.n_hops * self.hop_length / self.sr
+
+    def process(self, block, arrival=None):
+        events = []
+        self.pending = np.concatenate([self.pending, np.asarray(block, dtype=np.float32)])
+        while len(self.pending) >= self.hop_length:
+            hop, self.pending = self.pending[:self.hop_length], self.pending[self.hop_length:]
+            events.extend(self._update(hop))
+        if arrival is not None:
+            self.latencies.append(time.perf_counter() - arrival)
+        return events
+
+    def run(self, source, block_size=None):
+        block_size = block_size or self.hop_length
+        while True:
+            chunk = source.read(block_size)
+            if chunk is None:
+                break
+            block, arrival = chunk
+            for event in self.process(block, arrival):
+                yield event
+        source.close()
+
+    def latency_percentiles(self, percentiles=(50, 95, 99)):
+        if not self.latencies:
+            return {}
+        values = np.percentile(np.fromiter(self.latencies, dtype=np.float64), percentiles) * 1000
+        return {f"p{p}": value for p, value in zip(percentiles, values)}
+
+    def max_event_delay(self):
+        # 状態が変わってからイベントが出るまでの音声上の遅れの上限
+        return self.min_hold + self.hop_length / self.sr
+
+    def _update(self, hop):
+        # 窓から抜けるサンプルの二乗和を引き，入ってきたホップの分を足す
+        leaving = self.ring.latest(self.hop_length, offset=self.frame_length - self.hop_length) if self.ring.written >= self.frame_length else np.zeros(0)
+        self.ring.write(hop)
+        self.sum_squares += float(np.dot(hop, hop)) - float(np.dot(leaving, leaving))
+        self.n_hops += 1
+        if self.n_hops % 4096 == 0:
+            # 浮動小数点の誤差が溜まらないようにときどき窓全体から計算し直す
+            frame = self.ring.latest(self.frame_length).astype(np.float64)
+            self.sum_squares = float(np.dot(frame, frame))
+        self.sum_squares = max(self.sum_squares, 0.0)
+
+        rms = np.sqrt(self.sum_squares / min(self.ring.written, self.frame_length))
+        self.peak = max(rms, self.peak * self.peak_decay)
+        normalized = rms / self.peak
+
+        magnitude = np.abs(np.fft.rfft(hop * self.window)).astype(np.float32)
+        self.spectrum = self.centroid_smoothing * self.spectrum + (1 - self.centroid_smoothing) * magnitude
+        total = float(self.spectrum.sum())
+        centroid = float(np.dot(self.frequencies, self.spectrum) / total) if total > 0 else 0.0
+
+        energy = self._update_energy(rms)
+        self.state = {'time': self.time, 'rms': float(rms), 'normalized_rms': float(normalized), 'centroid': centroid, 'in_drop': self.in_drop}
+        return self._drop_events(normalized, energy) + self._change_events()
+
+    def _update_energy(self, rms):
+        energy = rms ** 2 + 1e-12
+        if self.short_energy is None:
+            self.short_energy = self.long_energy = self.quiet_energy = energy
+            return energy
+        hop_seconds = self.hop_length / self.sr
+        self.short_energy += (energy - self.short_energy) * min(1.0, hop_seconds / 0.5)
+        self.long_energy += (energy - self.long_energy) * min(1.0, hop_seconds / 8.0)
+        self.quiet_energy = min(self.quiet_energy, self.long_energy)
+        return energy
+
+    def _drop_events(self, normalized, energy):
+        # ピーク付近で，かつそれまでの静かな部分より十分大きいときだけドロップとみなす
+        # (曲の頭ではピークが現在値そのものになるため，ピーク比だけだと誤検出する)
+        loud = normalized > self.threshold and self.short_energy > self.change_ratio * self.quiet_energy
+        entering = not self.in_drop and loud
+        leaving = self.in_drop and normalized < self.threshold - self.hysteresis
+        if not (entering or leaving):
+            self.candidate_since = None
+            return []
+        if self.candidate_since is None:
+            self.candidate_since = self.time
+        if self.time - self.candidate_since < self.min_hold:
+            return []
+
+        self.in_drop = entering
+        self.candidate_since = None
+        return [self._event('drop_start' if entering else 'drop_end', self.time - self.min_hold)]
+
+    def _change_events(self):
+        # 短期と長期のエネルギー平均の比がchange_ratioを超えた瞬間だけ出し，比が戻るまでは再び出さない
+        ratio = self.short_energy / self.long_energy
+        contrast = max(ratio, 1 / ratio)
+        if contrast < np.sqrt(self.change_ratio):
+            self.change_armed = True
+        if not self.change_armed or contrast < self.change_ratio or self.time - self.last_change < self.change_refractory:
+            return []
+        self.change_armed = False
+        self.last_change = self.time
+        return [self._event('section_change', self.time)]
+
+    def _event(self, kind, audio_time):
+        return {'kind': kind, 'time': audio_time, 'detected_at': self.time, **{key: self.state[key] for key in ('normalized_rms', 'centroid')}}
+
+
+def monitor(source, analyzer=None, block_size=1024):
+    analyzer = analyzer or StreamingAnalyzer(sr=source.sr)
+    events = []
+    for event in analyzer.run(source, block_size):
+        events.append(event)
+        print(f"{colored(event['kind'], 'blue')}: {event['time']:8.2f} s (detected at {event['detected_at']:.2f} s)")
+
+    latencies = analyzer.latency_percentiles()
+    print(f"{colored('Latency', 'blue')}: " + ', '.join(f"{key} {value:.3f} ms" for key, value in latencies.items()))
+    print(f"{colored('Max event delay', 'blue')}: {analyzer.max_event_delay():.2f} s of audio")
+    return events, latencies
+
+def main(process_mode):
+    song_directory = const.PROD_SONG_DIRECTORY
+    song_path = os.path.join(song_directory, sorted(file for file in os.listdir(song_directory) if file.endswith('.mp3'))[0])
+
+    if process_mode == 'replay':
+        monitor(FileReplaySource(song_path, realtime=False))
+    elif process_mode == 'realtime':
+        monitor(FileReplaySource(song_path, realtime=True))
+
+if __name__ == "__main__":
+    process_mode = 'replay'  # 'replay' | 'realtime'
+    main(process_mode)
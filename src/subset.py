@@ -0,0 +1,307 @@
+from external_libraries import *
+from modules import *
+import data_const as const
+from manifest import CorpusManifest
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import time
+
+SECTION_LABELS = ['intro', 'drop', 'break', 'outro']
+# 層の切り方(特徴量ごとの分位数の数)．テンポ×長さ×ドロップの割合で18層
+STRATA_BINS = {'tempo': 3, 'duration': 3, 'drop_share': 2}
+# パイプラインの既定と同じ実験
+EXPERIMENTS = [('experiment1', 'box'), ('experiment2ex2', 'box'), ('experiment4', 'combined'), ('experiment5', 'distribution')]
+
+# 値は相対差10%以内，表の割合は5ポイント以内なら一致とみなす
+VALUE_TOLERANCE = 0.1
+SHARE_TOLERANCE = 0.05
+
+def song_features(song):
+    # 層分けに使う曲ごとの値(セクションの時間割合・テンポ・長さ)
+    segments = song.segments
+    duration = song.duration or (segments[-1]['end'] if segments else 0.0)
+    shares = {label: 0.0 for label in SECTION_LABELS}
+    for segment in segments:
+        if segment['label'] in shares:
+            shares[segment['label']] += segment['end'] - segment['start']
+    features = {f"{label}_share": share / duration if duration else 0.0 for label, share in shares.items()}
+    features['tempo'] = song.beat_data['bpm']
+    features['duration'] = duration
+    return features
+
+def _quantile_bins(values, n_bins):
+    # 欠損(テンポの無い曲など)は-1の層にまとめる
+    values = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    bins = np.full(len(values), -1)
+    known = ~np.isnan(values)
+    if known.any():
+        edges = np.quantile(values[known], np.linspace(0, 1, n_bins + 1)[1:-1])
+        bins[known] = np.searchsorted(edges, values[known], side='right')
+    return bins
+
+def stratify(features, bins=STRATA_BINS):
+    names = sorted(features)
+    columns = [_quantile_bins([features[name][key] for name in names], n_bins) for key, n_bins in bins.items()]
+    return {name: tuple(int(column[i]) for column in columns) for i, name in enumerate(names)}
+
+def _order_key(seed, song_name):
+    return hashlib.blake2b(f"{seed}:{song_name}".encode(), digest_size=8).hexdigest()
+
+def select_subset(strata, n_songs, seed=0):
+    # 層の大きさに比例して割り当て(最大剰余法)，層の中は曲名とseedのハッシュ順に取るので毎回同じ曲になる
+    groups = {}
+    for song_name, stratum in strata.items():
+        groups.setdefault(stratum, []).append(song_name)
+    for members in groups.values():
+        members.sort(key=lambda song_name: _order_key(seed, song_name))
+
+    n_songs = min(n_songs, len(strata))
+    quotas = {stratum: n_songs * len(members) / len(strata) for stratum, members in groups.items()}
+    counts = {stratum: int(quota) for stratum, quota in quotas.items()}
+    if n_songs >= len(groups):
+        counts = {stratum: max(count, 1) for stratum, count in counts.items()}
+        # 1曲に引き上げた分だけ，割り当てが最も余っている層(2曲以上)から減らして合計を保つ
+        while sum(counts.values()) > n_songs:
+            stratum = max((stratum for stratum in groups if counts[stratum] > 1), key=lambda stratum: (counts[stratum] - quotas[stratum], stratum))
+            counts[stratum] -= 1
+    for stratum in sorted(groups, key=lambda stratum: (counts[stratum] - quotas[stratum], stratum)):
+        if sum(counts.values()) >= n_songs:
+            break
+        counts[stratum] += 1
+    return sorted(song_name for stratum, members in groups.items() for song_name in members[:counts[stratum]])
+
+def ks_distance(sample, population):
+    # 経験分布関数の差の最大値(0なら分布が一致)
+    sample = np.sort([value for value in sample if value is not None])
+    population = np.sort([value for value in population if value is not None])
+    if not len(sample) or not len(population):
+        return np.nan
+    grid = np.concatenate([sample, population])
+    return float(np.max(np.abs(np.searchsorted(sample, grid, side='right') / len(sample)
+                               - np.searchsorted(population, grid, side='right') / len(population))))
+
+
+class SubsetRunner:
+    def __init__(self, name, directory, manifest, songs):
+        self.name = name
+        self.directory = directory
+        self.manifest = manifest
+        self.songs = songs
+
+    @classmethod
+    def select(cls, manifest, fraction=0.15, n_songs=None, seed=0, bins=STRATA_BINS, directory=None):
+        corpus = Corpus(manifest)
+        features = {song.name: song_features(song) for song in tqdm(corpus, total=len(corpus), desc="Stratifying")}
+        n_songs = n_songs or max(int(round(fraction * len(features))), 1)
+        songs = select_subset(stratify(features, bins), n_songs, seed)
+        name = f"n{len(songs)}_seed{seed}"
+        runner = cls(name, directory or os.path.join(const.PROD_CACHE_DIRECTORY, 'subsets', name), manifest, songs)
+        runner.print_fidelity(features)
+        return runner
+
+    @classmethod
+    def full(cls, manifest, directory=None):
+        # 全曲での実行(比較の基準)．ディレクトリは元のまま使う
+        songs = [entry['song_name'] for entry in manifest.songs()]
+        return cls('full', directory or os.path.join(const.PROD_CACHE_DIRECTORY, 'subsets', 'full'), manifest, songs)
+
+    @property
+    def is_full(self):
+        return self.name == 'full'
+
+    def print_fidelity(self, features):
+        subset = set(self.songs)
+        print(f"{colored('Subset', 'blue')}: {len(self.songs)} of {len(features)} songs")
+        for key in ['tempo', 'duration'] + [f"{label}_share" for label in SECTION_LABELS]:
+            population = [values[key] for values in features.values()]
+            sample = [values[key] for name, values in features.items() if name in subset]
+            print(f"{key:>12}: KS distance = {ks_distance(sample, population):.3f}")
+
+    def directories(self):
+        if self.is_full:
+            return {'json': const.PROD_JSON_DIRECTORY, 'song': const.PROD_SONG_DIRECTORY, 'demucs': const.PROD_DEMUCS_DIRECTORY,
+                    'midi': const.PROD_MIDI_DIRECTORY, 'cache': const.PROD_CACHE_DIRECTORY, 'figure': const.PROD_FIGURE_DIRECTORY}
+        return {'json': os.path.join(self.directory, 'allin1_formatted'), 'song': os.path.join(self.directory, 'songs'),
+                'demucs': os.path.join(self.directory, 'demucs', os.path.basename(os.path.normpath(const.PROD_DEMUCS_DIRECTORY))),
+                'midi': os.path.join(self.directory, 'midi'), 'cache': os.path.join(self.directory, 'cache'),
+                'figure': os.path.join(self.directory, 'figures')}
+
+    def materialize(self):
+        # 選んだ曲のJSON・ミックス・ステム・MIDIへのシンボリックリンクで本番と同じ構成のディレクトリを作る
+        if self.is_full:
+            return self
+        directories = self.directories()
+        for key in ('json', 'song', 'demucs', 'midi'):
+            if os.path.isdir(directories[key]):
+                rmtree(directories[key])
+            os.makedirs(directories[key])
+        for song_name in self.songs:
+            entry = self.manifest[song_name]
+            links = [(entry['json'], 'json'), (entry.get('mix'), 'song'), (entry.get('midi'), 'midi')]
+            stems = list(entry.get('stems', {}).values())
+            if stems:
+                links.append((os.path.dirname(stems[0]), 'demucs'))
+            for source, key in links:
+                if source:
+                    os.symlink(os.path.abspath(source), os.path.join(directories[key], os.path.basename(source)))
+        with open(os.path.join(self.directory, 'songs.json'), 'w') as file:
+            json.dump(self.songs, file, ensure_ascii=False, indent=4)
+        return self
+
+    def _bootstrap(self, module, process_mode):
+        # 実験を読み込む前に定数を差し替える(関数の既定値も差し替え後の値になる)
+        directories = {key: os.path.abspath(path) for key, path in self.directories().items()}
+        resampled = os.path.abspath(os.path.join(const.PROD_CACHE_DIRECTORY, 'resampled'))
+        return "\n".join([
+                "import data_const as const",
+                f"const.PROD_JSON_DIRECTORY = {directories['json']!r}",
+                f"const.PROD_SONG_DIRECTORY = {directories['song']!r}",
+                f"const.PROD_DEMUCS_DIRECTORY = {directories['demucs']!r}",
+                f"const.PROD_MIDI_DIRECTORY = {directories['midi']!r}",
+                f"const.PROD_CACHE_DIRECTORY = {directories['cache']!r}",
+                f"const.PROD_FIGURE_DIRECTORY = {directories['figure']!r}",
+                # リサンプル済みの音声は本番のキャッシュを共有する
+                "import audio_io",
+                f"audio_io.RESAMPLE_CACHE.directory = {resampled!r}",
+                f"import {module}",
+                f"{module}.main({process_mode!r})",
+                ])
+
+    def run_one(self, module, process_mode):
+        log_path = os.path.join(self.directory, 'logs', f"{module}_{process_mode}.log")
+        record_path = os.path.splitext(log_path)[0] + '.json'
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        # 失敗した時に前回の結果が残らないよう消してから走らせる
+        if os.path.exists(record_path):
+            os.remove(record_path)
+        start = time.perf_counter()
+        # 検定結果や集計値は子プロセスがresult_logでRESULTS_JSONに書き出す(標準出力は人が読むためのログ)
+        with open(log_path, 'w') as log, open(os.path.splitext(log_path)[0] + '.err', 'w') as err:
+            result = sp.run([sys.executable, "-c", self._bootstrap(module, process_mode)], stdout=log, stderr=err, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, 'MPLBACKEND': 'Agg', 'RESULTS_JSON': os.path.abspath(record_path)})
+        record = {'tests': {}, 'values': {}, 'tables': {}, 'samples': {}}
+        if os.path.exists(record_path):
+            with open(record_path, 'r') as file:
+                record.update(json.load(file))
+        record.update({'experiment': module, 'mode': process_mode, 'n_songs': len(self.songs),
+                       'wall': time.perf_counter() - start, 'returncode': result.returncode})
+        with open(record_path, 'w') as file:
+            json.dump(record, file, ensure_ascii=False, indent=4)
+        status = colored('ok', 'green') if result.returncode == 0 else colored(f"failed ({log_path})", 'red')
+        print(f"{colored(self.name, 'blue')}: {module}:{process_mode} {record['wall']:.1f}s {status}")
+        return record
+
+    def build_manifest(self):
+        # 子プロセスと同じ(絶対パスの)ディレクトリでマニフェストを作って保存しておく
+        # 子プロセスは読み込むだけになり，並列に同じファイルを書き換えなくなる
+        directories = {key: os.path.abspath(path) for key, path in self.directories().items()}
+        return CorpusManifest.load_or_build(json_directory=directories['json'], song_directory=directories['song'],
+                                            demucs_directory=directories['demucs'], midi_directory=directories['midi'],
+                                            cache_directory=directories['cache'])
+
+    def run(self, experiments=EXPERIMENTS, max_workers=None):
+        # 実験ごとに別プロセスで並列に走らせる
+        self.build_manifest()
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+            return list(executor.map(lambda job: self.run_one(*job), experiments))
+
+    def load_record(self, module, process_mode):
+        path = os.path.join(self.directory, 'logs', f"{module}_{process_mode}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+
+def _dunn_pairs(test):
+    groups, p = test.get('groups'), test.get('dunn')
+    if groups is None or p is None:
+        return {}
+    return {(groups[i], groups[j]): p[i][j] for i in range(len(groups)) for j in range(i + 1, len(groups))}
+
+def _shares(counts):
+    total = sum(counts.values())
+    return {key: value / total if total else 0.0 for key, value in counts.items()}
+
+def compare_records(subset, full, alpha=0.05):
+    rows = []
+    # 検定は有意かどうかの一致とp値，曲数あたりの統計量(効果の大きさの目安)の比を見る
+    sub_tests, ref_tests = subset.get('tests', {}), full.get('tests', {})
+    for name in sorted(sub_tests.keys() & ref_tests.keys()):
+        sub, ref = sub_tests[name], ref_tests[name]
+        effect_ratio = (sub['statistic'] / subset['n_songs']) / (ref['statistic'] / full['n_songs']) if ref['statistic'] else np.nan
+        rows.append({'name': name, 'kind': 'test', 'full': ref['p'], 'subset': sub['p'], 'ratio': effect_ratio,
+                     'agree': (sub['p'] < alpha) == (ref['p'] < alpha)})
+        # ダンの検定は両方で行われていれば，組ごとに有意かどうかを比べる
+        sub_pairs, ref_pairs = _dunn_pairs(sub), _dunn_pairs(ref)
+        for pair in sorted(sub_pairs.keys() & ref_pairs.keys()):
+            rows.append({'name': f"{name} Dunn {pair[0]}-{pair[1]}", 'kind': 'dunn', 'full': ref_pairs[pair], 'subset': sub_pairs[pair],
+                         'ratio': sub_pairs[pair] / ref_pairs[pair] if ref_pairs[pair] else np.nan,
+                         'agree': (sub_pairs[pair] < alpha) == (ref_pairs[pair] < alpha)})
+    sub_values, ref_values = subset.get('values', {}), full.get('values', {})
+    for name in sorted(sub_values.keys() & ref_values.keys()):
+        sub, ref = sub_values[name], ref_values[name]
+        rows.append({'name': name, 'kind': 'value', 'full': ref, 'subset': sub, 'ratio': sub / ref if ref else np.nan,
+                     'agree': abs(sub - ref) <= VALUE_TOLERANCE * abs(ref)})
+    # 表(打数など)は曲数で大きさが変わるので，行ごとの割合にしてから比べる
+    sub_tables, ref_tables = subset.get('tables', {}), full.get('tables', {})
+    for name in sorted(sub_tables.keys() & ref_tables.keys()):
+        for row in sorted(sub_tables[name].keys() & ref_tables[name].keys()):
+            sub, ref = _shares(sub_tables[name][row]), _shares(ref_tables[name][row])
+            for column in sorted(sub.keys() | ref.keys()):
+                sub_share, ref_share = sub.get(column, 0.0), ref.get(column, 0.0)
+                rows.append({'name': f"{name} {row} {column}", 'kind': 'share', 'full': ref_share, 'subset': sub_share,
+                             'ratio': sub_share / ref_share if ref_share else np.nan, 'agree': abs(sub_share - ref_share) <= SHARE_TOLERANCE})
+    # 曲ごとの値の分布はKS距離を有意水準alphaの棄却限界と比べる(中央値も並べる)
+    sub_samples, ref_samples = subset.get('samples', {}), full.get('samples', {})
+    for name in sorted(sub_samples.keys() & ref_samples.keys()):
+        sub, ref = sub_samples[name], ref_samples[name]
+        if not sub or not ref:
+            continue
+        critical = np.sqrt(-np.log(alpha / 2) / 2) * np.sqrt((len(sub) + len(ref)) / (len(sub) * len(ref)))
+        sub_median, ref_median = float(np.median(sub)), float(np.median(ref))
+        rows.append({'name': f"{name} distribution", 'kind': 'dist', 'full': ref_median, 'subset': sub_median,
+                     'ratio': sub_median / ref_median if ref_median else np.nan, 'agree': ks_distance(sub, ref) <= critical})
+    return rows
+
+def print_comparison(subset_runner, full_runner, experiments=EXPERIMENTS, alpha=0.05):
+    for module, process_mode in experiments:
+        subset, full = subset_runner.load_record(module, process_mode), full_runner.load_record(module, process_mode)
+        if subset is None or full is None:
+            print(f"{colored(f'{module}:{process_mode}', 'blue')}: run both the subset and the full corpus first")
+            continue
+        rows = compare_records(subset, full, alpha)
+        if not rows:
+            print(f"{colored(f'{module}:{process_mode}', 'blue')}: no results recorded by the experiment")
+            continue
+        agreement = np.mean([row['agree'] for row in rows])
+        print(f"{colored(f'{module}:{process_mode}', 'blue')}: {subset['n_songs']}/{full['n_songs']} songs, "
+              f"{subset['wall']:.1f}s vs {full['wall']:.1f}s, {agreement:.0%} agree")
+        print(f"{'name':>60} {'kind':>6} {'full':>10} {'subset':>10} {'ratio':>7}  agree")
+        for row in rows:
+            print(f"{row['name'][-60:]:>60} {row['kind']:>6} {row['full']:10.3g} {row['subset']:10.3g} {row['ratio']:7.2f}  "
+                  f"{'yes' if row['agree'] else colored('no', 'red')}")
+
+def main(process_mode):
+    json_directory = const.PROD_JSON_DIRECTORY
+    song_directory = const.PROD_SONG_DIRECTORY
+    demucs_directory = const.PROD_DEMUCS_DIRECTORY
+    midi_directory = const.PROD_MIDI_DIRECTORY
+    fraction = 0.15
+    seed = 0
+
+    manifest = CorpusManifest.load_or_build(json_directory=json_directory, song_directory=song_directory,
+                                            demucs_directory=demucs_directory, midi_directory=midi_directory)
+    if process_mode == 'select':
+        SubsetRunner.select(manifest, fraction, seed=seed).materialize()
+    elif process_mode == 'run':
+        SubsetRunner.select(manifest, fraction, seed=seed).materialize().run()
+    elif process_mode == 'full':
+        SubsetRunner.full(manifest).run()
+    elif process_mode == 'compare':
+        print_comparison(SubsetRunner.select(manifest, fraction, seed=seed), SubsetRunner.full(manifest))
+
+if __name__ == "__main__":
+    process_mode = 'run'  # 'select' | 'run' | 'full' | 'compare'
+    main(process_mode)
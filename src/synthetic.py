@@ -0,0 +1,261 @@
+from external_libraries import *
+import data_const as const
+from concurrent.futures import ProcessPoolExecutor
+
+COMPONENTS = ['bass', 'drums', 'other', 'vocals']
+# (ラベル, 小節数の候補, エネルギー)．ブレイクの後にドロップが戻る典型的な構成
+STRUCTURE = [('intro', (16, 32), 0.35), ('drop', (16, 32), 1.0), ('break', (8, 16), 0.45), ('drop', (16, 32), 1.0), ('outro', (16, 32), 0.3)]
+# 16分音符16ステップのパターン．ラベルごとにエネルギーに合わせて密度を変える
+PATTERNS = {
+        'intro': {35: '1000100010001000', 42: '0010001000100010'},
+        'drop': {35: '1000100010001000', 38: '0000100000001000', 42: '1010101010101010', 46: '0010001000100010'},
+        'break': {42: '0010001000100010', 39: '0000000000001000'},
+        'outro': {35: '1000100010001000', 42: '0010001000100010', 46: '0000000000000010'},
+        }
+CRASH = 49
+
+def song_name(index):
+    return f"{index:04d} - Synthetic {index}"
+
+def song_index(name):
+    return int(name.split(' - ')[0])
+
+def corpus_directories(root):
+    # data_const.py と同じ並び(songs/mp3, demucs/mdx_q, allin1_formatted, midi, cache)
+    return {
+            'song_directory': os.path.join(root, 'songs', 'mp3'),
+            'demucs_directory': os.path.join(root, 'demucs', 'mdx_q'),
+            'json_directory': os.path.join(root, 'allin1_formatted'),
+            'midi_directory': os.path.join(root, 'midi'),
+            'cache_directory': os.path.join(root, 'cache'),
+            }
+
+def make_song(index, seed=0):
+    # 曲番号ごとに子シードを作るので，曲数を変えても同じ番号の曲は同じになる
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+    base_bpm = float(rng.integers(118, 131))
+    structure = list(STRUCTURE)
+    if rng.random() < 0.4:
+        structure[3:3] = [('break', (8, 16), 0.45), ('drop', (16, 32), 1.0)]
+
+    sections, beats, downbeats = [], [], []
+    time = float(rng.uniform(0.1, 0.6))
+    for label, (min_bars, max_bars), energy in structure:
+        # ブレイクではテンポが少し揺れることがある(MIDIのテンポチェンジになる)
+        bpm = base_bpm + (float(rng.choice([-2, -1, 1, 2])) if label == 'break' and rng.random() < 0.5 else 0.0)
+        n_bars = int(rng.integers(min_bars // 8, max_bars // 8 + 1)) * 8
+        beat_length = 60.0 / bpm
+        section_beats = time + np.arange(n_bars * 4) * beat_length
+        sections.append({'label': label, 'start': time, 'end': time + n_bars * 4 * beat_length, 'bpm': bpm, 'bars': n_bars,
+                         'energy': energy * float(rng.uniform(0.9, 1.1))})
+        beats.append(section_beats)
+        downbeats.append(section_beats[::4])
+        time = sections[-1]['end']
+
+    return {'song_name': song_name(index), 'index': index, 'seed': seed, 'bpm': base_bpm, 'sections': sections,
+            'beats': np.concatenate(beats), 'downbeats': np.concatenate(downbeats), 'duration': time + float(rng.uniform(1.0, 4.0))}
+
+def song_rng(song, stream):
+    # 用途ごとに別の乱数列を使い，MIDIと音声のオンセットを一致させる
+    return np.random.default_rng(np.random.SeedSequence(song['seed'], spawn_key=(song['index'], stream)))
+
+def section_segments(song):
+    # allin1と同じく長いセクションは8/16小節ごとに分け，頭の無音は'start'(=intro)として残す
+    segments = [{'start': 0.0, 'end': round(song['sections'][0]['start'], 2), 'label': 'intro'}]
+    for section in song['sections']:
+        bar_length = 4 * 60.0 / section['bpm']
+        split = 16 if section['bars'] >= 32 else 8
+        for bar in range(0, section['bars'], split):
+            start = section['start'] + bar * bar_length
+            end = min(section['end'], start + split * bar_length)
+            segments.append({'start': round(start, 2), 'end': round(end, 2), 'label': section['label']})
+    segments.append({'start': round(song['sections'][-1]['end'], 2), 'end': round(song['duration'], 2), 'label': 'outro'})
+    return segments
+
+def allin1_json(song, path):
+    beats = song['beats']
+    return {
+            'path': path,
+            'bpm': int(round(song['bpm'])),
+            'beats': np.round(beats, 2).tolist(),
+            'downbeats': np.round(song['downbeats'], 2).tolist(),
+            'beat_positions': (np.arange(len(beats)) % 4 + 1).tolist(),
+            'segments': section_segments(song),
+            }
+
+def drum_events(song):
+    # (onset, note, velocity) をセクションのパターンから作り，小節ごとに少し崩して人間味を出す
+    rng = song_rng(song, 1)
+    onsets, notes, velocities = [], [], []
+    for section in song['sections']:
+        step = 60.0 / section['bpm'] / 4
+        pattern = {note: np.array([c == '1' for c in steps]) for note, steps in PATTERNS[section['label']].items()}
+        for bar in range(section['bars']):
+            bar_start = section['start'] + bar * 16 * step
+            for note, hits in pattern.items():
+                hits = hits.copy()
+                if bar % 8 == 7:
+                    # 8小節ごとのフィル
+                    hits[12:] |= rng.random(4) < 0.5
+                hits &= rng.random(16) > 0.03
+                positions = np.flatnonzero(hits)
+                onsets.append(bar_start + positions * step + rng.normal(0, 0.004, len(positions)))
+                notes.append(np.full(len(positions), note))
+                velocities.append(np.clip(rng.normal(90 + 30 * section['energy'], 8, len(positions)), 1, 127))
+        onsets.append(np.array([section['start']]))
+        notes.append(np.array([CRASH]))
+        velocities.append(np.array([110.0]))
+
+    onsets = np.maximum(np.concatenate(onsets), 0.0)
+    order = np.argsort(onsets, kind='stable')
+    return onsets[order], np.concatenate(notes)[order].astype(np.uint8), np.concatenate(velocities)[order].astype(np.uint8)
+
+def write_midi(song, path, ticks_per_beat=480):
+    # omnizartの出力と同じく1トラック(type 0)にテンポチェンジとチャンネル10のノートを並べる
+    onsets, notes, velocities = drum_events(song)
+    # 最初のテンポは0秒から有効にする
+    tempo_times = [0.0] + [section['start'] for section in song['sections'][1:]]
+    tempos = [mido.bpm2tempo(section['bpm']) for section in song['sections']]
+
+    # 秒 -> tick (テンポは区間ごとに一定)
+    tick_offsets = [0.0]
+    for i in range(1, len(tempo_times)):
+        tick_offsets.append(tick_offsets[-1] + (tempo_times[i] - tempo_times[i - 1]) * 1e6 / tempos[i - 1] * ticks_per_beat)
+
+    def to_ticks(times):
+        segment = np.searchsorted(tempo_times, times, side='right') - 1
+        return np.round(np.take(tick_offsets, segment) + (times - np.take(tempo_times, segment)) * 1e6 / np.take(tempos, segment) * ticks_per_beat).astype(np.int64)
+
+    messages = [(tick, 0, mido.MetaMessage('set_tempo', tempo=tempo)) for tick, tempo in zip(to_ticks(np.array(tempo_times)), tempos)]
+    note_ticks = to_ticks(onsets)
+    for tick, note, velocity in zip(note_ticks.tolist(), notes.tolist(), velocities.tolist()):
+        messages.append((tick, 1, mido.Message('note_on', channel=9, note=note, velocity=velocity)))
+        messages.append((tick + ticks_per_beat // 8, 2, mido.Message('note_off', channel=9, note=note, velocity=0)))
+    messages.sort(key=lambda message: (message[0], message[1]))
+
+    mid = mido.MidiFile(type=0, ticks_per_beat=ticks_per_beat)
+    track = mido.MidiTrack()
+    previous = 0
+    for tick, _, message in messages:
+        track.append(message.copy(time=tick - previous))
+        previous = tick
+    track.append(mido.MetaMessage('end_of_track', time=0))
+    mid.tracks.append(track)
+    mid.save(path)
+
+def energy_envelope(song, times):
+    # セクションのエネルギーを1小節かけてなめらかにつなぐ
+    starts = np.array([section['start'] for section in song['sections']])
+    energies = np.array([section['energy'] for section in song['sections']])
+    index = np.clip(np.searchsorted(starts, times, side='right') - 1, 0, len(starts) - 1)
+    envelope = energies[index]
+    ramp = 4 * 60.0 / song['bpm']
+    previous = energies[np.maximum(index - 1, 0)]
+    weight = np.clip((times - starts[index]) / ramp, 0, 1)
+    envelope = np.where(index > 0, previous + (envelope - previous) * weight, envelope)
+    return np.where((times < starts[0]) | (times > song['sections'][-1]['end']), 0.02, envelope)
+
+def feature_curve(song, sr=22050, hop_length=512, noise=0.05):
+    # 音声を作らずにフレーム単位のRMS相当の曲線を作る(ベンチマーク用)
+    rng = song_rng(song, 2)
+    times = np.arange(int(song['duration'] * sr / hop_length) + 1) * hop_length / sr
+    values = energy_envelope(song, times) * 0.3 + rng.normal(0, noise * 0.3, len(times))
+    return np.abs(values).astype(np.float32)[None, :], times
+
+def synthesize_stems(song, sr=22050):
+    rng = song_rng(song, 3)
+    n = int(song['duration'] * sr)
+    t = np.arange(n) / sr
+    envelope = energy_envelope(song, t)
+
+    # ドラム: MIDIと同じオンセットにキック・スネア・ハイハットの減衰音を畳み込む
+    onsets, notes, velocities = drum_events(song)
+    kernel_t = np.arange(int(0.25 * sr), dtype=np.float32) / sr
+    noise = rng.standard_normal(len(kernel_t)).astype(np.float32)
+    kernels = {
+            'low': np.sin(2 * np.pi * 55 * kernel_t * np.exp(-kernel_t * 8)) * np.exp(-kernel_t * 18),
+            'mid': noise * np.exp(-kernel_t * 30),
+            'high': np.diff(noise, prepend=0) * np.exp(-kernel_t * 80),
+            }
+    groups = {'low': (35, 36), 'mid': (37, 38, 39, 40), 'high': (42, 44, 46, 49, 51)}
+    drums = np.zeros(n, dtype=np.float32)
+    for kind, group in groups.items():
+        mask = np.isin(notes, group)
+        impulses = np.zeros(n, dtype=np.float32)
+        np.add.at(impulses, np.minimum((onsets[mask] * sr).astype(np.int64), n - 1), velocities[mask] / 127.0)
+        drums += fftconvolve(impulses, kernels[kind])[:n].astype(np.float32)
+
+    # ベース: 拍ごとにルートが動くサイン波，キックでダッキング
+    beat_index = np.clip(np.searchsorted(song['beats'], t, side='right') - 1, 0, len(song['beats']) - 1)
+    roots = 55 * 2 ** (rng.choice([0, 3, 5, 7], size=len(song['beats']) // 16 + 1) / 12)
+    frequency = roots[beat_index // 16]
+    phase = 2 * np.pi * np.cumsum(frequency) / sr
+    since_beat = t - song['beats'][beat_index]
+    bass = np.sin(phase) * (1 - np.exp(-since_beat * 12)) * np.clip(envelope - 0.3, 0, None)
+
+    # その他: 3和音のパッド，ボーカル: ビブラート付きの声部を2小節おきに
+    other = sum(np.sin(phase * ratio * 4) for ratio in (1.0, 1.26, 1.5)) / 3 * envelope
+    phrase = (beat_index // 8) % 2 == 0
+    vocals = np.sin(phase * 8 + 0.3 * np.sin(2 * np.pi * 5 * t)) * phrase * (envelope > 0.4) * 0.5
+
+    stems = {'bass': 0.4 * bass, 'drums': 0.5 * drums, 'other': 0.2 * other, 'vocals': 0.25 * vocals}
+    stems = {name: np.asarray(y, dtype=np.float32) for name, y in stems.items()}
+    mix = sum(stems.values())
+    peak = max(float(np.max(np.abs(mix))), 1e-6)
+    return {name: y / peak * 0.9 for name, y in stems.items()}, mix / peak * 0.9
+
+def write_mp3(path, y, sr, bitrate='128k'):
+    cmd = ["ffmpeg", "-y", "-v", "error", "-f", "f32le", "-ar", str(sr), "-ac", "1", "-i", "pipe:0", "-codec:a", "libmp3lame", "-b:a", bitrate, path]
+    result = sp.run(cmd, input=np.ascontiguousarray(y, dtype='<f4').tobytes(), stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed on {path}: {result.stderr.decode(errors='replace').strip()}")
+
+def write_song(index, directories, seed=0, audio=True, sr=22050, overwrite=False):
+    song = make_song(index, seed)
+    name = song['song_name']
+    json_path = os.path.join(directories['json_directory'], f"{name}.json")
+    midi_path = os.path.join(directories['midi_directory'], f"{name}.mid")
+    mix_path = os.path.join(directories['song_directory'], f"{name}.mp3")
+    stem_directory = os.path.join(directories['demucs_directory'], name)
+
+    if overwrite or not os.path.exists(json_path):
+        with open(json_path, 'w') as file:
+            json.dump(allin1_json(song, json_path), file, indent=4)
+    if overwrite or not os.path.exists(midi_path):
+        write_midi(song, midi_path)
+    if audio and (overwrite or not os.path.exists(mix_path)):
+        stems, mix = synthesize_stems(song, sr)
+        os.makedirs(stem_directory, exist_ok=True)
+        for component, y in stems.items():
+            write_mp3(os.path.join(stem_directory, f"{component}.mp3"), y, sr)
+        # ミックスは最後に書くので，途中で止まっても次回ステムから作り直す
+        write_mp3(mix_path, mix, sr)
+    return name
+
+def _write_song(args):
+    return write_song(*args)
+
+def generate_corpus(root, n_songs, seed=0, audio=True, sr=22050, overwrite=False, max_workers=None):
+    directories = corpus_directories(root)
+    for key, directory in directories.items():
+        if key != 'song_directory' or audio:
+            os.makedirs(directory, exist_ok=True)
+
+    arguments = [(index, directories, seed, audio, sr, overwrite) for index in range(n_songs)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        names = list(tqdm(executor.map(_write_song, arguments, chunksize=8), total=n_songs, desc="Generating synthetic corpus"))
+    print(f"{colored('generate_corpus', 'blue')}: {n_songs} songs in '{root}'.")
+    return names, directories
+
+def main(process_mode):
+    root = os.path.join(const.DEMO_CACHE_DIRECTORY, 'synthetic')
+
+    if process_mode == 'full':
+        generate_corpus(root, 10, audio=True)
+    elif process_mode == 'symbolic':
+        # JSONとMIDIだけ(音声なし)
+        generate_corpus(root, 1000, audio=False)
+
+if __name__ == "__main__":
+    process_mode = 'full'  # 'full' | 'symbolic'
+    main(process_mode)